@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure G-code parsing and analysis throughput of `printrun.gcoder`.
+
+Synthetic files of each style are generated, then every case is run in a
+separate process for each line implementation (compiled `GLine` and pure
+Python `PyLine`), so that the peak memory of each run can be measured.
+
+Examples:
+    python3 benchmarks/bench_gcoder.py --lines 200000 --output new.json
+    python3 benchmarks/bench_gcoder.py --baseline old.json --tolerance 0.15
+
+With --baseline, the exit status is 1 if a case got slower than allowed.
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import synthetic
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+IMPLEMENTATIONS = ("compiled", "python")
+
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def _case_gcode(gcoder, path, lines):
+    return lambda: gcoder.GCode(lines)
+
+
+def _case_light(gcoder, path, lines):
+    return lambda: gcoder.LightGCode(lines)
+
+
+def _case_append(gcoder, path, lines):
+    def run():
+        gcode = gcoder.GCode()
+        for line in lines:
+            gcode.append(line)
+        return gcode
+    return run
+
+
+def _case_layers(gcoder, path, lines):
+    # Line objects are created beforehand, only the analysis is timed
+    glines = [gcoder.Line(l2) for l2 in (l.strip() for l in lines) if l2]
+
+    def run():
+        gcode = gcoder.GCode(deferred=True)
+        gcode.lines = list(glines)
+        gcode._preprocess(build_layers=True)
+        return gcode
+    return run
+
+
+def _case_parse(gcoder, path, lines):
+    def run():
+        parse_line = gcoder.parse_line
+        line_class = gcoder.Line
+        for l2 in (l.strip() for l in lines):
+            if l2:
+                parse_line(line_class(l2))
+    return run
+
+
+def _case_mapped(gcoder, path, lines):
+    return lambda: gcoder.MappedGCode(path)
+
+
+def _case_packed(gcoder, path, lines):
+    return lambda: gcoder.PackedGCode(lines)
+
+
+def _case_columnar(gcoder, path, lines):
+    if importlib.util.find_spec("numpy") is None:
+        return None
+    return lambda: gcoder.GCode(lines, columnar=True)
+
+
+CASES = {
+    "gcode": _case_gcode,
+    "light": _case_light,
+    "append": _case_append,
+    "layers": _case_layers,
+    "parse": _case_parse,
+    "mapped": _case_mapped,
+    "packed": _case_packed,
+    "columnar": _case_columnar,
+}
+
+
+def run_worker(case, implementation, path, repeat):
+    """Time one case in this process, returns a result dict"""
+    if implementation == "python":
+        # Make the compiled module unavailable so that gcoder falls back
+        sys.modules["printrun.gcoder_line"] = None
+    import logging
+    logging.disable(logging.WARNING)
+    from printrun import gcoder
+    result = {"case": case, "implementation": implementation}
+    if implementation == "compiled" and gcoder.Line is gcoder.PyLine:
+        result["skipped"] = "compiled GLine unavailable"
+        return result
+    with open(path, encoding="utf-8") as f:
+        lines = f.readlines()
+    run = CASES[case](gcoder, path, lines)
+    if run is None:
+        result["skipped"] = "dependency unavailable"
+        return result
+    rss_before = _peak_rss_kb()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gcode = run()
+        timings.append(time.perf_counter() - start)
+        del gcode
+    best = min(timings)
+    result.update({
+        "lines": len(lines),
+        "seconds": best,
+        "timings": timings,
+        "lines_per_second": len(lines) / best if best else None,
+        "input_rss_kb": rss_before,
+        "peak_rss_kb": _peak_rss_kb(),
+    })
+    return result
+
+
+def _run_case(case, implementation, path, repeat):
+    command = [sys.executable, __file__, "--worker", case, implementation,
+               str(path), "--repeat", str(repeat)]
+    process = subprocess.run(command, capture_output=True, text=True,
+                             cwd=str(ROOT))
+    if process.returncode != 0:
+        return {"case": case, "implementation": implementation,
+                "error": process.stderr.strip().splitlines()[-1:]}
+    return json.loads(process.stdout)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=str(ROOT),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """List the results slower than `baseline` by more than `tolerance`"""
+    previous = {(r["style"], r["case"], r["implementation"]): r["seconds"]
+                for r in baseline["results"] if "seconds" in r}
+    regressions = []
+    for result in results:
+        key = (result["style"], result["case"], result["implementation"])
+        if "seconds" not in result or key not in previous:
+            continue
+        ratio = result["seconds"] / previous[key]
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append((key, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=100000,
+                        help="approximate number of lines per file")
+    parser.add_argument("--styles", default=",".join(synthetic.STYLES),
+                        help="comma separated G-code styles (%(default)s)")
+    parser.add_argument("--cases", default=",".join(CASES),
+                        help="comma separated cases (%(default)s)")
+    parser.add_argument("--implementations",
+                        default=",".join(IMPLEMENTATIONS),
+                        help="comma separated line implementations "
+                             "(%(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs per case, the fastest one is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--baseline",
+                        help="JSON results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="allowed slowdown against the baseline")
+    parser.add_argument("--worker", nargs=3,
+                        metavar=("CASE", "IMPLEMENTATION", "PATH"),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        case, implementation, path = args.worker
+        print(json.dumps(run_worker(case, implementation, path,
+                                    args.repeat)))
+        return 0
+
+    styles = [s for s in args.styles.split(",") if s]
+    cases = [c for c in args.cases.split(",") if c]
+    implementations = [i for i in args.implementations.split(",") if i]
+    for case in cases:
+        if case not in CASES:
+            parser.error("unknown case %r" % case)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for style in styles:
+            path = Path(directory) / ("%s.gcode" % style)
+            count = synthetic.write(path, args.lines, style, args.seed)
+            for case in cases:
+                for implementation in implementations:
+                    result = _run_case(case, implementation, path,
+                                       args.repeat)
+                    result["style"] = style
+                    # Skipped and failed cases report no count of their own
+                    result.setdefault("lines", count)
+                    results.append(result)
+                    if "seconds" in result:
+                        status = "%8.3fs %10.0f lines/s %8s kB" % (
+                            result["seconds"], result["lines_per_second"],
+                            result["peak_rss_kb"])
+                    else:
+                        status = result.get("skipped") or \
+                            "error: %s" % result.get("error")
+                    print("%-10s %-9s %-8s %s" % (style, case, implementation,
+                                                  status))
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "lines": args.lines,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for (style, case, implementation), ratio in regressions:
+            print("REGRESSION %s %s %s: %.2fx slower"
+                  % (style, case, implementation, ratio))
+        status = 1 if regressions else 0
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Synthetic G-code resembling the output of common slicers and CAM tools.
+
+Every style produces layers of perimeters and infill with the usual
+retractions, travel moves and comments, with the features each style is
+meant to exercise. Output only depends on the style, size and seed.
+"""
+
+import math
+import random
+
+STYLES = ("slicer", "arcs", "multitool", "relative-e", "cnc")
+
+LAYER_HEIGHT = 0.2
+FILAMENT_PER_MM = 0.033
+
+
+def _header(style):
+    yield "; generated by Printrun benchmarks, style: %s" % style
+    yield "M107"
+    if style == "cnc":
+        yield "G21 ; set units to millimeters"
+        yield "G90"
+        yield "G28"
+        return
+    yield "M104 S200 ; set temperature"
+    yield "M140 S60"
+    yield "G28 ; home all axes"
+    yield "M190 S60"
+    yield "M109 S200"
+    yield "G21 ; set units to millimeters"
+    yield "G90 ; use absolute coordinates"
+    if style == "relative-e":
+        yield "M83 ; use relative distances for extrusion"
+    else:
+        yield "M82 ; use absolute distances for extrusion"
+    yield "G92 E0"
+
+
+def _footer(style):
+    if style == "cnc":
+        yield "M5"
+        yield "G0 Z10"
+    else:
+        yield "M104 S0"
+        yield "M140 S0"
+    yield "G28 X0"
+    yield "M84"
+
+
+class _Writer:
+    """Keep track of position and extrusion while emitting moves"""
+
+    def __init__(self, style, rnd):
+        self.style = style
+        self.rnd = rnd
+        self.x = self.y = 0.
+        self.e = 0.
+        self.tool = 0
+
+    def _extrusion(self, length):
+        amount = length * FILAMENT_PER_MM
+        if self.style == "relative-e":
+            return amount
+        self.e += amount
+        return self.e
+
+    def travel(self, x, y):
+        self.x, self.y = x, y
+        if self.style == "cnc":
+            return "G0 X%.3f Y%.3f" % (x, y)
+        return "G1 X%.3f Y%.3f F9000" % (x, y)
+
+    def extrude(self, x, y, feedrate):
+        length = math.hypot(x - self.x, y - self.y)
+        self.x, self.y = x, y
+        if self.style == "cnc":
+            return "G1 X%.3f Y%.3f F%d" % (x, y, feedrate)
+        return "G1 X%.3f Y%.3f E%.5f F%d" % (x, y, self._extrusion(length),
+                                             feedrate)
+
+    def arc(self, x, y, i, j, clockwise):
+        radius = math.hypot(i, j)
+        # Arc length, approximated by a quarter turn
+        length = radius * math.pi / 2
+        self.x, self.y = x, y
+        return "%s X%.3f Y%.3f I%.3f J%.3f E%.5f F1800" % (
+            "G2" if clockwise else "G3", x, y, i, j, self._extrusion(length))
+
+    def retract(self):
+        if self.style == "cnc":
+            return []
+        if self.style == "relative-e":
+            return ["G1 E-0.8 F2400"]
+        self.e -= 0.8
+        return ["G1 E%.5f F2400" % self.e]
+
+    def unretract(self):
+        if self.style == "cnc":
+            return []
+        if self.style == "relative-e":
+            return ["G1 E0.8 F2400"]
+        self.e += 0.8
+        return ["G1 E%.5f F2400" % self.e]
+
+
+def _layer(writer, z, layer_id):
+    """Lines of one layer: a few perimeters then infill"""
+    rnd = writer.rnd
+    style = writer.style
+    yield ";LAYER:%d" % layer_id
+    if style == "cnc":
+        yield "M3 S12000"
+        yield "G1 Z%.3f F300" % -z
+    else:
+        if style != "relative-e":
+            yield "G92 E0"
+            writer.e = 0.
+        yield "G1 Z%.3f F7800" % z
+    if style == "multitool" and layer_id % 2:
+        writer.tool = 1 - writer.tool
+        yield "T%d" % writer.tool
+        yield "G92 E0"
+        writer.e = 0.
+    cx = 100 + rnd.uniform(-5, 5)
+    cy = 100 + rnd.uniform(-5, 5)
+    for perimeter in range(3):
+        size = 20 - perimeter * 0.45
+        corners = [(cx - size, cy - size), (cx + size, cy - size),
+                   (cx + size, cy + size), (cx - size, cy + size)]
+        yield from writer.retract()
+        yield writer.travel(*corners[0])
+        yield from writer.unretract()
+        yield ";TYPE:WALL-%s" % ("OUTER" if perimeter == 0 else "INNER")
+        if style == "arcs":
+            # Rounded square: straight sides joined by quarter circles
+            radius = 2.
+            for k in range(4):
+                x0, y0 = corners[k]
+                x1, y1 = corners[(k + 1) % 4]
+                dx = (x1 - x0) / (2 * size)
+                dy = (y1 - y0) / (2 * size)
+                yield writer.extrude(x1 - dx * radius, y1 - dy * radius, 1800)
+                nx, ny = -dy, dx
+                yield writer.arc(x1 + nx * radius, y1 + ny * radius,
+                                 dx * radius, dy * radius, False)
+        else:
+            for x, y in corners[1:] + corners[:1]:
+                yield writer.extrude(x, y, 1800)
+    if style == "cnc":
+        yield "M5"
+        yield "G0 Z5"
+        return
+    yield from writer.retract()
+    yield writer.travel(cx - 19, cy - 19)
+    yield from writer.unretract()
+    yield ";TYPE:FILL"
+    # Zig-zag infill with some noise in line lengths
+    step = 0.45
+    y = cy - 19
+    forward = True
+    while y < cy + 19:
+        x = cx + 19 if forward else cx - 19
+        yield writer.extrude(x + rnd.uniform(-0.2, 0.2), y, 3600)
+        y += step
+        yield writer.extrude(writer.x, y, 3600)
+        forward = not forward
+
+
+def generate(lines, style="slicer", seed=0):
+    """Yield about `lines` lines of G-code in the given `style`"""
+    if style not in STYLES:
+        raise ValueError("unknown style %r, expected one of %s"
+                         % (style, ", ".join(STYLES)))
+    writer = _Writer(style, random.Random(seed))
+    count = 0
+    for line in _header(style):
+        count += 1
+        yield line
+    layer_id = 0
+    while count < lines:
+        z = (layer_id + 1) * LAYER_HEIGHT
+        for line in _layer(writer, z, layer_id):
+            count += 1
+            yield line
+        layer_id += 1
+    yield from _footer(style)
+
+
+def write(path, lines, style="slicer", seed=0):
+    """Write generated G-code to `path`, returns the number of lines"""
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for line in generate(lines, style, seed):
+            f.write(line)
+            f.write("\n")
+            count += 1
+    return count
@@ -0,0 +1,464 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+# Standard libraries:
+import asyncio
+import os
+import threading
+from collections import deque
+
+# Third-party libraries
+import serial
+
+# Custom libraries:
+from printrun.device import Device, DeviceError, READ_EMPTY, READ_EOF
+
+
+class LineProtocol(asyncio.Protocol):
+    """Split the data received from a device into lines.
+
+    Complete lines, including their end of line, are appended to `lines`,
+    followed by `READ_EOF` once the connection is lost. Writers wait with
+    `drain` while the transport buffers more than its high-water mark.
+
+    Attributes
+    ----------
+    lines : deque
+    exception : Exception
+        The error which closed the connection, if any.
+    transport : asyncio.Transport
+
+    """
+
+    def __init__(self):
+        self.lines = deque()
+        self.exception = None
+        self.transport = None
+        self._buffer = bytearray()
+        self._waiter = None
+        self._paused = False
+        self._drain_waiters = deque()
+
+    async def drain(self):
+        """Wait until the transport accepts more data to write"""
+        if not self._paused:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+
+    def _wake_writers(self):
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._wake_writers()
+
+    async def wait_line(self, timeout):
+        """Wait up to `timeout` seconds for `lines` not to be empty"""
+        if self.lines:
+            return
+        loop = asyncio.get_running_loop()
+        self._waiter = waiter = loop.create_future()
+        timer = loop.call_later(timeout, self._wake)
+        try:
+            await waiter
+        finally:
+            timer.cancel()
+            self._waiter = None
+
+    def _wake(self):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buffer = self._buffer
+        buffer += data
+        start = 0
+        eol = buffer.find(b'\n')
+        while eol >= 0:
+            self.lines.append(bytes(buffer[start:eol + 1]))
+            start = eol + 1
+            eol = buffer.find(b'\n', start)
+        if start:
+            del buffer[:start]
+            self._wake()
+
+    def eof_received(self):
+        # Let the transport close itself
+        return False
+
+    def connection_lost(self, exc):
+        if self._buffer:
+            self.lines.append(bytes(self._buffer))
+            self._buffer.clear()
+        self.exception = exc
+        self.lines.append(READ_EOF)
+        self._wake()
+        self._paused = False
+        self._wake_writers()
+
+
+class SerialTransport(asyncio.Transport):
+    """Asyncio transport over an open `serial.Serial` port.
+
+    The file descriptor of the port is watched by the event loop on POSIX
+    systems. Elsewhere, a thread blocks on reads and hands the data over to
+    the event loop.
+
+    Parameters
+    ----------
+    loop : asyncio.AbstractEventLoop
+    port : serial.Serial
+        The open serial port, in non-blocking mode.
+    protocol : asyncio.Protocol
+
+    """
+
+    max_size = 4096
+    # Flow control limits of the write buffer, in bytes
+    high_water = 64 * 1024
+    low_water = 16 * 1024
+
+    def __init__(self, loop, port, protocol):
+        super().__init__()
+        self._loop = loop
+        self._port = port
+        self._protocol = protocol
+        self._buffer = bytearray()
+        self._closing = False
+        self._writing_paused = False
+        self._thread = None
+        try:
+            self._fd = port.fileno()
+            loop.add_reader(self._fd, self._read_ready)
+        except (AttributeError, NotImplementedError):
+            # Windows, or an event loop without file descriptor support
+            self._fd = None
+            port.timeout = 0.25
+            self._thread = threading.Thread(target=self._read_thread,
+                                            name='serial read thread',
+                                            daemon=True)
+            self._thread.start()
+        loop.call_soon(protocol.connection_made, self)
+
+    @property
+    def port(self):
+        """The `serial.Serial` instance"""
+        return self._port
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, self.max_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fatal_error(e)
+            return
+        if data:
+            self._protocol.data_received(data)
+        else:
+            self._fatal_error(None)
+
+    def _read_thread(self):
+        port = self._port
+        while not self._closing:
+            try:
+                data = port.read(port.in_waiting or 1)
+            except (serial.SerialException, OSError) as e:
+                if not self._closing:
+                    self._loop.call_soon_threadsafe(self._fatal_error, e)
+                return
+            if data:
+                self._loop.call_soon_threadsafe(self._data_received, data)
+
+    def _data_received(self, data):
+        if not self._closing:
+            self._protocol.data_received(data)
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        if self._fd is None:
+            try:
+                self._port.write(data)
+            except serial.SerialException as e:
+                self._fatal_error(e)
+            return
+        if not self._buffer:
+            try:
+                written = os.write(self._fd, data)
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            except OSError as e:
+                self._fatal_error(e)
+                return
+            if written == len(data):
+                return
+            data = memoryview(data)[written:]
+            self._loop.add_writer(self._fd, self._write_ready)
+        self._buffer += data
+        if not self._writing_paused and len(self._buffer) > self.high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+
+    def _write_ready(self):
+        try:
+            written = os.write(self._fd, self._buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._fatal_error(e)
+            return
+        del self._buffer[:written]
+        if self._writing_paused and len(self._buffer) <= self.low_water:
+            self._writing_paused = False
+            self._protocol.resume_writing()
+        if not self._buffer:
+            self._loop.remove_writer(self._fd)
+            if self._closing:
+                self._close(None)
+
+    def get_write_buffer_size(self):
+        return len(self._buffer)
+
+    def get_write_buffer_limits(self):
+        return (self.low_water, self.high_water)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError(f"high ({high}) must be >= low ({low}) "
+                             "must be >= 0")
+        self.high_water = high
+        self.low_water = low
+
+    def can_write_eof(self):
+        return False
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        """Close once the buffered data has been written"""
+        if self._closing:
+            return
+        self._closing = True
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+        if not self._buffer:
+            self._close(None)
+
+    def abort(self):
+        self._close(None)
+
+    def _fatal_error(self, exc):
+        self._close(exc)
+
+    def _close(self, exc):
+        if self._port is None:
+            return
+        self._closing = True
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+        self._buffer.clear()
+        port = self._port
+        self._port = None
+        try:
+            port.close()
+        except serial.SerialException:
+            pass
+        self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+class AsyncDevice(Device):
+    """Handler for serial and socket connections on an asyncio event loop.
+
+    Provides the interface of `printrun.device.Device`, except that
+    `connect` and `readline` are coroutines and that `write` never blocks:
+    data is buffered by the underlying `asyncio.Transport`. It must be used
+    from the event loop that connected it.
+
+    Parameters
+    ----------
+    port : str, optional
+    baudrate : int, optional
+    force_dtr : bool or None, optional
+        See `printrun.device.Device`.
+
+    """
+
+    def __init__(self, port=None, baudrate=9600, force_dtr=None):
+        super().__init__(port, baudrate, force_dtr)
+        self._protocol = None
+
+    async def connect(self, port=None, baudrate=None):
+        """Establishes the connection to the device.
+
+        Parameters
+        ----------
+        port : str, optional
+        baudrate : int, optional
+            See `printrun.device.Device.connect`.
+
+        Raises
+        ------
+        DeviceError
+            If an error occurred when attempting to connect.
+
+        """
+        if port is not None:
+            self.port = port
+        if baudrate is not None:
+            self.baudrate = baudrate
+
+        if self.port is None:
+            raise DeviceError("No port or URL specified")
+        self._parse_type()
+        loop = asyncio.get_running_loop()
+        self._protocol = LineProtocol()
+        if self._type == 'socket':
+            await self._connect_socket_async(loop)
+        else:
+            self._connect_serial_async(loop)
+
+    async def readline(self, timeout=None) -> bytes:
+        """Read one line from the device stream.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Seconds to wait for a line, 0.25 by default.
+
+        Returns
+        -------
+        bytes
+            See `printrun.device.Device.readline`.
+
+        Raises
+        ------
+        DeviceError
+            If the connection was lost because of an error.
+
+        """
+        if self._protocol is None:
+            raise DeviceError("Attempted to read when disconnected")
+        protocol = self._protocol
+        lines = protocol.lines
+        if not lines:
+            await protocol.wait_line(self._timeout if timeout is None
+                                     else timeout)
+            if not lines:
+                return READ_EMPTY
+        line = lines[0]
+        if line is READ_EOF:
+            # Stay at the end of file for the next calls
+            if protocol.exception is not None:
+                msg = f"Connection to '{self.port}' lost"
+                raise DeviceError(msg, protocol.exception)
+            return line
+        return lines.popleft()
+
+    async def drain(self):
+        """Wait until the data written so far is mostly sent.
+
+        `write` buffers data without limit: writers sending many lines
+        should wait on this coroutine so that the buffer stays below the
+        high-water mark of the transport.
+        """
+        if self._protocol is not None:
+            await self._protocol.drain()
+
+    # ------------------------------------------------------------------------
+    # Serial Functions
+    # ------------------------------------------------------------------------
+    def _connect_serial_async(self, loop):
+        self._disable_ttyhup()
+        try:
+            port = serial.Serial(baudrate=self.baudrate, timeout=0,
+                                 parity=serial.PARITY_NONE)
+            port.port = self.port
+            if self.force_dtr is not None:
+                port.dtr = self.force_dtr
+            port.open()
+        except (serial.SerialException, IOError) as e:
+            msg = "Could not connect to serial port '{}'".format(self.port)
+            raise DeviceError(msg, e) from e
+        self._device = SerialTransport(loop, port, self._protocol)
+
+    def _is_connected_serial(self):
+        return not self._device.is_closing()
+
+    def _disconnect_serial(self):
+        self._device.close()
+        self._device = None
+
+    def _reset_serial(self):
+        port = self._device.port
+        port.dtr = True
+        asyncio.get_running_loop().call_later(0.2, setattr, port, 'dtr',
+                                              False)
+
+    def _write_serial(self, data):
+        if self._device.is_closing():
+            raise DeviceError(f"Unable to write to serial port '{self.port}'")
+        self._device.write(data)
+
+    # ------------------------------------------------------------------------
+    # Socket Functions
+    # ------------------------------------------------------------------------
+    async def _connect_socket_async(self, loop):
+        try:
+            self._device, _ = await asyncio.wait_for(
+                loop.create_connection(lambda: self._protocol,
+                                       self._hostname, self._port_number),
+                1.0)
+        except (OSError, asyncio.TimeoutError) as e:
+            self._device = None
+            msg = "Could not connect to {}:{}".format(self._hostname,
+                                                      self._port_number)
+            raise DeviceError(msg, e) from e
+        self._is_connected = True
+
+    def _is_connected_socket(self):
+        return self._is_connected and not self._device.is_closing()
+
+    def _disconnect_socket(self):
+        self._is_connected = False
+        self._device.close()
+        self._device = None
+
+    def _write_socket(self, data):
+        if self._device.is_closing():
+            self._is_connected = False
+            msg = ("Unable to write to {}:{}. Connection lost"
+                   ).format(self._hostname, self._port_number)
+            raise DeviceError(msg)
+        self._device.write(data)
@@ -0,0 +1,658 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import traceback
+from collections import deque
+from functools import reduce
+from printrun import gcoder
+from printrun import device
+from printrun.asyncdevice import AsyncDevice
+from printrun.eventbus import PrinterEvent
+from printrun.printcore import Callback, ResendBuffer, SendWindow, classify_line
+from printrun.printcore import AUTOREPORTS, parse_capability
+from printrun.printcore import LINE_CAPABILITY, LINE_DEBUG, LINE_ERROR, \
+    LINE_GREETING, LINE_OK_TEMP, LINE_POSITION, LINE_RESEND, LINE_TEMP
+from printrun.plugins import PRINTCORE_HANDLER
+
+class EventStream():
+    """Asynchronous iterator over the events of an `AsyncPrintcore`"""
+
+    def __init__(self, subscribers):
+        self._queue = asyncio.Queue()
+        self._subscribers = subscribers
+        subscribers.append(self._queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._subscribers is None:
+            raise StopAsyncIteration
+        return await self._queue.get()
+
+    async def aclose(self):
+        """Stop receiving events"""
+        if self._subscribers is not None:
+            self._subscribers.remove(self._queue)
+            self._subscribers = None
+
+class AsyncPrintcore():
+    """Core 3D printer host functionality on an asyncio event loop.
+
+    This is the asyncio counterpart of `printrun.printcore.printcore`. No
+    thread is started: replies are read and commands sent by two tasks of
+    the running event loop, so that a single thread can drive hundreds of
+    printers. All methods must be called from that event loop.
+
+    Events are delivered to the `PrinterEventHandler` objects in
+    `event_handler` and to the methods of `callback` like printcore does, and
+    can also be consumed as an asynchronous stream with `events`.
+
+    Attributes
+    ----------
+    analyzer : GCode
+        A `printrun.gcoder.GCode` object containing all the G-code commands
+        sent to the printer.
+    callback : Callback
+        See `printrun.printcore.Callback`.
+    event_handler : list of PrinterEventHandler
+        See `printrun.eventhandler.PrinterEventHandler`.
+    mainqueue : GCode
+        The G-code being printed.
+    online : bool
+        True if the printer has responded to the initial command and is
+        active.
+    paused : bool
+        True if there is a print currently on pause.
+    printer : AsyncDevice
+        The connection to the printer, None when disconnected.
+    printing : bool
+        True if there is a print currently running.
+    priqueue : deque
+        Commands sent ahead of the print, with the futures resolved once they
+        are written.
+    window_size, rx_buffer_size, window, resend_buffer_size, sentlines
+    autoreport_interval, autoreports, capabilities
+        See `printrun.printcore.printcore`.
+
+    """
+
+    def __init__(self):
+        self.baud = None
+        self.dtr = None
+        self.port = None
+        self.window_size = 1
+        self.rx_buffer_size = 128
+        self.window = None
+        self.analyzer = gcoder.GCode()
+        self.printer = None
+        self.clear = True
+        self.online = False
+        self.printing = False
+        self.paused = False
+        self.mainqueue = None
+        self.priqueue = deque()
+        self.queueindex = 0
+        self.lineno = 0
+        self.resendfrom = -1
+        self.resend_buffer_size = 1024
+        self.sentlines = ResendBuffer(self.resend_buffer_size)
+        self.autoreport_interval = 0
+        self.autoreports = set()
+        self.capabilities = {}
+        self.log = deque(maxlen = 10000)
+        self.writefailures = 0
+        self.callback = Callback()
+        self.callback.hostcommand = self._host_command_cb
+        self.callback.error = self._error_cb
+        self.event_handler = list(PRINTCORE_HANDLER)
+        self.loud = False
+        self.tcp_streaming_mode = False
+        self.greetings = ['start', 'Grbl ']
+        self.xy_feedrate = None
+        self.z_feedrate = None
+        self._subscribers = []
+        self._tasks = []
+        # Created on connection, within the event loop
+        self._wakeup = None
+        self._online_event = None
+        self._callback('init')
+
+    def addEventHandler(self, handler):
+        """Add a `printrun.eventhandler.PrinterEventHandler`"""
+        self.event_handler.append(handler)
+
+    def events(self):
+        """Return an asynchronous iterator over the events from now on.
+
+        Each `PrinterEvent` is queued for every iterator until it is consumed,
+        a consumer must keep up or close its iterator with `aclose`.
+
+        """
+        return EventStream(self._subscribers)
+
+    async def connect(self, port = None, baud = None, dtr = None,
+                      window_size = None):
+        """Set port, baudrate and send window size if given, then connect to
+        printer.
+
+        Returns once the connection is open, the printer is online once it
+        has replied, see `wait_online`.
+
+        """
+        if self.printer:
+            await self.disconnect()
+        if port is not None:
+            self.port = port
+        if baud is not None:
+            self.baud = baud
+        if dtr is not None:
+            self.dtr = dtr
+        if window_size is not None:
+            self.window_size = window_size
+        if self.port is None or self.baud is None:
+            return
+        self.writefailures = 0
+        self.autoreports = set()
+        self.capabilities = {}
+        printer = AsyncDevice(force_dtr = self.dtr)
+        try:
+            await printer.connect(self.port, self.baud)
+        except device.DeviceError as e:
+            self._logError("Connection error: %s" % e)
+            return
+        self.printer = printer
+        if self.window_size == 1:
+            self.window = None
+        else:
+            self.window = SendWindow(self.window_size, self.rx_buffer_size)
+        self._wakeup = asyncio.Event()
+        self._online_event = asyncio.Event()
+        self._callback('connect')
+        self._tasks = [asyncio.ensure_future(self._listen()),
+                       asyncio.ensure_future(self._sender())]
+
+    async def disconnect(self):
+        """Disconnects from printer and pauses the print"""
+        if self.printer:
+            # May be called from a callback of one of the tasks
+            current = asyncio.current_task()
+            tasks = [task for task in self._tasks if task is not current]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            self._tasks = []
+            try:
+                self.printer.disconnect()
+            except device.DeviceError:
+                self._logError(traceback.format_exc())
+            for command, future in self.priqueue:
+                if future is not None and not future.done():
+                    future.cancel()
+            self.priqueue.clear()
+        self._callback('disconnect')
+        self.printer = None
+        self.online = False
+        self.printing = False
+
+    async def wait_online(self, timeout = None):
+        """Wait until the printer is online, returns False on timeout"""
+        if self.online:
+            return True
+        if self._online_event is None:
+            return False
+        try:
+            await asyncio.wait_for(self._online_event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def reset(self):
+        """Attempt to reset the connection to the printer.
+
+        See `printrun.printcore.printcore.reset`.
+
+        """
+        self.printer.reset()
+
+    async def send(self, command):
+        """Add a command to the print if printing, else send it.
+
+        Outside of a print, returns once the command has been written.
+
+        """
+        if not self.online:
+            self._logError(_("Not connected to printer."))
+        elif self.printing:
+            self.mainqueue.append(command)
+        else:
+            await self.send_now(command)
+
+    async def send_now(self, command):
+        """Send a command ahead of the print, returns once it is written"""
+        if not self.online:
+            self._logError(_("Not connected to printer."))
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.priqueue.append((command, future))
+        self._wake()
+        await future
+
+    async def startprint(self, gcode, startindex = 0):
+        """Start a print.
+
+        Returns as soon as the print has started, see
+        `printrun.printcore.printcore.startprint`.
+
+        Returns
+        -------
+        bool
+            True on successful print start, False if already printing or
+            offline.
+
+        """
+        if self.printing or not self.online or not self.printer:
+            return False
+        self.queueindex = startindex
+        self.mainqueue = gcode
+        self.printing = True
+        self.lineno = 0
+        self.resendfrom = -1
+        self.sentlines = ResendBuffer(self.resend_buffer_size)
+        if self.window is not None:
+            self.window.reset()
+        self.clear = False
+        await self._send("M110 N-1", -1, True)
+        self._callback('start', startindex != 0)
+        self._wake()
+        return True
+
+    def cancelprint(self):
+        """Cancel an ongoing print."""
+        self.pause()
+        self.paused = False
+        self.mainqueue = None
+        self.clear = True
+
+    def pause(self):
+        """Pause an ongoing print, returns False if not printing.
+
+        See `printrun.printcore.printcore.pause`.
+
+        """
+        if not self.printing:
+            return False
+        self.paused = True
+        self.printing = False
+        self.pauseX = self.analyzer.abs_x
+        self.pauseY = self.analyzer.abs_y
+        self.pauseZ = self.analyzer.abs_z
+        self.pauseE = self.analyzer.abs_e
+        self.pauseF = self.analyzer.current_f
+        self.pauseRelative = self.analyzer.relative
+        self.pauseRelativeE = self.analyzer.relative_e
+        self._callback('end')
+        self._wake()
+        return True
+
+    async def resume(self):
+        """Resume a paused print, returns False if not paused.
+
+        See `printrun.printcore.printcore.resume`.
+
+        """
+        if not self.paused:
+            return False
+        self.send_now_nowait("G90")
+        xyFeed = '' if self.xy_feedrate is None else ' F' + str(self.xy_feedrate)
+        zFeed = '' if self.z_feedrate is None else ' F' + str(self.z_feedrate)
+        self.send_now_nowait("G1 X%s Y%s%s" % (self.pauseX, self.pauseY, xyFeed))
+        self.send_now_nowait("G1 Z" + str(self.pauseZ) + zFeed)
+        self.send_now_nowait("G92 E" + str(self.pauseE))
+        if self.pauseRelative:
+            self.send_now_nowait("G91")
+        if self.pauseRelativeE:
+            self.send_now_nowait('M83')
+        self.send_now_nowait("G1 F" + str(self.pauseF))
+        self.paused = False
+        self.printing = True
+        self._callback('start', True)
+        self._wake()
+        return True
+
+    def send_now_nowait(self, command):
+        """Queue a command ahead of the print without waiting for it"""
+        if not self.online:
+            self._logError(_("Not connected to printer."))
+            return
+        self.priqueue.append((command, None))
+        self._wake()
+
+    # ------------------------------------------------------------------------
+    # Reading
+    # ------------------------------------------------------------------------
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _logError(self, error):
+        self._callback('error', error)
+
+    def _error_cb(self, error):
+        logging.error(error)
+
+    def _host_command_cb(self, command):
+        if command.lstrip().startswith(";@pause"):
+            self.pause()
+
+    async def _readline(self):
+        try:
+            line_bytes = await self.printer.readline()
+            if line_bytes is device.READ_EOF:
+                self._logError("Can't read from printer (disconnected?).")
+                return None
+            line = classify_line(line_bytes.decode('utf-8'), self.greetings)
+            if len(line) > 1:
+                self.log.append(line)
+                self._callback('recv', line)
+                if self.loud: logging.info("RECV: %s" % line.rstrip())
+            return line
+        except UnicodeDecodeError:
+            msg = ("Got rubbish reply from {0} at baudrate {1}:\n"
+                   "Maybe a bad baudrate?").format(self.port, self.baud)
+            self._logError(msg)
+            return None
+        except device.DeviceError as e:
+            self._logError("Can't read from printer (disconnected?) %s" % e)
+            return None
+
+    def _set_online(self):
+        self.online = True
+        self._online_event.set()
+        self._callback('online')
+        self._request_capabilities()
+
+    def _request_capabilities(self):
+        if self.autoreport_interval:
+            self.send_now_nowait("M115")
+
+    def _capability(self, line):
+        name, enabled = parse_capability(line)
+        self.capabilities[name] = enabled
+        if enabled and name in AUTOREPORTS and self.autoreport_interval:
+            kind, command = AUTOREPORTS[name]
+            self.send_now_nowait("%s S%d" % (command,
+                                              self.autoreport_interval))
+            self.autoreports.add(kind)
+
+    async def _listen_until_online(self):
+        while not self.online and self.printer:
+            await self._send("M105")
+            if self.writefailures >= 4:
+                logging.error(_("Aborting connection attempt after 4 failed writes."))
+                return False
+            empty_lines = 0
+            while True:
+                line = await self._readline()
+                if line is None:
+                    return False
+                # See printcore._listen_until_online
+                if not line:
+                    empty_lines += 1
+                    if empty_lines == 15: break
+                else: empty_lines = 0
+                if line.ok or line.kind in (LINE_GREETING, LINE_TEMP):
+                    self._set_online()
+                    return True
+        return self.online
+
+    async def _listen(self):
+        self.clear = True
+        if not self.printing and not await self._listen_until_online():
+            return
+        resend_requested = False
+        # See printcore._listen
+        resend_ok = None
+        while self.printer:
+            line = await self._readline()
+            if line is None:
+                break
+            if resend_requested and resend_ok is not False:
+                if not line.ok:
+                    self.clear = True
+                    self._wake()
+                resend_ok = line.ok
+            resend_requested = False
+            kind = line.kind
+            if kind == LINE_DEBUG:
+                continue
+            if line.ok or kind == LINE_GREETING:
+                self.clear = True
+                self._wake()
+            if self.window is not None:
+                if line.ok:
+                    self.window.ack(line)
+                elif kind == LINE_GREETING:
+                    self.window.reset()
+            if kind == LINE_OK_TEMP or kind == LINE_TEMP:
+                self._callback('temp', line)
+            elif kind == LINE_POSITION:
+                self._callback('position', line)
+            elif kind == LINE_CAPABILITY:
+                self._capability(line)
+            elif kind == LINE_GREETING and self.online:
+                self.autoreports.clear()
+                self._request_capabilities()
+            elif kind == LINE_ERROR:
+                self._logError(line)
+            elif kind == LINE_RESEND:
+                toresend = line.resend
+                if toresend is not None and \
+                   (self.window is None or self.window.resend(toresend)):
+                    self.resendfrom = toresend
+                if resend_ok is False:
+                    self.clear = True
+                resend_requested = True
+                self._wake()
+        if self.window is not None:
+            self.window.reset()
+        self.clear = True
+        self._wake()
+
+    # ------------------------------------------------------------------------
+    # Sending
+    # ------------------------------------------------------------------------
+    def _windowed(self):
+        return (self.window is not None and self.printing and
+                (not self.printer.has_flow_control or
+                 not self.tcp_streaming_mode))
+
+    def _ready(self, nbytes = 1):
+        # Whether the sender has something to do
+        if not self.printer:
+            return False
+        if not self.printing:
+            return bool(self.priqueue)
+        if self._windowed():
+            return self.window.has_room(nbytes)
+        return self.clear
+
+    async def _wait(self):
+        self._wakeup.clear()
+        await self._wakeup.wait()
+
+    async def _sender(self):
+        while True:
+            while not self._ready():
+                await self._wait()
+            if self.printing:
+                await self._sendnext()
+            else:
+                command, future = self.priqueue.popleft()
+                await self._send(command)
+                if future is not None and not future.done():
+                    future.set_result(None)
+            # Sending never suspends while the printer keeps up, e.g. in
+            # TCP streaming mode: let the other tasks run between lines
+            await asyncio.sleep(0)
+
+    async def _has_index(self, i):
+        gcode = self.mainqueue
+        if gcode is None:
+            return False
+        if i < len(gcode) or not gcode.loading:
+            return gcode.has_index(i)
+        # Still loading in another thread
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, gcode.has_index, i)
+
+    async def _sendnext(self):
+        if not self.printer.has_flow_control or not self.tcp_streaming_mode:
+            self.clear = False
+        if self.resendfrom < self.lineno and self.resendfrom > -1:
+            if self.resendfrom not in self.sentlines:
+                self._logError(_("Printer requested line %d again but it is "
+                                 "no longer kept, pausing print.")
+                               % self.resendfrom)
+                self.resendfrom = -1
+                self.pause()
+                self.clear = True
+                return
+            await self._send(self.sentlines[self.resendfrom], self.resendfrom,
+                             False)
+            self.resendfrom += 1
+            return
+        self.resendfrom = -1
+        if self.priqueue:
+            command, future = self.priqueue.popleft()
+            await self._send(command)
+            if future is not None and not future.done():
+                future.set_result(None)
+            return
+        mainqueue = self.mainqueue
+        if self.printing and await self._has_index(self.queueindex):
+            (layer, line) = mainqueue.idxs(self.queueindex)
+            gline = mainqueue.all_layers[layer][line]
+            if self.queueindex > 0:
+                (prev_layer, prev_line) = mainqueue.idxs(self.queueindex - 1)
+                if prev_layer != layer:
+                    self._callback('layerchange', layer)
+            if await self._has_index(self.queueindex + 1):
+                (next_layer, next_line) = mainqueue.idxs(self.queueindex + 1)
+                next_gline = mainqueue.all_layers[next_layer][next_line]
+            else:
+                next_gline = None
+            gline = self._callback('printpresend', gline, next_gline,
+                                   self.queueindex)
+            if gline is None:
+                self.queueindex += 1
+                self.clear = True
+                return
+            tline = gline.raw
+            if tline.lstrip().startswith(";@"):  # check for host command
+                self._callback('hostcommand', tline)
+                self.queueindex += 1
+                self.clear = True
+                return
+            tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
+            if tline:
+                await self._send(tline, self.lineno, True, gline)
+                self.lineno += 1
+                self._callback('printsend', gline)
+            else:
+                self.clear = True
+            self.queueindex += 1
+        elif self._windowed() and len(self.window):
+            # Lines in flight may still be requested again
+            await self._wait()
+            self.clear = True
+        elif self.printing:
+            self.printing = False
+            self.clear = True
+            self.queueindex = 0
+            self.lineno = 0
+            await self._send("M110 N-1", -1, True)
+            self.sentlines.clear()
+            self._callback('end')
+
+    def _checksum(self, command):
+        return reduce(lambda x, y: x ^ y, map(ord, command))
+
+    async def _send(self, command, lineno = 0, calcchecksum = False,
+                    gline = None):
+        if not self.printer:
+            return
+        # `gline` is given with print lines, already parsed when loaded
+        # Only add checksums if over serial (tcp does the flow control itself)
+        if calcchecksum and not self.printer.has_flow_control:
+            prefix = "N" + str(lineno) + " " + command
+            command = prefix + "*" + str(self._checksum(prefix))
+            if "M110" not in command:
+                self.sentlines[lineno] = command
+        try:
+            if gline is not None:
+                gline = self.analyzer.advance(gline)
+            else:
+                gline = self.analyzer.append(command, store = False)
+        except:
+            gline = None
+            logging.warning(_("Could not analyze command %s:") % command +
+                            "\n" + traceback.format_exc())
+        if self.loud:
+            logging.info("SENT: %s" % command)
+        self._callback('send', command, gline)
+        data = (command + "\n").encode('ascii')
+        if self._windowed():
+            # Wait for the line to fit in the firmware receive buffer
+            while (self.printer and self._windowed() and
+                   not self.window.has_room(len(data))):
+                await self._wait()
+            if self.window is not None:
+                numbered = calcchecksum or command.startswith("N")
+                self.window.sent(len(data), lineno if numbered else None)
+        try:
+            self.printer.write(data)
+            self.writefailures = 0
+        except device.DeviceError as e:
+            self._logError("Can't write to printer (disconnected?)"
+                           " {0}".format(e))
+            self.writefailures += 1
+            return
+        # Writes are buffered by the transport, keep it below its limit
+        await self.printer.drain()
+
+    def _callback(self, name, *args):
+        # See printcore._callback, without the deprecated callbacks
+        for handler in self.event_handler:
+            try: event = getattr(handler, f"on_{name}")
+            except AttributeError: continue
+            try:
+                event(*args)
+            except Exception:
+                logging.error(f"'on_{name}' handler failed with:\n"
+                              f"{traceback.format_exc()}")
+        if self._subscribers:
+            record = PrinterEvent(name, args)
+            for queue in self._subscribers:
+                queue.put_nowait(record)
+        try: callback = getattr(self.callback, name)
+        except AttributeError: return None
+        try:
+            return callback(*args)
+        except Exception:
+            logging.error(f"'{name}' callback failed with:\n"
+                          f"{traceback.format_exc()}")
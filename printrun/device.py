@@ -75,7 +75,7 @@ class Device():
         self._hostname = None
         self._socketfile = None
         self._port_number = None
-        self._read_buffer = []
+        self._read_buffer = LineBuffer()
         self._selector = None
         self._timeout = 0.25
         self._type = None
@@ -108,6 +108,7 @@ class Device():
 
         if self.port is not None:
             self._parse_type()
+            self._read_buffer.clear()
             getattr(self, "_connect_" + self._type)()
         else:
             raise DeviceError("No port or URL specified")
@@ -265,9 +266,17 @@ class Device():
             raise DeviceError(msg, e) from e
 
     def _readline_serial(self):
+        buffer = self._read_buffer
         try:
-            # Serial.readline() returns b'' (aka `READ_EMPTY`) on timeout
-            return self._device.readline()
+            line = buffer.readline()
+            while not line:
+                # Wait for one byte, then take all the bytes received
+                size = max(1, self._device.in_waiting)
+                if not buffer.fill(self._device.readinto, size):
+                    # Timeout, a partial line is kept for the next call
+                    return READ_EMPTY
+                line = buffer.readline()
+            return line
         except (serial.SerialException, OSError) as e:
             msg = f"Unable to read from serial port '{self.port}'"
             raise DeviceError(msg, e) from e
@@ -334,50 +343,31 @@ class Device():
 
     def _readline_socket(self):
         SYS_AGAIN = None  # python's marker for timeout/no data
-        # SYS_EOF = b''   # python's marker for EOF
+        SYS_EOF = 0  # python's marker for EOF
+        buffer = self._read_buffer
         try:
-            line = self._readline_buf()
-            if line:
-                return line
-            chunk_size = 256
-            while True:
-                chunk = self._socketfile.read(chunk_size)
-                if (chunk is SYS_AGAIN and
+            line = buffer.readline()
+            while not line:
+                read = buffer.fill(self._socketfile.readinto)
+                if (read is SYS_AGAIN and
                         self._selector.select(self._timeout)):
-                    chunk = self._socketfile.read(chunk_size)
-                if chunk:
-                    self._read_buffer.append(chunk)
-                    line = self._readline_buf()
-                    if line:
-                        return line
-                elif chunk is SYS_AGAIN:
+                    read = buffer.fill(self._socketfile.readinto)
+                if read is SYS_AGAIN:
                     return READ_EMPTY
-                else:  # chunk is SYS_EOF
-                    line = b''.join(self._read_buffer)
-                    self._read_buffer = []
+                if read == SYS_EOF:
+                    line = buffer.flush()
                     if line:
                         return line
                     self._is_connected = False
                     return READ_EOF
+                line = buffer.readline()
+            return line
         except OSError as e:
             self._is_connected = False
             msg = ("Unable to read from {}:{}. Connection lost"
                    ).format(self._hostname, self._port_number)
             raise DeviceError(msg, e) from e
 
-    def _readline_buf(self):
-        # Try to readline from buffer
-        if self._read_buffer:
-            chunk = self._read_buffer[-1]
-            eol = chunk.find(b'\n')
-            if eol >= 0:
-                line = b''.join(self._read_buffer[:-1]) + chunk[:(eol+1)]
-                self._read_buffer = []
-                if eol + 1 < len(chunk):
-                    self._read_buffer.append(chunk[(eol+1):])
-                return line
-        return READ_EMPTY
-
     def _write_socket(self, data):
         try:
             self._socketfile.write(data)
@@ -392,6 +382,97 @@ class Device():
             raise DeviceError(msg, e) from e
 
 
+class LineBuffer():
+    """Split the bytes read from a device into lines.
+
+    Data is read straight into a preallocated `bytearray`, in which lines
+    are looked for with `find`. Only the returned lines are copied, and the
+    start of an incomplete line is moved to the front of the buffer when
+    little room is left. The buffer grows for lines longer than it.
+
+    Parameters
+    ----------
+    size : int, optional
+        Initial size of the buffer in bytes. (Default is 4096)
+
+    """
+
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        # Unread data is in [_start, _end), without '\n' before _scanned
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        """Drop the data not read yet."""
+        self._start = self._end = self._scanned = 0
+
+    def readline(self) -> bytes:
+        """Next complete line including its end of line, or `READ_EMPTY`."""
+        eol = self._buffer.find(b'\n', self._scanned, self._end)
+        if eol < 0:
+            self._scanned = self._end
+            return READ_EMPTY
+        line = bytes(self._view[self._start:eol + 1])
+        self._start = self._scanned = eol + 1
+        if self._start == self._end:
+            self.clear()
+        return line
+
+    def flush(self) -> bytes:
+        """All the data not read yet, even without an end of line."""
+        data = bytes(self._view[self._start:self._end])
+        self.clear()
+        return data
+
+    def fill(self, readinto, size=None):
+        """Read more data with a `readinto` function.
+
+        Parameters
+        ----------
+        readinto : callable
+            Function filling the writable buffer it is given, returning the
+            number of bytes read, such as `socket.SocketIO.readinto`.
+        size : int, optional
+            Maximum number of bytes to read, as much as fits by default.
+
+        Returns
+        -------
+        int or None
+            The value returned by `readinto`.
+
+        """
+        capacity = len(self._buffer)
+        if self._start and capacity - self._end < capacity // 4:
+            # Move the incomplete line to the front
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start:self._end]
+            self._scanned -= self._start
+            self._start = 0
+            self._end = pending
+        if self._end == capacity:
+            # A single line fills the buffer
+            self._view.release()
+            self._buffer.extend(bytes(capacity))
+            self._view = memoryview(self._buffer)
+            capacity *= 2
+        stop = capacity if size is None else min(capacity, self._end + size)
+        target = self._view[self._end:stop]
+        try:
+            read = readinto(target)
+        finally:
+            # Callers may keep a reference, which would prevent growing
+            target.release()
+        if read:
+            self._end += read
+        return read
+
+
 class DeviceError(Exception):
     """Raised on any connection error.
 
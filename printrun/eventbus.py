@@ -0,0 +1,229 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Delivery of printer events away from the communication threads.
+
+`PrinterEventHandler` objects added to a printcore are called from its
+read and print threads, so a slow handler delays the communication with
+the printer. Subscribers of an `EventBus` are called from a dispatcher
+thread instead: publishing an event only appends a record to a deque
+(which needs no lock) and wakes the dispatcher up if it is waiting.
+"""
+
+import logging
+import threading
+import time
+import traceback
+from collections import deque, namedtuple
+
+from printrun.eventhandler import PrinterEventHandler
+
+PrinterEvent = namedtuple("PrinterEvent", ("name", "args"))
+PrinterEvent.__doc__ = """Record of a printer event.
+
+`name` is the name of a `printrun.eventhandler.PrinterEventHandler` method
+without its "on_" prefix, `args` the tuple of its arguments."""
+
+# Events of which only the latest one of each batch is delivered by default
+COALESCED = ("temp", "position")
+
+class EventBus():
+    """Delivers published events to subscribers from a dispatcher thread.
+
+    Events are delivered in batches, in the order they were published: the
+    dispatcher waits `batch_interval` once woken up, so that the events
+    published meanwhile are handled at once.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Maximum number of events waiting for the dispatcher. Once reached,
+        the oldest events are dropped.
+    batch_interval : float, optional
+        Seconds during which events are gathered before being delivered.
+    coalesce : iterable of str, optional
+        Names of the events of which only the latest one of each batch is
+        delivered, such as temperature reports, which supersede the
+        previous ones.
+
+    Attributes
+    ----------
+    dropped : int
+        Number of events dropped because the dispatcher fell behind.
+
+    """
+
+    def __init__(self, capacity = 65536, batch_interval = 0.01,
+                 coalesce = COALESCED):
+        self.capacity = capacity
+        self.batch_interval = batch_interval
+        self.coalesce = frozenset(coalesce)
+        self.dropped = 0
+        self._queue = deque(maxlen = capacity)
+        # Replaced rather than modified, so that it can be read without lock
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def wants(self, name):
+        """Whether `name` events have subscribers, so that publishers can
+        skip building them"""
+        return name in self._subscribers
+
+    def publish(self, name, args = ()):
+        """Queue an event for its subscribers, never blocks"""
+        queue = self._queue
+        if len(queue) == self.capacity:
+            self.dropped += 1
+        queue.append(PrinterEvent(name, args))
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def subscribe(self, name, callback, batch = False):
+        """Call `callback(*args)` on each `name` event.
+
+        With `batch`, `callback` is called once per batch instead, with the
+        list of `PrinterEvent` records of the batch as only argument.
+
+        """
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            subscribers[name] = subscribers.get(name, ()) + ((callback, batch),)
+            self._subscribers = subscribers
+        self.start()
+
+    def start(self):
+        """Start the dispatcher thread, if there are subscribers and it is
+        not running.
+
+        Done by `subscribe`, and needed again to resume the delivery of
+        events after `close`.
+
+        """
+        with self._lock:
+            if self._thread is None and self._subscribers:
+                self._thread = threading.Thread(target = self._dispatch,
+                                                name = 'event dispatcher',
+                                                daemon = True)
+                self._thread.start()
+
+    def unsubscribe(self, name, callback):
+        with self._lock:
+            subscribers = dict(self._subscribers)
+            remaining = tuple(s for s in subscribers.get(name, ())
+                              if s[0] != callback)
+            if remaining:
+                subscribers[name] = remaining
+            else:
+                subscribers.pop(name, None)
+            self._subscribers = subscribers
+
+    def add_handler(self, handler):
+        """Subscribe the event methods a `PrinterEventHandler` overrides"""
+        for name, method in self._handler_methods(handler):
+            self.subscribe(name, method)
+
+    def remove_handler(self, handler):
+        for name, method in self._handler_methods(handler):
+            self.unsubscribe(name, method)
+
+    @staticmethod
+    def _handler_methods(handler):
+        for attr in dir(handler):
+            if attr.startswith("on_") and getattr(type(handler), attr, None) \
+               is not getattr(PrinterEventHandler, attr, None):
+                yield attr[3:], getattr(handler, attr)
+
+    def flush(self, timeout = None):
+        """Wait until the events published so far are delivered.
+
+        Returns False on timeout. Must not be called by subscribers.
+
+        """
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self.publish(None, (done,))
+        return done.wait(timeout)
+
+    def close(self):
+        """Deliver the pending events and stop the dispatcher thread.
+
+        Subscribers are kept, events published afterwards wait for `start`.
+        When called by a subscriber, the dispatcher stops once the current
+        batch is delivered.
+
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._wakeup.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def _dispatch(self):
+        queue = self._queue
+        current = threading.current_thread()
+        running = True
+        while running:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # Stopped by `close`, possibly already replaced by `start`
+            running = self._thread is current
+            if self.batch_interval:
+                time.sleep(self.batch_interval)
+            events = []
+            try:
+                while True:
+                    events.append(queue.popleft())
+            except IndexError:
+                pass
+            self._deliver(events)
+
+    def _deliver(self, events):
+        coalesce = self.coalesce
+        if coalesce:
+            latest = {}
+            for i, event in enumerate(events):
+                if event.name in coalesce:
+                    latest[event.name] = i
+            if latest:
+                events = [event for i, event in enumerate(events)
+                          if latest.get(event.name, i) == i]
+        subscribers = self._subscribers
+        batches = {}
+        flushed = []
+        for event in events:
+            if event.name is None:
+                flushed.append(event.args[0])
+                continue
+            for callback, batch in subscribers.get(event.name, ()):
+                if batch:
+                    batches.setdefault(callback, []).append(event)
+                else:
+                    self._call(callback, event.name, event.args)
+        for callback, batch_events in batches.items():
+            self._call(callback, "batch", (batch_events,))
+        for done in flushed:
+            done.set()
+
+    @staticmethod
+    def _call(callback, name, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.error(f"'{name}' event subscriber failed with:\n"
+                          f"{traceback.format_exc()}")
@@ -28,6 +28,10 @@ class PrinterEventHandler:
     `printrun.printcore.Callback`. Same logic applies to all other methods
     but for `on_init`, `on_connect` and `on_disconnect`. See below.
 
+    Handlers are called from the printcore threads. Slow ones can be given
+    to `printrun.eventbus.EventBus.add_handler` instead, to be called from
+    a dispatcher thread.
+
     """
     def __init__(self):
         """Event-handler constructor."""
@@ -60,6 +64,9 @@ class PrinterEventHandler:
     def on_temp(self, line):
         pass
 
+    def on_position(self, line):
+        pass
+
     def on_start(self, resume):
         pass
 
@@ -0,0 +1,437 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless host driving many printers from one event loop.
+
+A `Farm` owns one `printrun.asyncprintcore.AsyncPrintcore` per printer and
+prints queued jobs on the printers as they get idle. Each G-code file is
+parsed once, the same `printrun.gcoder.LightGCode` being printed by all the
+printers running it.
+"""
+
+# Standard libraries:
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sys
+from collections import deque
+
+# Custom libraries:
+from printrun import gcoder
+from printrun.asyncprintcore import AsyncPrintcore
+from printrun.eventhandler import PrinterEventHandler
+from printrun.utils import install_locale, parse_temperature_report, \
+    setup_logging
+install_locale('pronterface')
+
+# States of the printers, see `FarmPrinter.state`
+OFFLINE = 'offline'
+IDLE = 'idle'
+PRINTING = 'printing'
+PAUSED = 'paused'
+
+# Port ranges of network printers, such as localhost:8080-8109
+port_range_exp = re.compile(r"^(.+):(\d+)-(\d+)$")
+
+
+class Job():
+    """A G-code file to print one or more times.
+
+    Attributes
+    ----------
+    name : str
+    gcode : LightGCode
+        The parsed file, shared by all the printers printing the job.
+    copies : int
+        Number of prints to make.
+    started, finished, failed : int
+        Prints started, finished and cancelled so far.
+
+    """
+
+    def __init__(self, name, gcode, copies = 1):
+        self.name = name
+        self.gcode = gcode
+        self.copies = copies
+        self.started = 0
+        self.finished = 0
+        self.failed = 0
+
+    @property
+    def remaining(self):
+        """Number of prints left to start"""
+        return self.copies - self.started
+
+    @property
+    def done(self):
+        """True once all the prints are over"""
+        return self.finished + self.failed >= self.copies
+
+    def status(self):
+        return {"name": self.name,
+                "lines": len(self.gcode),
+                "copies": self.copies,
+                "started": self.started,
+                "finished": self.finished,
+                "failed": self.failed,
+                }
+
+
+class FarmPrinter(PrinterEventHandler):
+    """A printer of a `Farm`, following the events of its printcore.
+
+    Attributes
+    ----------
+    name : str
+    port : str
+    core : AsyncPrintcore
+    job : Job
+        The job being printed, None when idle.
+    layer : int
+        Index of the layer being printed.
+    error : str
+        Last error reported by the printcore, if any.
+
+    """
+
+    def __init__(self, farm, name, port, core):
+        super().__init__()
+        self.farm = farm
+        self.name = name
+        self.port = port
+        self.core = core
+        self.job = None
+        self.layer = 0
+        self.error = None
+        self._tempreport = None
+        self._temps = None
+        core.addEventHandler(self)
+
+    @property
+    def state(self):
+        """One of `OFFLINE`, `IDLE`, `PRINTING` and `PAUSED`"""
+        if not self.core.online:
+            return OFFLINE
+        if self.core.printing:
+            return PRINTING
+        if self.core.paused:
+            return PAUSED
+        return IDLE
+
+    @property
+    def idle(self):
+        return self.job is None and self.state == IDLE
+
+    @property
+    def progress(self):
+        """Percentage of the job lines sent, None when idle"""
+        if self.job is None or not len(self.job.gcode):
+            return None
+        return 100 * self.core.queueindex / len(self.job.gcode)
+
+    @property
+    def temps(self):
+        """Last temperatures reported, see `parse_temperature_report`"""
+        report = self._tempreport
+        if report is None:
+            return None
+        # Only parsed when asked for, and once per report
+        if self._temps is None or self._temps[0] is not report:
+            self._temps = (report, parse_temperature_report(report))
+        return self._temps[1]
+
+    def status(self):
+        return {"port": self.port,
+                "state": self.state,
+                "job": self.job.name if self.job is not None else None,
+                "progress": self.progress,
+                "layer": self.layer,
+                "temps": self.temps,
+                "error": self.error,
+                }
+
+    def on_online(self):
+        self.farm.schedule_soon()
+
+    def on_temp(self, line):
+        self._tempreport = line
+
+    def on_layerchange(self, layer):
+        self.layer = layer
+
+    def on_error(self, error):
+        self.error = error
+
+    def on_end(self):
+        # Also called when pausing
+        if self.core.paused or self.job is None:
+            return
+        self.job.finished += 1
+        logging.info(_("%s finished printing %s") % (self.name, self.job.name))
+        self.job = None
+        self.layer = 0
+        self.farm.schedule_soon()
+
+
+class Farm():
+    """Host for many printers sharing a queue of jobs.
+
+    All the printers are driven from the running event loop. Jobs are
+    started on printers as soon as they are online and idle, in the order
+    they were submitted.
+
+    Parameters
+    ----------
+    baud : int, optional
+        Default communication speed of the printers.
+    window_size : int, optional
+        Send window of the printers, see `printrun.printcore.printcore`.
+
+    Attributes
+    ----------
+    printers : dict
+        The `FarmPrinter` objects by name.
+    jobs : deque of Job
+        The jobs not done yet, in submission order.
+
+    """
+
+    def __init__(self, baud = 115200, window_size = 1):
+        self.baud = baud
+        self.window_size = window_size
+        self.printers = {}
+        self.jobs = deque()
+        self._gcodes = {}
+        self._tasks = set()
+        # Created within the event loop, see `join`
+        self._changed = None
+
+    async def add_printer(self, name, port, baud = None):
+        """Connect to a printer and add it to the farm.
+
+        Returns the `FarmPrinter`, which gets jobs once online.
+
+        """
+        if name in self.printers:
+            raise ValueError(_("Printer %s already exists") % name)
+        core = AsyncPrintcore()
+        printer = FarmPrinter(self, name, port, core)
+        self.printers[name] = printer
+        await core.connect(port, baud or self.baud,
+                           window_size = self.window_size)
+        return printer
+
+    async def remove_printer(self, name):
+        """Disconnect a printer, its print is counted as failed"""
+        printer = self.printers.pop(name)
+        if printer.job is not None:
+            printer.job.failed += 1
+            printer.job = None
+        await printer.core.disconnect()
+        self._notify()
+
+    async def load(self, path):
+        """Parse a G-code file, or return the copy parsed already"""
+        path = os.path.realpath(path)
+        future = self._gcodes.get(path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(None, self._parse, path)
+            self._gcodes[path] = future
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            self._gcodes.pop(path, None)
+            raise
+
+    def _parse(self, path):
+        gcode = gcoder.LightGCode(deferred = True)
+        with open(path, "r", encoding = "utf-8") as f:
+            gcode.prepare(f)
+        gcode.estimate_duration()
+        return gcode
+
+    def forget(self, path):
+        """Drop a parsed file, later jobs parse it again"""
+        self._gcodes.pop(os.path.realpath(path), None)
+
+    async def submit(self, path, copies = 1, name = None):
+        """Queue a job printing a G-code file `copies` times"""
+        gcode = await self.load(path)
+        job = Job(name or os.path.basename(path), gcode, copies)
+        self.jobs.append(job)
+        self.schedule_soon()
+        return job
+
+    def schedule_soon(self):
+        """Start queued jobs on idle printers from a new task"""
+        task = asyncio.ensure_future(self.schedule())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def schedule(self):
+        """Start queued jobs on the idle printers"""
+        for printer in list(self.printers.values()):
+            job = next((job for job in self.jobs if job.remaining > 0), None)
+            if job is None:
+                break
+            if not printer.idle:
+                continue
+            # Taken before yielding to the event loop
+            printer.job = job
+            job.started += 1
+            printer.error = None
+            if await printer.core.startprint(job.gcode):
+                logging.info(_("%s started printing %s")
+                             % (printer.name, job.name))
+            else:
+                printer.job = None
+                job.started -= 1
+        self._notify()
+
+    def _notify(self):
+        while self.jobs and self.jobs[0].done:
+            self.jobs.popleft()
+        if self._changed is not None:
+            self._changed.set()
+
+    def pause(self, name):
+        """Pause the print of a printer"""
+        return self.printers[name].core.pause()
+
+    async def resume(self, name):
+        """Resume the paused print of a printer"""
+        return await self.printers[name].core.resume()
+
+    def cancel(self, name):
+        """Cancel the print of a printer, which is counted as failed"""
+        printer = self.printers[name]
+        if printer.job is None:
+            return False
+        printer.core.cancelprint()
+        printer.job.failed += 1
+        printer.job = None
+        printer.layer = 0
+        self.schedule_soon()
+        return True
+
+    async def send_now(self, name, command):
+        """Send a command ahead of the print of a printer"""
+        await self.printers[name].core.send_now(command)
+
+    @property
+    def busy(self):
+        """True while jobs are queued or printing"""
+        return bool(self.jobs) or any(printer.job is not None
+                                      for printer in self.printers.values())
+
+    async def join(self):
+        """Wait until all the jobs are done"""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        while self.busy:
+            self._changed.clear()
+            await self._changed.wait()
+
+    def status(self):
+        """Aggregate status of the printers and jobs"""
+        printers = {name: printer.status()
+                    for name, printer in self.printers.items()}
+        states = dict.fromkeys((OFFLINE, IDLE, PRINTING, PAUSED), 0)
+        for status in printers.values():
+            states[status["state"]] += 1
+        return {"printers": printers,
+                "states": states,
+                "jobs": [job.status() for job in self.jobs],
+                "queued": sum(job.remaining for job in self.jobs),
+                }
+
+    async def close(self):
+        """Disconnect all the printers"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*(printer.core.disconnect()
+                               for printer in self.printers.values()))
+
+
+def expand_ports(specs):
+    """Parse [NAME=]PORT printer arguments into (name, port) tuples.
+
+    Network ports may be ranges, such as localhost:8080-8109.
+
+    """
+    printers = []
+    for spec in specs:
+        name, sep, port = spec.rpartition("=")
+        match = port_range_exp.match(port)
+        if match is None:
+            printers.append((name or port, port))
+            continue
+        host, first, last = match.group(1), int(match.group(2)), \
+            int(match.group(3))
+        for number in range(first, last + 1):
+            port = "%s:%d" % (host, number)
+            printers.append(("%s%d" % (name, number - first) if name
+                             else port, port))
+    return printers
+
+
+async def run(args):
+    farm = Farm(args.baud, args.window_size)
+    try:
+        for name, port in expand_ports(args.printer):
+            await farm.add_printer(name, port)
+        for filename in args.files:
+            await farm.submit(filename, args.copies)
+        done = asyncio.ensure_future(farm.join())
+        while not done.done():
+            await asyncio.wait([done], timeout = args.status_interval)
+            status = farm.status()
+            logging.info(_("Printers: %(printing)d printing, %(idle)d idle, "
+                           "%(paused)d paused, %(offline)d offline")
+                         % status["states"] +
+                         _(" | Prints queued: %d") % status["queued"])
+    finally:
+        await farm.close()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        description = _("Print G-code files on a farm of printers"))
+    parser.add_argument("files", nargs = "*", metavar = "FILE",
+                        help = _("G-code files to print"))
+    parser.add_argument("-p", "--printer", action = "append", default = [],
+                        metavar = "[NAME=]PORT",
+                        help = _("printer port, network ports may be ranges "
+                                 "such as localhost:8080-8109"))
+    parser.add_argument("-b", "--baud", type = int, default = 115200)
+    parser.add_argument("-w", "--window-size", type = int, default = 1,
+                        help = _("lines sent ahead of acknowledgements"))
+    parser.add_argument("-c", "--copies", type = int, default = 1,
+                        help = _("prints of each file"))
+    parser.add_argument("-s", "--status-interval", type = float,
+                        default = 10, help = _("seconds between status "
+                                               "reports"))
+    args = parser.parse_args(argv)
+    if not args.printer:
+        parser.error(_("no printer given"))
+    setup_logging(sys.stdout, reset_handlers = True)
+    try:
+        asyncio.run(run(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
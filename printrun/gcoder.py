@@ -15,12 +15,19 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
 import sys
 import re
 import math
+import mmap
+import operator
+import os
+import time
 import datetime
 import logging
+import threading
 from array import array
+from bisect import bisect_right
 
 gcode_parsed_args = ["x", "y", "e", "f", "z", "i", "j"]
 gcode_parsed_nonargs = 'gtmnd'
@@ -65,9 +72,14 @@ except Exception as e:
     Line = PyLine
     LightLine = PyLightLine
 
+# Compiled patterns of find_specific_code, by code
+specific_exps = {}
+
 def find_specific_code(line, code):
-    exp = specific_exp % code
-    bits = [bit for bit in re.findall(exp, line.raw) if bit]
+    exp = specific_exps.get(code)
+    if exp is None:
+        exp = specific_exps[code] = re.compile(specific_exp % code)
+    bits = [bit for bit in exp.findall(line.raw) if bit]
     if not bits: return None
     else: return float(bits[0][1:])
 
@@ -101,6 +113,53 @@ def parse_coordinates(line, split_raw, imperial = False, force = False):
         if code not in gcode_parsed_nonargs and bit[1]:
             setattr(line, code, unit_factor * float(bit[1]))
 
+def py_parse_line(line, imperial = False):
+    """Set command, is_move and coordinates of `line`
+
+    Same as `split` followed by `parse_coordinates`, taking into account
+    that a G20/G21 command applies to its own coordinates. The compiled
+    `gcoder_line.parse_line` does this in a single scan of the line.
+    """
+    split_raw = split(line)
+    if line.command == "G20":
+        imperial = True
+    elif line.command == "G21":
+        imperial = False
+    if line.command:
+        parse_coordinates(line, split_raw, imperial)
+
+parse_line = py_parse_line
+if Line is not PyLine:
+    try:
+        parse_line = gcoder_line.parse_line
+    except AttributeError as e:
+        # Module built from an older version
+        logging.warning("Compiled G-code tokenizer unavailable: %s" % e)
+
+def _data_size(data):
+    """Size of `data` in bytes if it is known before reading it"""
+    try:
+        return os.fstat(data.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        pass
+    if isinstance(data, (list, tuple)):
+        return sum(len(l) for l in data)
+    return None
+
+# Smallest number of lines worth parsing in a process of its own
+MIN_LINES_PER_WORKER = 100000
+
+def _parallel_workers(count, workers):
+    """Number of processes, at most `workers`, worth parsing `count` lines
+    with: starting them only pays off with large files and idle CPUs"""
+    if not workers or workers < 2:
+        return 1
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    return max(1, min(workers, cpus, count // MIN_LINES_PER_WORKER))
+
 class Layer(list):
 
     __slots__ = ("duration", "z")
@@ -110,15 +169,90 @@ class Layer(list):
         self.z = z
         self.duration = 0
 
+class LayerIndex:
+    """Position of the lines of `GCode.all_layers` in the whole file
+
+    Only the index of the first line of each layer is stored, so that
+    lines can be added to or removed from a layer by shifting the start
+    of the following layers, and line `i` is found by bisection.
+    """
+
+    __slots__ = ("starts", "count")
+
+    def __init__(self):
+        self.starts = array('Q')
+        self.count = 0
+
+    @classmethod
+    def from_counts(cls, counts):
+        """Index of layers holding `counts` lines each"""
+        index = cls()
+        for layer_id, count in enumerate(counts):
+            index.add(layer_id, count)
+        return index
+
+    def __len__(self):
+        return self.count
+
+    def add(self, layer_id, count = 1):
+        """Record `count` more lines at the end of the last layer,
+        `layer_id`, or of a new one"""
+        starts = self.starts
+        while len(starts) <= layer_id:
+            starts.append(self.count)
+        self.count += count
+
+    def resize(self, layer_id, delta):
+        """Record `delta` more (or less) lines in layer `layer_id`"""
+        starts = self.starts
+        for i in range(layer_id + 1, len(starts)):
+            starts[i] += delta
+        self.count += delta
+
+    def start(self, layer_id):
+        return self.starts[layer_id]
+
+    def idxs(self, i):
+        """Layer of line `i` and its index in that layer"""
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("line index out of range")
+        starts = self.starts
+        layer_id = bisect_right(starts, i) - 1
+        return layer_id, i - starts[layer_id]
+
+    def layer_idxs(self):
+        """Layer of each line, as an array"""
+        idxs = array('I')
+        for layer_id, count in enumerate(self.counts()):
+            idxs.extend(array('I', [layer_id]) * count)
+        return idxs
+
+    def line_idxs(self):
+        """Index of each line in its layer, as an array"""
+        idxs = array('I')
+        for count in self.counts():
+            idxs.extend(range(count))
+        return idxs
+
+    def counts(self):
+        """Number of lines of each layer"""
+        starts = self.starts
+        ends = starts[1:]
+        ends.append(self.count)
+        return [end - start for start, end in zip(starts, ends)]
+
 class GCode:
 
     line_class = Line
+    # Whether prepend_to_layer and rewrite_layer can be used
+    editable = True
 
     lines = None
     layers = None
     all_layers = None
-    layer_idxs = None
-    line_idxs = None
+    layer_index = None
     append_layer = None
     append_layer_id = None
 
@@ -176,6 +310,12 @@ class GCode:
 
     est_layer_height = None
 
+    # Loading progress, see prepare_iter
+    loading = False
+    cancelled = False
+    bytes_processed = 0
+    bytes_total = None
+
     # abs_x is the current absolute X in machine current coordinate system
     # (after the various G92 transformations) and can be used to store the
     # absolute position of the head at a given time
@@ -221,95 +361,217 @@ class GCode:
 
     def __init__(self, data = None, home_pos = None,
                  layer_callback = None, deferred = False,
-                 cutting_as_extrusion = False):
+                 cutting_as_extrusion = False, columnar = False):
         self.cutting_as_extrusion = cutting_as_extrusion
+        self.columnar = columnar
+        # Per tool lists are updated in place, they must not be shared
+        # between instances
+        self.current_e_multi = [0]
+        self.offset_e_multi = [0]
+        self.total_e_multi = [0]
+        self.max_e_multi = [0]
+        self.filament_length_multi = [0]
         if not deferred:
             self.prepare(data, home_pos, layer_callback)
 
-    def prepare(self, data = None, home_pos = None, layer_callback = None):
+    def prepare(self, data = None, home_pos = None, layer_callback = None,
+                workers = None):
+        """Load and analyze G-code lines
+
+        Parameters
+        ----------
+        data : iterable of str, optional
+            G-code lines, for instance an open file.
+        home_pos : tuple, optional
+            Home position, as (x, y, z).
+        layer_callback : callable, optional
+            Called as `layer_callback(gcode, layer_id)` once each layer is
+            complete.
+        workers : int, optional
+            Maximum number of processes parsing the lines. Using several
+            ones implies the columnar backend, whatever `columnar`, and
+            reading the whole file first. Fewer processes are used if
+            there are fewer CPUs or lines to share (see
+            `MIN_LINES_PER_WORKER`), and with a single one the file is
+            parsed as without `workers`.
+        """
+        for _ in self.prepare_iter(data, home_pos, layer_callback, workers):
+            pass
+
+    def prepare_iter(self, data = None, home_pos = None, layer_callback = None,
+                     workers = None):
+        """Load and analyze G-code lines, one layer at a time
+
+        Same as `prepare`, as a generator. Lines are read from `data` only
+        as needed to complete the next layer, so the layers already yielded
+        (and `len(self)` lines) can be used, for instance printed, while the
+        rest of the file is being analyzed. `bytes_processed` and
+        `bytes_total` tell how far the analysis went, and `cancel` stops it.
+
+        The columnar backend, also used when parsing with several
+        `workers`, analyzes the whole file before the first layer is
+        yielded, and stores the lines in `PackedLines` columns whatever
+        `line_class`.
+
+        Yields
+        ------
+        int
+            Index of each complete layer in `all_layers`, in order.
+        """
         self.home_pos = home_pos
+        self.cancelled = False
+        self.bytes_processed = 0
+        self.bytes_total = _data_size(data)
         if data:
-            line_class = self.line_class
-            self.lines = [line_class(l2) for l2 in
-                          (l.strip() for l in data)
-                          if l2]
-            self._preprocess(build_layers = True,
-                             layer_callback = layer_callback)
+            if (workers or 1) > 1:
+                data = data if isinstance(data, list) else list(data)
+                workers = _parallel_workers(len(data), workers)
+            if (self.columnar or (workers or 1) > 1) \
+               and self._prepare_columnar(data, layer_callback, workers):
+                self.bytes_processed = self.bytes_total or 0
+                yield from range(self.append_layer_id)
+                return
+            self.lines = self._new_lines()
+            yield from self._stream(self._read(data), layer_callback)
         else:
-            self.lines = []
+            self.lines = self._new_lines()
             self.append_layer_id = 0
             self.append_layer = Layer([])
             self.all_layers = [self.append_layer]
             self.all_zs = set()
             self.layers = {}
-            self.layer_idxs = array('I', [])
-            self.line_idxs = array('I', [])
+            self.layer_index = LayerIndex()
+
+    def _new_lines(self):
+        return []
+
+    def cancel(self):
+        """Stop loading at the next line
+
+        The lines already read are analyzed as if the file ended there and
+        `prepare` or `prepare_iter` return normally, with `cancelled` set.
+        """
+        self.cancelled = True
+
+    def _read(self, data):
+        """Yield each non-empty line of `data` while storing it in `lines`"""
+        line_class = self.line_class
+        lines = self.lines
+        for l in data:
+            if self.cancelled:
+                return
+            # Characters, which is bytes for ASCII files
+            self.bytes_processed += len(l)
+            l = l.strip()
+            if l:
+                line = line_class(l)
+                lines.append(line)
+                yield line
+
+    def _stream(self, lines, layer_callback):
+        """Analyze `lines`, waking up `has_index` waiters on each layer"""
+        self._progress = threading.Condition()
+        self._pending = []
+        self.loading = True
+        try:
+            for layer_id in self._preprocess_iter(lines, build_layers = True,
+                                                  layer_callback = layer_callback):
+                with self._progress:
+                    self._progress.notify_all()
+                yield layer_id
+        finally:
+            if not self.cancelled and self.bytes_total is not None:
+                self.bytes_processed = self.bytes_total
+            with self._progress:
+                self.loading = False
+                for command in self._pending:
+                    self.append(command)
+                self._pending = []
+                self._progress.notify_all()
+
+    def _prepare_columnar(self, data, layer_callback = None, workers = None):
+        """Load and analyze `data` with the vectorized backend
+
+        Returns False if the backend is not available (NumPy missing),
+        in which case nothing has been done.
+        """
+        try:
+            from . import gcoder_columnar
+        except ImportError as e:
+            logging.warning("Columnar GCoder analysis unavailable: %s" % e)
+            return False
+        raws = [l2 for l2 in (l.strip() for l in data) if l2]
+        gcoder_columnar.preprocess(self, raws, layer_callback, workers)
+        return True
 
     def has_index(self, i):
+        """Whether line `i` exists, waiting for it if it is still loading"""
+        if i < len(self) or not self.loading:
+            return i < len(self)
+        with self._progress:
+            self._progress.wait_for(lambda: i < len(self) or not self.loading)
         return i < len(self)
+
     def __len__(self):
-        return len(self.line_idxs)
+        return len(self.layer_index)
+
+    # Layer and index in that layer of each line, for compatibility
+    layer_idxs = property(lambda self: self.layer_index.layer_idxs())
+    line_idxs = property(lambda self: self.layer_index.line_idxs())
 
     def __iter__(self):
         return self.lines.__iter__()
 
+    def _command_lines(self, commands):
+        glines = []
+        for command in commands:
+            command = command.strip()
+            if command:
+                gline = Line(command)
+                # Split to get command
+                split(gline)
+                # Force is_move to False
+                gline.is_move = False
+                glines.append(gline)
+        return glines
+
     def prepend_to_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
-        layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
-        else:
-            end_index = i + 1
-        end_line = self.line_idxs[end_index - 1]
-        for i, command in enumerate(commands):
-            gline = Line(command)
-            # Split to get command
-            split(gline)
-            # Force is_move to False
-            gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-            # Update indices arrays & global gcodes list
-            self.layer_idxs.insert(end_index + i, layer_idx)
-            self.line_idxs.insert(end_index + i, end_line + i + 1)
-        return commands[::-1]
+        """Insert `commands` at the beginning of layer `layer_idx`
+
+        Takes time proportional to the size of the layer and the number of
+        layers, plus a single move of the items of `lines`.
+        """
+        glines = self._command_lines(commands)
+        self._splice_layer(layer_idx, 0, 0, glines)
+        return [gline.raw for gline in glines]
 
     def rewrite_layer(self, commands, layer_idx):
-        # Prepend commands in reverse order
-        commands = [c.strip() for c in commands[::-1] if c.strip()]
+        """Replace the lines of layer `layer_idx` with `commands`
+
+        Takes time proportional to the size of the layer and the number of
+        layers, plus a single move of the items of `lines`.
+        """
+        glines = self._command_lines(commands)
+        self._splice_layer(layer_idx, 0, len(self.all_layers[layer_idx]),
+                           glines)
+        return [gline.raw for gline in glines]
+
+    def _splice_layer(self, layer_idx, offset, count, glines):
+        """Replace `count` lines of layer `layer_idx` from its line
+        `offset` with `glines`"""
         layer = self.all_layers[layer_idx]
-        # Find start index to append lines
-        # and end index to append new indices
-        start_index = self.layer_idxs.index(layer_idx)
-        for i in range(start_index, len(self.layer_idxs)):
-            if self.layer_idxs[i] != layer_idx:
-                end_index = i
-                break
+        start = self.layer_index.start(layer_idx) + offset
+        delta = len(glines) - count
+        self.lines[start:start + count] = glines
+        if isinstance(layer, MappedLayer):
+            # Layers are ranges of `lines`, the following ones move
+            layer.count += delta
+            for following in self.all_layers[layer_idx + 1:]:
+                if isinstance(following, MappedLayer):
+                    following.start += delta
         else:
-            end_index = i + 1
-        self.layer_idxs = self.layer_idxs[:start_index] + array('I', len(commands) * [layer_idx]) + self.layer_idxs[end_index:]
-        self.line_idxs = self.line_idxs[:start_index] + array('I', range(len(commands))) + self.line_idxs[end_index:]
-        del self.lines[start_index:end_index]
-        del layer[:]
-        for i, command in enumerate(commands):
-            gline = Line(command)
-            # Split to get command
-            split(gline)
-            # Force is_move to False
-            gline.is_move = False
-            # Insert gline at beginning of layer
-            layer.insert(0, gline)
-            # Insert gline at beginning of list
-            self.lines.insert(start_index, gline)
-        return commands[::-1]
+            layer[offset:offset + count] = glines
+        self.layer_index.resize(layer_idx, delta)
 
     def append(self, command, store = True):
         '''Add a G-code command to the list
@@ -321,7 +583,9 @@ class GCode:
         store : bool, default: True
             If True, `command` is appended to the current list of
             commands. If False, processed command is returned but not
-            added to the list.
+            added to the list. While loading (see `prepare_iter`), stored
+            commands are only added after the last loaded line, and None is
+            returned.
 
         Returns
         -------
@@ -334,18 +598,68 @@ class GCode:
         if not command:
             # TODO: return None or empty gline? Pylint #R1710
             return
+        if store and self.loading:
+            with self._progress:
+                if self.loading:
+                    # Added once the lines still being loaded are analyzed
+                    self._pending.append(command)
+                    return
         gline = Line(command)
         self._preprocess([gline])
         if store:
             self.lines.append(gline)
             self.append_layer.append(gline)
-            self.layer_idxs.append(self.append_layer_id)
-            self.line_idxs.append(len(self.append_layer)-1)
+            self.layer_index.add(self.append_layer_id)
         return gline
 
+    def advance(self, gline):
+        '''Process a line already parsed by another `GCode`
+
+        Same as `append(gline.raw, store = False)`, except that the command
+        and coordinates of `gline` are reused instead of parsing its text
+        again. Only the position, extrusion and modes of this object are
+        updated, `gline` itself is left untouched.
+
+        Parameters
+        ----------
+        gline : Line
+            Parsed line, such as one of the `lines` of the G-code being
+            printed. Lines without parsed values, like the ones of a
+            `LightGCode`, are parsed again.
+
+        Returns
+        -------
+        Line
+            A new `printrun.gcoder.Line` holding the values of `gline` and
+            the state of this object after it.
+
+        '''
+        if gline.command is None or getattr(gline, "is_move", None) is None:
+            return self.append(gline.raw, store = False)
+        line = Line(gline.raw)
+        line.command = gline.command
+        line.is_move = gline.is_move
+        for name in gcode_parsed_args:
+            value = getattr(gline, name)
+            if value is not None:
+                setattr(line, name, value)
+        self._preprocess([line], parsed = True)
+        return line
+
     def _preprocess(self, lines = None, build_layers = False,
-                    layer_callback = None):
-        """Checks for imperial/relativeness settings and tool changes"""
+                    layer_callback = None, parsed = False):
+        """Checks for imperial/relativeness settings and tool changes
+
+        With `parsed`, the command and coordinates of `lines` were already
+        set and they are not parsed again.
+        """
+        for _ in self._preprocess_iter(lines, build_layers, layer_callback,
+                                       parsed):
+            pass
+
+    def _preprocess_iter(self, lines = None, build_layers = False,
+                         layer_callback = None, parsed = False):
+        """Same as `_preprocess`, yielding the index of complete layers"""
         if not lines:
             lines = self.lines
         imperial = self.imperial
@@ -408,14 +722,14 @@ class GCode:
             # Initialize layers
             all_layers = self.all_layers = []
             all_zs = self.all_zs = set()
-            layer_idxs = self.layer_idxs = []
-            line_idxs = self.line_idxs = []
+            layer_index = self.layer_index = LayerIndex()
 
 
             last_layer_z = None
             prev_z = None
             cur_z = None
             cur_lines = []
+            finished_layers = 0
 
             def append_lines(lines, isEnd):
                 if not build_layers:
@@ -423,7 +737,7 @@ class GCode:
                 nonlocal layerbeginduration, last_layer_z
                 if cur_layer_has_extrusion and prev_z != last_layer_z \
                         or not all_layers:
-                    layer = Layer([], prev_z)
+                    layer = self._new_layer(prev_z)
                     last_layer_z = prev_z
                     finished_layer = len(all_layers)-1 if all_layers else None
                     all_layers.append(layer)
@@ -432,11 +746,11 @@ class GCode:
                     layer = all_layers[-1]
                     finished_layer = None
                 layer_id = len(all_layers)-1
-                layer_line = len(layer)
-                for i, ln in enumerate(lines):
+                for ln in lines:
                     layer.append(ln)
-                    layer_idxs.append(layer_id)
-                    line_idxs.append(layer_line+i)
+                # Lines are in their layer before being counted, for
+                # has_index while loading
+                layer_index.add(layer_id, len(lines))
                 layer.duration += totalduration - layerbeginduration
                 layerbeginduration = totalduration
                 if layer_callback:
@@ -455,7 +769,8 @@ class GCode:
             # # Parse line
             # Use a heavy copy of the light line to preprocess
             line = get_line(true_line)
-            split_raw = split(line)
+            if not parsed:
+                parse_line(line, imperial)
             if line.command:
                 # Update properties
                 if line.is_move:
@@ -497,9 +812,6 @@ class GCode:
                 max_e_multi = self.max_e_multi[current_tool]
 
 
-                if line.command[0] == "G":
-                    parse_coordinates(line, split_raw, imperial)
-
                 # Compute current position
                 if line.is_move:
                     x = line.x
@@ -676,6 +988,10 @@ class GCode:
                         append_lines(cur_lines, False)
                         cur_lines = []
                         cur_layer_has_extrusion = False
+                        # All layers but the last one are complete
+                        while finished_layers < len(all_layers) - 1:
+                            yield finished_layers
+                            finished_layers += 1
 
             if build_layers:
                 cur_lines.append(true_line)
@@ -713,8 +1029,6 @@ class GCode:
             self.append_layer = Layer([])
             self.append_layer.duration = 0
             all_layers.append(self.append_layer)
-            self.layer_idxs = array('I', layer_idxs)
-            self.line_idxs = array('I', line_idxs)
 
             # Compute bounding box
             all_zs = self.all_zs.union({zmin}).difference({None})
@@ -748,8 +1062,15 @@ class GCode:
             totaltime = datetime.timedelta(seconds = int(totalduration))
             self.duration = totaltime
 
+            while finished_layers < self.append_layer_id:
+                yield finished_layers
+                finished_layers += 1
+
+    def _new_layer(self, z = None):
+        return Layer([], z)
+
     def idxs(self, i):
-        return self.layer_idxs[i], self.line_idxs[i]
+        return self.layer_index.idxs(i)
 
     def estimate_duration(self):
         return self.layers_count, self.duration
@@ -757,14 +1078,399 @@ class GCode:
 class LightGCode(GCode):
     line_class = LightLine
 
+class StoredLines:
+    """Base of the sequences of lines stored in another form than objects
+
+    Subclasses create the object of stored line `i` with `_stored(i)`.
+    Lines added after loading, by `GCode.append` or by layer edits, are
+    regular objects kept in `appended`. Once layers were edited, `order`
+    maps each line index to a stored line, or to the object at index
+    `-1 - value` of `appended` for negative values.
+    """
+
+    __slots__ = ("appended", "order")
+
+    def __init__(self):
+        self.appended = []
+        self.order = None
+
+    def _stored(self, i):
+        raise NotImplementedError
+
+    def _stored_count(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        if self.order is not None:
+            return len(self.order)
+        return self._stored_count() + len(self.appended)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("line index out of range")
+        if self.order is not None:
+            stored = self.order[i]
+            if stored < 0:
+                return self.appended[-1 - stored]
+            return self._stored(stored)
+        count = self._stored_count()
+        if i >= count:
+            return self.appended[i - count]
+        return self._stored(i)
+
+    def __setitem__(self, index, lines):
+        """Replace the lines of slice `index` with the objects `lines`"""
+        if not isinstance(index, slice):
+            index = slice(index, index + 1)
+            lines = [lines]
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("only contiguous lines can be replaced")
+        if self.order is None:
+            self.order = array('q', range(self._stored_count()))
+            self.order.extend(range(-1, -1 - len(self.appended), -1))
+        refs = array('q')
+        for line in lines:
+            self.appended.append(line)
+            refs.append(-len(self.appended))
+        self.order[start:max(start, stop)] = refs
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, line):
+        self.appended.append(line)
+        if self.order is not None:
+            self.order.append(-len(self.appended))
+
+class MappedLines(StoredLines):
+    """Lines of a memory-mapped G-code file, created on demand
+
+    Only the byte offset of each non-empty line is kept in memory.
+    """
+
+    __slots__ = ("data", "offsets", "line_class")
+
+    def __init__(self, data, line_class):
+        super().__init__()
+        self.data = data
+        self.offsets = array('Q')
+        self.line_class = line_class
+
+    def raw(self, i):
+        """Text of stored line `i`"""
+        start = self.offsets[i]
+        end = self.data.find(b"\n", start)
+        if end < 0:
+            end = len(self.data)
+        return self.data[start:end].decode("utf-8").strip()
+
+    def _stored(self, i):
+        return self.line_class(self.raw(i))
+
+    def _stored_count(self):
+        return len(self.offsets)
+
+class MappedLayer:
+    """Layer of a `MappedGCode`, a `PackedGCode` or a columnar analysis, as
+    a range of its lines"""
+
+    __slots__ = ("lines", "start", "count", "duration", "z")
+
+    def __init__(self, lines, start, z = None):
+        self.lines = lines
+        self.start = start
+        self.count = 0
+        self.z = z
+        self.duration = 0
+
+    def append(self, line):
+        # Lines are always added in file order, only count them
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("layer line index out of range")
+        return self.lines[self.start + i]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.lines[self.start + i]
+
+class MappedGCode(LightGCode):
+    """`LightGCode` reading lines from a memory-mapped file
+
+    Instead of one object per line, only line offsets and the layer index
+    arrays are kept in memory. Line objects are created when accessed,
+    through `lines` or `all_layers`, and are not kept. Lines added by
+    `prepend_to_layer` or `rewrite_layer` are kept as objects, the file
+    itself is left untouched.
+
+    `data` is a file path or a file object (from which only the file
+    descriptor is used). The columnar backend is not used, as it would
+    need the whole file in memory.
+    """
+
+    def prepare_iter(self, data = None, home_pos = None,
+                     layer_callback = None, workers = None):
+        if isinstance(data, (str, bytes, os.PathLike)):
+            with open(data, "rb") as f:
+                yield from self.prepare_iter(f, home_pos, layer_callback)
+            return
+        if not self._map(data):
+            # Nothing to map (no data, empty file, list of lines...)
+            yield from super().prepare_iter(data, home_pos, layer_callback)
+            return
+        self.home_pos = home_pos
+        self.cancelled = False
+        self.bytes_processed = 0
+        self.bytes_total = len(self.lines.data)
+        yield from self._stream(self._scan(), layer_callback)
+
+    def _map(self, data):
+        if not hasattr(data, "fileno") or os.fstat(data.fileno()).st_size == 0:
+            return False
+        mapped = mmap.mmap(data.fileno(), 0, access = mmap.ACCESS_READ)
+        self.lines = MappedLines(mapped, self.line_class)
+        return True
+
+    def _scan(self):
+        """Yield each non-empty line while recording its offset"""
+        data = self.lines.data
+        offsets = self.lines.offsets
+        line_class = self.line_class
+        size = len(data)
+        start = 0
+        while start < size and not self.cancelled:
+            end = data.find(b"\n", start)
+            if end < 0:
+                end = size
+            raw = data[start:end].decode("utf-8").strip()
+            self.bytes_processed = end + 1
+            if raw:
+                offsets.append(start)
+                yield line_class(raw)
+            start = end + 1
+
+    def _new_layer(self, z = None):
+        # All lines processed so far are already in a layer
+        return MappedLayer(self.lines, len(self.layer_index), z)
+
+# Columns of PackedLines: floats (NaN for None), then flags
+packed_float_attrs = ("x", "y", "z", "e", "f", "i", "j",
+                      "current_x", "current_y", "current_z")
+packed_flag_attrs = ("is_move", "relative", "relative_e", "extruding")
+
+_get_floats = operator.attrgetter(*packed_float_attrs)
+_get_flags = operator.attrgetter(*packed_flag_attrs)
+
+def _packed_float(name):
+    def get(self):
+        value = getattr(self._lines, name)[self._index]
+        return None if value != value else value
+    def set(self, value):
+        getattr(self._lines, name)[self._index] = \
+            math.nan if value is None else value
+    return property(get, set)
+
+def _packed_flag(bit):
+    def get(self):
+        return bool(self._lines.flags[self._index] & bit)
+    def set(self, value):
+        if value:
+            self._lines.flags[self._index] |= bit
+        else:
+            self._lines.flags[self._index] &= ~bit
+    return property(get, set)
+
+class PackedLine:
+    """View on one line of `PackedLines`, with the `Line` attributes
+
+    Attributes are read from and written to the columns, the view itself
+    only holds the line index.
+    """
+
+    __slots__ = ("_lines", "_index")
+
+    def __init__(self, lines, index):
+        self._lines = lines
+        self._index = index
+
+    @property
+    def raw(self):
+        return self._lines.raw(self._index)
+
+    @property
+    def command(self):
+        return self._lines.commands[self._lines.command_ids[self._index]]
+
+    def _get_current_tool(self):
+        tool = self._lines.current_tool[self._index]
+        return None if tool < 0 else tool
+
+    def _set_current_tool(self, tool):
+        self._lines.current_tool[self._index] = -1 if tool is None else tool
+    current_tool = property(_get_current_tool, _set_current_tool)
+
+    def _get_gcview_end_vertex(self):
+        vertex = self._lines.gcview_end_vertex[self._index]
+        return None if vertex < 0 else vertex
+
+    def _set_gcview_end_vertex(self, vertex):
+        self._lines.gcview_end_vertex[self._index] = \
+            -1 if vertex is None else vertex
+    gcview_end_vertex = property(_get_gcview_end_vertex,
+                                 _set_gcview_end_vertex)
+
+for _name in packed_float_attrs:
+    setattr(PackedLine, _name, _packed_float(_name))
+for _bit, _name in enumerate(packed_flag_attrs):
+    setattr(PackedLine, _name, _packed_flag(1 << _bit))
+del _bit, _name
+
+class PackedLines(StoredLines):
+    """Analyzed G-code lines stored as columns
+
+    Raw lines are concatenated in a single buffer and every parsed or
+    computed value is stored in a typed array, one item per line, so that
+    millions of lines only take a few objects. Indexing returns a
+    `PackedLine` view. The arrays support the buffer protocol, e.g.
+    `numpy.frombuffer(lines.current_x)` gives the X positions without
+    copy. The columns are indexed by stored line, which is also the line
+    index until layers are edited (see `StoredLines`).
+    """
+
+    __slots__ = packed_float_attrs + (
+        "float_columns", "data", "offsets", "command_ids", "commands", "command_index",
+        "current_tool", "flags", "gcview_end_vertex")
+
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+        self.offsets = array('Q')
+        for name in packed_float_attrs:
+            setattr(self, name, array('d'))
+        self.float_columns = tuple(getattr(self, name)
+                                   for name in packed_float_attrs)
+        # Index 0 stands for lines without command
+        self.commands = [None]
+        self.command_index = {None: 0}
+        self.command_ids = array('H')
+        self.current_tool = array('h')
+        self.flags = array('B')
+        self.gcview_end_vertex = array('q')
+
+    def pack(self, line):
+        """Store the analyzed `line`"""
+        self.offsets.append(len(self.data))
+        self.data += line.raw.encode("utf-8")
+        nan = math.nan
+        for column, value in zip(self.float_columns, _get_floats(line)):
+            column.append(nan if value is None else value)
+        command_id = self.command_index.get(line.command)
+        if command_id is None:
+            command_id = self.command_index[line.command] = len(self.commands)
+            self.commands.append(line.command)
+        self.command_ids.append(command_id)
+        tool = line.current_tool
+        self.current_tool.append(-1 if tool is None else tool)
+        is_move, relative, relative_e, extruding = _get_flags(line)
+        self.flags.append((1 if is_move else 0) | (2 if relative else 0)
+                          | (4 if relative_e else 0)
+                          | (8 if extruding else 0))
+        vertex = line.gcview_end_vertex
+        self.gcview_end_vertex.append(-1 if vertex is None else vertex)
+
+    def raw(self, i):
+        """Text of stored line `i`"""
+        start = self.offsets[i]
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) \
+            else len(self.data)
+        return self.data[start:end].decode("utf-8")
+
+    def _stored(self, i):
+        return PackedLine(self, i)
+
+    def _stored_count(self):
+        return len(self.offsets)
+
+class PackedGCode(GCode):
+    """`GCode` keeping its lines in `PackedLines` columns
+
+    Lines are fully analyzed, as for `GCode`, but each one is packed into
+    the columns as soon as it is done and the `Line` object is dropped.
+    Lines added by `prepend_to_layer` or `rewrite_layer` are kept as
+    objects. The columnar backend is not used.
+    """
+
+    def _new_lines(self):
+        return PackedLines()
+
+    def _read(self, data):
+        """Yield a `Line` per non-empty line, packing the previous one
+
+        `_preprocess` is done with a line when it asks for the next one.
+        """
+        lines = self.lines
+        previous = None
+        for l in data:
+            if self.cancelled:
+                break
+            self.bytes_processed += len(l)
+            l = l.strip()
+            if l:
+                if previous is not None:
+                    lines.pack(previous)
+                previous = Line(l)
+                yield previous
+        if previous is not None:
+            lines.pack(previous)
+
+    def _prepare_columnar(self, data, layer_callback = None, workers = None):
+        return False
+
+    def _new_layer(self, z = None):
+        # All lines processed so far are already in a layer
+        return MappedLayer(self.lines, len(self.layer_index), z)
+
+
 def main():
-    if len(sys.argv) < 2:
-        print("usage: %s filename.gcode" % sys.argv[0])
-        return
+    parser = argparse.ArgumentParser(description = "Analyze a G-code file")
+    parser.add_argument("filename")
+    parser.add_argument("--columnar", action = "store_true",
+                        help = "use the vectorized analysis backend")
+    parser.add_argument("--workers", type = int, default = 1,
+                        help = "maximum number of processes used to parse "
+                             "the file, several ones imply --columnar")
+    args = parser.parse_args()
 
     print("Line object size:", sys.getsizeof(Line("G0 X0")))
     print("Light line object size:", sys.getsizeof(LightLine("G0 X0")))
-    gcode = GCode(open(sys.argv[1], "rU"))
+    with open(args.filename, "r") as f:
+        data = f.readlines()
+    start = time.perf_counter()
+    gcode = GCode(data, columnar = args.columnar)
+    elapsed = time.perf_counter() - start
+    print("Parsed in %0.02fs" % elapsed)
+    if args.workers > 1:
+        start = time.perf_counter()
+        gcode = GCode(deferred = True, columnar = args.columnar)
+        gcode.prepare(data, workers = args.workers)
+        parallel_elapsed = time.perf_counter() - start
+        print("Parsed in %0.02fs with %d workers (speedup: %0.02fx)"
+              % (parallel_elapsed, args.workers, elapsed / parallel_elapsed))
 
     print("Dimensions:")
     xdims = (gcode.xmin, gcode.xmax, gcode.width)
@@ -0,0 +1,243 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent cache of G-code analysis results.
+
+Analyzing a big file (layers, bounding box, filament, duration) takes much
+longer than just reading it. The results of `LightGCode` and `MappedGCode`
+analysis are stored in a small binary file per G-code file, so that loading
+the same file again only needs to read its lines.
+
+Each cache file holds a header, JSON encoded scalar results and then the
+raw per layer (and, for mapped files, per line) arrays.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+from pathlib import Path
+
+from printrun import gcoder
+
+MAGIC = b"PRGC"
+VERSION = 2
+SUFFIX = ".gcache"
+# magic, version, metadata length
+_header = struct.Struct("<4sII")
+_chunk_size = 1 << 20
+
+# GCode attributes needed to display the file and to keep analyzing
+# appended commands while printing
+STATE_ATTRS = ("imperial", "cutting", "relative", "relative_e",
+               "current_tool", "current_x", "current_y", "current_z",
+               "current_e", "total_e", "max_e", "current_f", "offset_x",
+               "offset_y", "offset_z", "offset_e", "current_e_multi",
+               "offset_e_multi", "total_e_multi", "max_e_multi",
+               "filament_length", "filament_length_multi", "xmin", "xmax",
+               "ymin", "ymax", "zmin", "zmax", "width", "depth", "height")
+
+def file_digest(path):
+    """Hash of the content of the file at `path`"""
+    digest = hashlib.blake2b(digest_size = 20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _read_array(f, typecode, count):
+    values = array(typecode)
+    values.fromfile(f, count)
+    return values
+
+class CacheDirectory:
+    """Directory of files derived from G-code files, limited to `max_size`
+    bytes. The least recently used entries are removed first when the
+    directory gets too big.
+    """
+
+    suffix = SUFFIX
+
+    def __init__(self, directory, max_size):
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    @staticmethod
+    def _identity(path):
+        stat = os.stat(path)
+        return {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+                "digest": file_digest(path)}
+
+    def evict(self, keep = None):
+        """Remove least recently used entries until the size fits, except
+        `keep` (e.g. the entry just written, even if it is too big alone)"""
+        entries = []
+        for entry in self.directory.glob("*" + self.suffix):
+            if entry == keep:
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        if keep is not None:
+            try:
+                total += keep.stat().st_size
+            except OSError:
+                pass
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                entry.unlink()
+            except OSError:
+                continue
+            total -= size
+
+class AnalysisCache(CacheDirectory):
+    """Directory of cached G-code analysis, limited to `max_size` bytes.
+
+    Entries are named after the G-code file path and the analyzer settings,
+    and are only used if the size, modification time and content of the
+    file did not change.
+    """
+
+    @staticmethod
+    def supports(gcode):
+        """Only objects without per line analysis results can be cached"""
+        return gcode.line_class is not gcoder.Line
+
+    def _entry(self, gcode, path, home_pos):
+        settings = [os.path.abspath(path), type(gcode).__name__,
+                    gcode.line_class.__name__, list(home_pos or ()),
+                    bool(gcode.cutting_as_extrusion)]
+        key = hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+        return self.directory / (key + self.suffix)
+
+    def load(self, gcode, path, home_pos = None, layer_callback = None):
+        """Fill `gcode` (created with `deferred = True`) from the cache.
+
+        Returns
+        -------
+        bool
+            False if there is no valid entry for `path`, in which case
+            `gcode` must be prepared as usual.
+        """
+        if not self.supports(gcode) or self.max_size <= 0:
+            return False
+        entry = self._entry(gcode, path, home_pos)
+        try:
+            with open(entry, "rb") as f:
+                magic, version, meta_size = _header.unpack(
+                    f.read(_header.size))
+                if magic != MAGIC or version != VERSION:
+                    return False
+                meta = json.loads(f.read(meta_size))
+                if meta["identity"] != self._identity(path):
+                    return False
+                n_lines = meta["lines"]
+                n_layers = len(meta["layer_z"])
+                durations = _read_array(f, "d", n_layers)
+                counts = _read_array(f, "I", n_layers)
+                offsets = _read_array(f, "Q", n_lines) \
+                    if meta["offsets"] else None
+        except (OSError, ValueError, KeyError, EOFError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning("Ignoring G-code cache entry %s: %s"
+                                % (entry, e))
+            return False
+
+        gcode.home_pos = home_pos
+        if offsets is not None:
+            with open(path, "rb") as f:
+                gcode.lines = gcoder.MappedLines(
+                    mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ),
+                    gcode.line_class)
+            gcode.lines.offsets = offsets
+            new_layer = lambda start, z: gcoder.MappedLayer(gcode.lines,
+                                                            start, z)
+        else:
+            line_class = gcode.line_class
+            with open(path, "r", encoding = "utf-8") as f:
+                gcode.lines = [line_class(l2) for l2 in
+                               (l.strip() for l in f)
+                               if l2]
+            new_layer = lambda start, z: gcoder.Layer([], z)
+        if len(gcode.lines) != n_lines:
+            return False
+
+        gcode.all_layers = []
+        start = 0
+        for z, duration, count in zip(meta["layer_z"], durations, counts):
+            layer = new_layer(start, z)
+            if offsets is not None:
+                layer.count = count
+            else:
+                layer.extend(gcode.lines[start:start + count])
+            layer.duration = duration
+            gcode.all_layers.append(layer)
+            start += count
+        gcode.append_layer_id = len(gcode.all_layers)
+        gcode.append_layer = gcoder.Layer([])
+        gcode.all_layers.append(gcode.append_layer)
+        gcode.all_zs = set(meta["all_zs"])
+        gcode.layer_index = gcoder.LayerIndex.from_counts(counts)
+        for attr in STATE_ATTRS:
+            setattr(gcode, attr, meta["state"][attr])
+        gcode.duration = datetime.timedelta(seconds = meta["duration"])
+        os.utime(entry)
+        if layer_callback:
+            for layer_id in range(gcode.append_layer_id):
+                layer_callback(gcode, layer_id)
+        return True
+
+    def store(self, gcode, path, home_pos = None):
+        """Save the analysis of `gcode`, freshly prepared from `path`"""
+        if not self.supports(gcode) or self.max_size <= 0:
+            return
+        layers = gcode.all_layers[:gcode.append_layer_id]
+        meta = {
+            "identity": self._identity(path),
+            "lines": len(gcode),
+            "offsets": isinstance(gcode.lines, gcoder.MappedLines),
+            "layer_z": [layer.z for layer in layers],
+            "all_zs": list(gcode.all_zs),
+            "duration": int(gcode.duration.total_seconds()),
+            "state": dict((attr, getattr(gcode, attr))
+                          for attr in STATE_ATTRS),
+        }
+        entry = self._entry(gcode, path, home_pos)
+        temp = entry.with_suffix(".tmp")
+        try:
+            self.directory.mkdir(parents = True, exist_ok = True)
+            with open(temp, "wb") as f:
+                data = json.dumps(meta, default = float).encode()
+                f.write(_header.pack(MAGIC, VERSION, len(data)))
+                f.write(data)
+                array("d", [layer.duration for layer in layers]).tofile(f)
+                array("I", [len(layer) for layer in layers]).tofile(f)
+                if meta["offsets"]:
+                    gcode.lines.offsets.tofile(f)
+            os.replace(temp, entry)
+        except OSError as e:
+            logging.warning("Could not write G-code cache entry %s: %s"
+                            % (entry, e))
+            return
+        self.evict()
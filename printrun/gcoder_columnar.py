@@ -0,0 +1,790 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized columnar analysis backend for `printrun.gcoder.GCode`.
+
+Instead of walking every line object in Python, the whole file is
+tokenized into NumPy columns (one entry per line, NaN for absent
+parameters) and positions, modal states, extrusion, bounding box, layers
+and duration are computed with whole-array passes. Only rare events (G92,
+G28, tool changes, layer boundaries) are handled in Python loops. The
+results are stored as they are computed, in `gcoder.PackedLines` columns:
+line objects are only created when accessed.
+
+The results are meant to be identical to `GCode._preprocess`, quirks
+included, so that both engines can be used interchangeably.
+"""
+
+import concurrent.futures
+import datetime
+import logging
+import math
+import re
+
+import numpy
+
+from printrun import gcoder
+
+# Tokens are a letter from `gcoder.to_parse` followed by a number, as in
+# `gcoder.gcode_exp`. Comments are replaced by a marker so that a comment
+# coming before the first token can be told apart from a line without any
+# token at all. As the text is lowercased first, an uppercase marker cannot
+# clash with anything else. Lines never span newlines here, so `\s` is
+# restricted.
+COMMENT_MARK = "C"
+_letters = gcoder.to_parse
+_number = r"[-+]?[0-9]*\.?[0-9]*"
+_blank = r"[^\S\n]*"
+_comment_exp = re.compile(r"\([^\(\)\n]*\)|;.*")
+# The command of each line, or the comment mark
+_line_exp = re.compile(
+    r"^[^{l}{m}\n]*(?:n{b}{n}[^{l}{m}\n]*)?([{l}]{b}{n}|{m})?.*$"
+    .format(l = _letters, m = COMMENT_MARK, b = _blank, n = _number),
+    re.MULTILINE)
+_blank_exp = re.compile(r"[^\S\n]+")
+# Parameters with a non-empty value, and line ends, found in a single pass
+# over the whole text. Numbers contain no letter, so no parameter is hidden
+# by the previous one and letters without value need not be matched.
+_param_exp = re.compile(r"\n|[{codes}]{b}(?:[-+][0-9]*\.?[0-9]*|[0-9]+\.?[0-9]*|\.[0-9]*)"
+                        .format(codes = "".join(gcoder.gcode_parsed_args),
+                                b = _blank).encode())
+# Parameters are parsed in chunks of this many characters, which bounds the
+# memory used by the token lists
+_chunk_size = 1 << 22
+# Width of the token arrays, longer tokens are parsed one by one
+_token_width = 12
+
+# Line kinds, see `tokenize`
+KIND_COMMAND = 0
+KIND_COMMENT = 1
+KIND_UNPARSED = 2
+
+class Tokens:
+    """Stateless per-line decomposition of a G-code file.
+
+    Attributes
+    ----------
+    command : numpy.ndarray of str
+        Command of each line such as "G1" or "M104", empty if the line has
+        no command (see `kind`).
+    kind : numpy.ndarray of int8
+        `KIND_COMMAND`, `KIND_COMMENT` for lines starting with a comment and
+        `KIND_UNPARSED` for lines without any recognizable token.
+    params : dict of numpy.ndarray
+        Value of each of `gcoder.gcode_parsed_args` on G lines, in file
+        units, NaN when absent.
+    """
+
+    __slots__ = ("command", "kind", "params")
+
+    def __init__(self, command, kind, params):
+        self.command = command
+        self.kind = kind
+        self.params = params
+
+    def __len__(self):
+        return len(self.command)
+
+def _to_floats(tokens):
+    """Parse the values of `tokens`, an array of parameter letters followed
+    by a number, as `float` would.
+
+    Numbers of up to 15 digits are an integer divided by a power of ten,
+    both exact as floats, so that the division rounds them like `float`.
+    Other tokens, such as malformed numbers, go through `float`.
+    """
+    chars = tokens.view(numpy.uint8).reshape(len(tokens), tokens.itemsize)
+    # One pass per character, each on contiguous memory
+    columns = numpy.ascontiguousarray(chars[:, 1:].T)
+    count = len(tokens)
+    negative = columns[0] == ord("-")
+    simple = numpy.ones(count, dtype = bool)
+    mantissa = numpy.zeros(count, dtype = numpy.int64)
+    digits = numpy.zeros(count, dtype = numpy.int8)
+    fraction = numpy.zeros(count, dtype = numpy.int8)
+    dots = numpy.zeros(count, dtype = numpy.int8)
+    for position, column in enumerate(columns):
+        value = column - numpy.uint8(ord("0"))
+        is_digit = value < 10
+        is_dot = column == ord(".")
+        mantissa *= numpy.where(is_digit, 10, 1)
+        mantissa += numpy.where(is_digit, value, 0)
+        digits += is_digit
+        fraction += is_digit & (dots > 0)
+        dots += is_dot
+        valid = is_digit | is_dot | (column == 0)
+        if not position:
+            valid |= negative | (column == ord("+"))
+        simple &= valid
+    simple &= (digits > 0) & (digits <= 15) & (dots <= 1)
+    values = mantissa / 10.0 ** fraction
+    values[negative] *= -1
+    for i in numpy.flatnonzero(~simple).tolist():
+        values[i] = float(tokens[i][1:])
+    return values
+
+def _params(text, count, valid):
+    """Value of each parameter on the `valid` lines of `text`, which has
+    `count` lines
+
+    As with `gcoder.gcode_exp`, the last non-empty value of a parameter
+    wins. Malformed numbers such as "-" only fail like the regular parser
+    would, that is when they are found on a line that gets parsed.
+    """
+    params = dict((code, numpy.full(count, numpy.nan))
+                  for code in gcoder.gcode_parsed_args)
+    if text is None:
+        return params
+    data = text.encode()
+    newline = ord("\n")
+    first_line = 0
+    for chunk in _split_bytes(data, _chunk_size):
+        found = _param_exp.findall(chunk)
+        tokens = numpy.array(found, dtype = "S%d" % _token_width)
+        codes = tokens.view(numpy.uint8)[::_token_width]
+        line = first_line + numpy.cumsum(codes == newline)
+        first_line = line[-1] + 1 if len(line) else first_line + 1
+        keep = codes != newline
+        keep[keep] = valid[line[keep]]
+        index = numpy.flatnonzero(keep)
+        codes = codes[index]
+        line = line[index]
+        values = _to_floats(tokens[index])
+        # Tokens cut to the width of the array
+        for i in numpy.flatnonzero(numpy.char.str_len(tokens[index])
+                                   == _token_width).tolist():
+            values[i] = float(found[index[i]][1:])
+        for code, column in params.items():
+            selected = numpy.flatnonzero(codes == ord(code))
+            if not len(selected):
+                continue
+            lines = line[selected]
+            # Only the last value on each line
+            last = numpy.append(lines[1:] != lines[:-1], True)
+            column[lines[last]] = values[selected[last]]
+    return params
+
+def tokenize(raws):
+    """Split stripped, non-empty G-code lines into `Tokens`."""
+    # An empty text would still give one (empty) line
+    return tokenize_text("\n".join(raws)) if raws else tokenize_text(None)
+
+def tokenize_text(text):
+    """Tokenize newline separated lines, see `tokenize`.
+
+    `text` must not have empty lines, None stands for no line at all.
+    """
+    commands = []
+    if text is not None:
+        text = _comment_exp.sub(COMMENT_MARK, text.lower())
+        # Whole text operations rather than one per line
+        commands = _blank_exp.sub("", "\n".join(_line_exp.findall(text)))
+        commands = commands.upper().split("\n")
+    command = numpy.array(commands, dtype = str)
+    kind = numpy.zeros(len(command), dtype = numpy.int8)
+    if len(command):
+        kind[command == ""] = KIND_UNPARSED
+        kind[command == COMMENT_MARK] = KIND_COMMENT
+        command[kind != KIND_COMMAND] = ""
+    else:
+        command = command.astype("U1")
+    is_g = command.astype("U1") == "G"
+    return Tokens(command, kind, _params(text, len(command), is_g))
+
+def _split_bytes(data, size):
+    """Split `data` in chunks of whole lines of about `size` bytes"""
+    start = 0
+    while True:
+        end = data.find(b"\n", start + size)
+        if end < 0:
+            yield data[start:]
+            return
+        yield data[start:end]
+        start = end + 1
+
+def _split_text(text, count):
+    """Split `text` in about `count` chunks of whole lines"""
+    size = len(text) // count + 1
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + size)
+        if end < 0:
+            end = len(text)
+        chunks.append(text[start:end])
+        start = end + 1
+    return chunks
+
+def tokenize_parallel(raws, workers):
+    """`tokenize` using a pool of `workers` processes.
+
+    Tokenizing is stateless, so the text is cut into byte ranges of whole
+    lines which are tokenized independently and then put back together.
+    Modal states are only resolved afterwards, by `analyze`.
+    """
+    if not raws or workers < 2:
+        return tokenize(raws)
+    chunks = _split_text("\n".join(raws), workers)
+    with concurrent.futures.ProcessPoolExecutor(len(chunks)) as pool:
+        parts = list(pool.map(tokenize_text, chunks))
+    return Tokens(numpy.concatenate([part.command for part in parts]),
+                  numpy.concatenate([part.kind for part in parts]),
+                  dict((code, numpy.concatenate([part.params[code]
+                                                 for part in parts]))
+                       for code in gcoder.gcode_parsed_args))
+
+def _ffill_index(mask):
+    """Index of the last True entry of `mask` up to each position, or -1"""
+    idx = numpy.where(mask, numpy.arange(len(mask)), -1)
+    return numpy.maximum.accumulate(idx) if len(idx) else idx
+
+def _ffill(mask, values, initial):
+    """Forward fill `values` where `mask` is set, starting with `initial`"""
+    idx = _ffill_index(mask)
+    if numpy.ndim(values) == 0:
+        values = numpy.full(len(mask), values)
+    return numpy.where(idx >= 0, values[numpy.maximum(idx, 0)], initial)
+
+def _modal(command, events, initial):
+    """State of a modal setting, events being a {command: value} dict"""
+    mask = numpy.zeros(len(command), dtype = bool)
+    values = numpy.zeros(len(command), dtype = type(initial))
+    for code, value in events.items():
+        hit = command == code
+        mask |= hit
+        values[hit] = value
+    return _ffill(mask, values, initial)
+
+def _previous(values, initial = 0.):
+    """`values` shifted by one position, starting with `initial`"""
+    return numpy.concatenate(([initial], values))[:len(values)]
+
+def _line_precision(values):
+    """Round `values` as stored in line objects.
+
+    Compiled lines store single precision values, which the regular
+    analysis then works with.
+    """
+    if gcoder.Line is gcoder.PyLine:
+        return values
+    return values.astype(numpy.float32).astype(float)
+
+def _solve_segment(values, sets, deltas, base, offset):
+    """Positions along a slice where the coordinate offset is constant"""
+    cumulated = numpy.cumsum(deltas)
+    last_set = _ffill_index(sets)
+    anchor = numpy.maximum(last_set, 0)
+    return numpy.where(last_set >= 0,
+                       values[anchor] + offset + cumulated - cumulated[anchor],
+                       base + cumulated)
+
+def _solve_axis(values, moves, relative, homes, g92s, current, offset, home):
+    """Track the absolute position of an axis.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Axis values, in mm, NaN when absent.
+    moves, relative, homes, g92s : numpy.ndarray of bool
+        Lines being moves, relative moves, G28 homing this axis and G92
+        setting this axis.
+    current, offset, home : float
+        Starting position and G92 offset, home position.
+
+    Returns
+    -------
+    tuple
+        Positions after each line, final position and final offset.
+    """
+    present = ~numpy.isnan(values)
+    sets = moves & ~relative & present
+    deltas = numpy.where(moves & relative & present, values, 0.)
+    positions = numpy.empty(len(values))
+    start = 0
+    for boundary in numpy.flatnonzero(homes | g92s).tolist() + [len(values)]:
+        if boundary > start:
+            positions[start:boundary] = _solve_segment(
+                values[start:boundary], sets[start:boundary],
+                deltas[start:boundary], current, offset)
+            current = positions[boundary - 1]
+        if boundary == len(values):
+            break
+        if homes[boundary]:
+            offset = 0
+            current = home
+        else:
+            offset = current - values[boundary]
+        positions[boundary] = current
+        start = boundary + 1
+    return positions, current, offset
+
+def _solve_extrusion(values, moves, relative, g92s, current, offset, total,
+                     max_e):
+    """Track extrusion, see `_solve_axis`.
+
+    Returns
+    -------
+    tuple
+        Per line extruding flags (on moves with E), running total, final
+        current, offset, total and max.
+    """
+    e_moves = moves & ~numpy.isnan(values)
+    positions, new_current, offset = _solve_axis(
+        values, moves, relative, numpy.zeros(len(values), dtype = bool), g92s,
+        current, offset, 0)
+    previous = _previous(positions, current)
+    extruding = e_moves & numpy.where(relative, values > 0,
+                                      positions > previous)
+    increments = numpy.where(e_moves,
+                             numpy.where(relative, values,
+                                         positions - previous), 0.)
+    totals = total + numpy.cumsum(increments)
+    if e_moves.any():
+        total = float(totals[-1])
+        max_e = max(max_e, float(totals[e_moves].max()))
+    return extruding, totals, new_current, offset, total, max_e
+
+class Analysis:
+    """Per-line results of `analyze`, as NumPy columns.
+
+    Attributes
+    ----------
+    tokens : Tokens
+        The analyzed tokens.
+    params : dict of numpy.ndarray
+        Parameters of G lines converted to mm, NaN when absent.
+    has_command, is_move, e_moves : numpy.ndarray of bool
+        Lines with a command (that is, not starting with a comment), moves
+        (G0 to G3) and moves with an E parameter.
+    relative, relative_e, tool : numpy.ndarray
+        Modal states after each line.
+    current_x, current_y, current_z : numpy.ndarray
+        Absolute position after each line.
+    extruding : numpy.ndarray of bool
+        Moves adding filament.
+    extruding_final : numpy.ndarray of bool
+        `extruding`, plus lines where a cutting tool is on if cutting is
+        shown as extrusion.
+    total_e : numpy.ndarray
+        Total extruded length after each line.
+    max_e : float
+        Maximum extruded length before the first line.
+    """
+
+    __slots__ = ("tokens", "params", "has_command", "is_move", "e_moves",
+                 "relative", "relative_e", "tool", "current_x", "current_y",
+                 "current_z", "extruding", "extruding_final", "total_e",
+                 "max_e")
+
+    def __len__(self):
+        return len(self.tokens)
+
+def analyze(gcode, tokens):
+    """Run modal states, positions and extrusion over `tokens`.
+
+    `gcode` current state (position, modes, offsets...) is used as starting
+    point and is updated with the final state, just like
+    `GCode._preprocess` does.
+    """
+    result = Analysis()
+    result.tokens = tokens
+    n = len(tokens)
+    command = tokens.command
+    letter = command.astype("U1")
+    result.has_command = tokens.kind != KIND_COMMENT
+
+    # Modal states, as set after processing each line
+    imperial = _modal(command, {"G20": True, "G21": False},
+                      bool(gcode.imperial))
+    relative = _modal(command, {"G90": False, "G91": True},
+                      bool(gcode.relative))
+    relative_e = _modal(command, {"G90": False, "G91": True,
+                                  "M82": False, "M83": True},
+                        bool(gcode.relative_e))
+    cutting = _modal(command, {"M3": True, "M4": True, "M5": False},
+                     bool(gcode.cutting))
+    tool_values = numpy.zeros(n, dtype = numpy.int64)
+    tool_changes = numpy.zeros(n, dtype = bool)
+    tools_count = len(gcode.current_e_multi)
+    for i in numpy.flatnonzero(letter == "T").tolist():
+        try:
+            tool_values[i] = int(command[i][1:])
+        except ValueError:
+            continue  # handle T? by treating it as no tool change
+        tool_changes[i] = True
+        tools_count = max(tools_count, tool_values[i] + 1)
+    tool = _ffill(tool_changes, tool_values, gcode.current_tool)
+    while tools_count > len(gcode.current_e_multi):
+        gcode.current_e_multi += [0]
+        gcode.offset_e_multi += [0]
+        gcode.total_e_multi += [0]
+        gcode.max_e_multi += [0]
+
+    # Coordinates, in mm
+    factor = numpy.where(imperial, 25.4, 1.)
+    params = dict((code, values * factor)
+                  for code, values in tokens.params.items())
+    params = dict((code, _line_precision(values))
+                  for code, values in params.items())
+    x, y, z, e, f = (params[code] for code in "xyzef")
+    is_move = (command == "G0") | (command == "G1") \
+        | (command == "G2") | (command == "G3")
+    g28 = command == "G28"
+    g92 = command == "G92"
+    home_all = g28 & (numpy.nan_to_num(x) == 0) \
+        & (numpy.nan_to_num(y) == 0) & (numpy.nan_to_num(z) == 0)
+    for code, values in (("x", x), ("y", y), ("z", z)):
+        present = ~numpy.isnan(values)
+        positions, current, offset = _solve_axis(
+            values, is_move, relative, g28 & (home_all | present),
+            g92 & present,
+            getattr(gcode, "current_" + code),
+            getattr(gcode, "offset_" + code),
+            getattr(gcode, "home_" + code))
+        setattr(result, "current_" + code, positions)
+        setattr(gcode, "current_" + code, current)
+        setattr(gcode, "offset_" + code, offset)
+
+    # Extrusion, both global and per tool
+    e_g92 = g92 & ~numpy.isnan(e)
+    result.max_e = gcode.max_e
+    extruding, result.total_e, gcode.current_e, gcode.offset_e, \
+        gcode.total_e, gcode.max_e = _solve_extrusion(
+            e, is_move, relative_e, e_g92, gcode.current_e, gcode.offset_e,
+            gcode.total_e, gcode.max_e)
+    for t in range(len(gcode.current_e_multi)):
+        on_tool = tool == t
+        if not on_tool.any():
+            continue
+        _, _, gcode.current_e_multi[t], gcode.offset_e_multi[t], \
+            gcode.total_e_multi[t], gcode.max_e_multi[t] = _solve_extrusion(
+                e[on_tool], is_move[on_tool], relative_e[on_tool],
+                e_g92[on_tool], gcode.current_e_multi[t],
+                gcode.offset_e_multi[t], gcode.total_e_multi[t],
+                gcode.max_e_multi[t])
+    result.extruding = extruding
+    result.extruding_final = extruding | (cutting & result.has_command
+                                          & bool(gcode.cutting_as_extrusion))
+
+    # Store the final status
+    if n:
+        gcode.imperial = bool(imperial[-1])
+        gcode.relative = bool(relative[-1])
+        gcode.relative_e = bool(relative_e[-1])
+        gcode.cutting = bool(cutting[-1])
+        gcode.current_tool = int(tool[-1])
+    feeds = numpy.flatnonzero(is_move & ~numpy.isnan(f))
+    if len(feeds):
+        gcode.current_f = float(f[feeds[-1]])
+
+    result.params = params
+    result.is_move = is_move
+    result.e_moves = is_move & ~numpy.isnan(e)
+    result.relative = relative
+    result.relative_e = relative_e
+    result.tool = tool
+    return result
+
+def _fill(column, values):
+    """Append `values` to the typed array `column`"""
+    column.frombytes(numpy.asarray(values, dtype = column.typecode).tobytes())
+
+def pack_lines(raws, analysis):
+    """Store `raws` and their analysis in `gcoder.PackedLines` columns,
+    with the values `GCode._preprocess` sets on full `Line` objects"""
+    tokens = analysis.tokens
+    lines = gcoder.PackedLines()
+    text = "".join(raws)
+    if text.isascii():
+        sizes = [len(raw) for raw in raws]
+    else:
+        sizes = [len(raw.encode("utf-8")) for raw in raws]
+    lines.data = bytearray(text, "utf-8")
+    sizes = numpy.array(sizes, dtype = numpy.int64)
+    _fill(lines.offsets, numpy.cumsum(sizes) - sizes)
+
+    params = analysis.params
+    commands = analysis.has_command
+    for name in gcoder.packed_float_attrs:
+        if name in params:
+            values = params[name]
+        else:
+            # Positions are only set on lines with a command
+            values = numpy.where(commands, _line_precision(
+                getattr(analysis, name)), numpy.nan)
+        _fill(getattr(lines, name), values)
+
+    # Lines starting with a comment have an empty command, as with `split`
+    names, ids = numpy.unique(tokens.command, return_inverse = True)
+    names = names.tolist()
+    lines.commands.extend(names)
+    lines.command_index.update((name, index + 1)
+                               for index, name in enumerate(names))
+    ids = ids.reshape(-1) + 1
+    for i in numpy.flatnonzero(tokens.kind == KIND_UNPARSED).tolist():
+        raw = raws[i]
+        logging.warning("raw G-Code line \"%s\" could not be parsed" % raw)
+        command_id = lines.command_index.get(raw)
+        if command_id is None:
+            command_id = lines.command_index[raw] = len(lines.commands)
+            lines.commands.append(raw)
+        ids[i] = command_id
+    _fill(lines.command_ids, ids)
+
+    is_move = analysis.is_move
+    _fill(lines.current_tool, numpy.where(is_move, analysis.tool, -1))
+    _fill(lines.flags, is_move * 1 | (is_move & analysis.relative) * 2
+          | (is_move & analysis.relative_e) * 4
+          | analysis.extruding_final * 8)
+    _fill(lines.gcview_end_vertex, numpy.full(len(raws), -1))
+    return lines
+
+def durations(analysis, raws, acceleration = 2000.0):
+    """Per line durations, using the same model as `GCode._preprocess`"""
+    n = len(analysis)
+    command = analysis.tokens.command
+    x, y, z, e, f = (analysis.params[code] for code in "xyzef")
+    result = numpy.zeros(n)
+    linear = numpy.flatnonzero((command == "G0") | (command == "G1"))
+    if len(linear):
+        # Coordinates are taken as is from the file, which the duration
+        # model does not try to fix: missing ones are kept from the
+        # previous G0/G1
+        lx, ly, lz, le = (_ffill(~numpy.isnan(values[linear]),
+                                 values[linear], 0.)
+                          for values in (x, y, z, e))
+        lf = _ffill(~numpy.isnan(f[linear]), f[linear] / 60.0, 0.)
+        has_z = ~numpy.isnan(z[linear])
+        has_e = ~numpy.isnan(e[linear])
+        dx = lx - _previous(lx)
+        dy = ly - _previous(ly)
+        # Force a full reacceleration on direction reversals
+        reversal = dx * _previous(dx) + dy * _previous(dy) <= 0
+        lastf = numpy.where(reversal, 0., _previous(lf))
+        travel = numpy.hypot(dx, dy)
+        still = travel == 0
+        z_travel = numpy.where(analysis.relative[linear], numpy.abs(z[linear]),
+                               numpy.abs(z[linear] - _previous(lz)))
+        e_travel = numpy.where(analysis.relative_e[linear],
+                               numpy.abs(e[linear]),
+                               numpy.abs(e[linear] - _previous(le)))
+        travel = numpy.where(still & has_z, z_travel,
+                             numpy.where(still & ~has_z & has_e,
+                                         e_travel, travel))
+        with numpy.errstate(divide = "ignore", invalid = "ignore"):
+            constant = numpy.where(lf != 0, travel / lf, 0.)
+            distance = 2 * numpy.abs(((lastf + lf) * (lf - lastf) * 0.5)
+                                     / acceleration)
+            accelerated = (distance <= travel) & (lastf + lf != 0) & (lf != 0)
+            full = 2 * distance / (lastf + lf) + (travel - distance) / lf
+            partial = 2 * travel / (lastf + lf)
+            result[linear] = numpy.where(lf == lastf, constant,
+                                         numpy.where(accelerated, full,
+                                                     partial))
+    for i in numpy.flatnonzero(command == "G4").tolist():
+        dwell = gcoder.P(gcoder.PyLightLine(raws[i]))
+        if dwell:
+            result[i] = dwell / 1000.0
+    return result
+
+def _layer_z(analysis):
+    """Z used for layer detection after each line, NaN if still unknown.
+
+    Like in `GCode._preprocess`, this is the Z from the file, only
+    following G92 and relative moves, not the machine position. Z changes
+    are few, so they are accumulated in order to get the very same floats.
+    """
+    z = analysis.params["z"]
+    present = analysis.has_command & ~numpy.isnan(z)
+    g92 = analysis.tokens.command == "G92"
+    sets = present & (g92 | (analysis.is_move & ~analysis.relative))
+    steps = present & analysis.is_move & analysis.relative
+    events = numpy.flatnonzero(sets | steps)
+    values = numpy.empty(len(events))
+    cur_z = None
+    for k, (value, is_set) in enumerate(zip(z[events].tolist(),
+                                            sets[events].tolist())):
+        cur_z = value if is_set or cur_z is None else cur_z + value
+        values[k] = cur_z
+    changed = numpy.zeros(len(z), dtype = bool)
+    changed[events] = True
+    filled = numpy.full(len(z), numpy.nan)
+    filled[events] = values
+    return _ffill(changed, filled, numpy.nan)
+
+def _optional(value):
+    return None if math.isnan(value) else float(value)
+
+def build_layers(gcode, analysis, line_durations, layer_callback = None):
+    """Split `gcode.lines` into layers, see `GCode._preprocess`
+
+    Layers are `gcoder.MappedLayer` ranges of the lines.
+    """
+    n = len(analysis)
+    x_or_y = ~numpy.isnan(analysis.params["x"]) \
+        | ~numpy.isnan(analysis.params["y"])
+    layer_extrusion = analysis.extruding & x_or_y
+    extrusion_count = numpy.cumsum(layer_extrusion)
+    layer_z = _layer_z(analysis)
+    same = (layer_z == _previous(layer_z, numpy.nan)) \
+        | (numpy.isnan(layer_z) & numpy.isnan(_previous(layer_z, numpy.nan)))
+    # A group of lines ends on a Z change if some extrusion happened since
+    # the previous Z change
+    changes = numpy.flatnonzero(~same)
+    before = _previous(changes, -1).astype(numpy.int64)
+    counted = extrusion_count[changes] - numpy.where(
+        before >= 0, extrusion_count[numpy.maximum(before, 0)], 0)
+    ends = changes[counted > 0].tolist()
+    groups = [(end, True) for end in ends]
+    if n:
+        last = ends[-1] if ends else -1
+        since_last = extrusion_count[-1] - (extrusion_count[last]
+                                            if last >= 0 else 0)
+        groups.append((n, since_last > 0))
+    cumulated = numpy.cumsum(line_durations)
+
+    all_layers = gcode.all_layers = []
+    all_zs = gcode.all_zs = set()
+    layer_index = gcode.layer_index = gcoder.LayerIndex()
+    last_layer_z = None
+    layerbeginduration = 0.0
+    start = 0
+    for index, (end, has_extrusion) in enumerate(groups):
+        prev_z = _optional(layer_z[end - 1]) if end > 0 else None
+        if has_extrusion and prev_z != last_layer_z or not all_layers:
+            layer = gcoder.MappedLayer(gcode.lines, start, prev_z)
+            last_layer_z = prev_z
+            finished_layer = len(all_layers) - 1 if all_layers else None
+            all_layers.append(layer)
+            all_zs.add(prev_z)
+        else:
+            layer = all_layers[-1]
+            finished_layer = None
+        layer_id = len(all_layers) - 1
+        layer.count += end - start
+        layer_index.add(layer_id, end - start)
+        totalduration = float(cumulated[min(end, n - 1)])
+        layer.duration += totalduration - layerbeginduration
+        layerbeginduration = totalduration
+        if layer_callback:
+            # we finish a layer when inserting the next
+            if finished_layer is not None:
+                layer_callback(gcode, finished_layer)
+            # notify about end layer, there will not be next
+            if index == len(groups) - 1:
+                layer_callback(gcode, layer_id)
+        start = end
+
+    gcode.append_layer_id = len(all_layers)
+    gcode.append_layer = gcoder.Layer([])
+    gcode.append_layer.duration = 0
+    all_layers.append(gcode.append_layer)
+
+def _bounds(values):
+    if not len(values):
+        return float("inf"), float("-inf")
+    return float(values.min()), float(values.max())
+
+def finalize(gcode, analysis, line_durations):
+    """Compute bounding box, filament and duration totals"""
+    n = len(analysis)
+    command = analysis.tokens.command
+    is_move = analysis.is_move
+
+    # Travel moves only count until something got extruded
+    running_max_e = numpy.maximum.accumulate(
+        numpy.where(analysis.e_moves, analysis.total_e, -numpy.inf)) \
+        if n else analysis.total_e
+    travel = is_move & (numpy.maximum(running_max_e, analysis.max_e) <= 0)
+    current_x = _line_precision(analysis.current_x)
+    current_y = _line_precision(analysis.current_y)
+    xmin, xmax = _bounds(current_x[travel])
+    ymin, ymax = _bounds(current_y[travel])
+
+    # Extruding moves also count the start point of the move, as taken from
+    # the previous G0/G1 in file coordinates
+    extruding = is_move & analysis.extruding_final
+    linear = (command == "G0") | (command == "G1")
+    before = numpy.cumsum(linear) - linear - 1
+    started = extruding & (before >= 0)
+    xs = [current_x[extruding]]
+    ys = [current_y[extruding]]
+    if started.any():
+        linear_ids = numpy.flatnonzero(linear)
+        for values, out in ((analysis.params["x"], xs),
+                            (analysis.params["y"], ys)):
+            filled = _ffill(~numpy.isnan(values[linear_ids]),
+                            values[linear_ids], 0.)
+            out.append(filled[before[started]])
+    xmin_e, xmax_e = _bounds(numpy.concatenate(xs))
+    ymin_e, ymax_e = _bounds(numpy.concatenate(ys))
+
+    all_zs = gcode.all_zs.union({0}).difference({None})
+    zmin = min(all_zs)
+    zmax = max(all_zs)
+
+    gcode.filament_length = gcode.max_e
+    while len(gcode.filament_length_multi) < len(gcode.max_e_multi):
+        gcode.filament_length_multi += [0]
+    for i, length in enumerate(gcode.max_e_multi):
+        gcode.filament_length_multi[i] = length
+
+    if gcode.filament_length > 0:
+        gcode.xmin = xmin_e if not math.isinf(xmin_e) else 0
+        gcode.xmax = xmax_e if not math.isinf(xmax_e) else 0
+        gcode.ymin = ymin_e if not math.isinf(ymin_e) else 0
+        gcode.ymax = ymax_e if not math.isinf(ymax_e) else 0
+    else:
+        gcode.xmin = xmin if not math.isinf(xmin) else 0
+        gcode.xmax = xmax if not math.isinf(xmax) else 0
+        gcode.ymin = ymin if not math.isinf(ymin) else 0
+        gcode.ymax = ymax if not math.isinf(ymax) else 0
+    gcode.zmin = zmin if not math.isinf(zmin) else 0
+    gcode.zmax = zmax if not math.isinf(zmax) else 0
+    gcode.width = gcode.xmax - gcode.xmin
+    gcode.depth = gcode.ymax - gcode.ymin
+    gcode.height = gcode.zmax - gcode.zmin
+
+    totalduration = float(line_durations.sum()) if n else 0.0
+    gcode.duration = datetime.timedelta(seconds = int(totalduration))
+
+def preprocess(gcode, raws, layer_callback = None, workers = None):
+    """Analyze a whole file, replacing `GCode._preprocess(build_layers=True)`.
+
+    The lines are stored as `gcoder.PackedLines` in `gcode.lines`, whatever
+    `gcode.line_class`, so that no line object is created while loading.
+
+    Parameters
+    ----------
+    gcode : GCode
+        The `printrun.gcoder.GCode` object to fill in.
+    raws : list of str
+        Stripped, non-empty G-code lines.
+    layer_callback : callable, optional
+        Called as in `GCode._preprocess`.
+    workers : int, optional
+        Number of processes used to tokenize the lines.
+
+    Returns
+    -------
+    Analysis
+        The per-line analysis results.
+    """
+    analysis = analyze(gcode, tokenize_parallel(raws, workers or 1))
+    gcode.lines = pack_lines(raws, analysis)
+    line_durations = durations(analysis, raws)
+    build_layers(gcode, analysis, line_durations, layer_callback)
+    finalize(gcode, analysis, line_durations)
+    return analysis
@@ -15,9 +15,11 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
-from libc.stdlib cimport malloc, free
+import logging
+
+from libc.stdlib cimport malloc, free, strtod
 from libc.stdint cimport uint8_t, uint32_t
-from libc.string cimport strlen, strncpy
+from libc.string cimport strlen, strncpy, memcpy, strcmp
 
 cdef char* copy_string(object value):
     value = value.encode('utf-8')
@@ -257,3 +259,180 @@ cdef class GLightLine:
         def __set__(self, value):
             if value: self._status = set_has_var(self._status, pos_is_move)
             else: self._status = unset_has_var(self._status, pos_is_move)
+
+cdef inline bint is_blank(char c):
+    # Same as \s in regular expressions, for ASCII
+    return c == b' ' or (b'\t' <= c <= b'\r') or (28 <= c <= 31)
+
+cdef inline bint is_digit(char c):
+    return b'0' <= c <= b'9'
+
+cdef inline char to_lower(char c):
+    if b'A' <= c <= b'Z':
+        return c + 32
+    return c
+
+cdef inline int arg_index(char c):
+    # Position in gcoder.gcode_parsed_args, -1 for other letters
+    if c == b'x': return 0
+    if c == b'y': return 1
+    if c == b'e': return 2
+    if c == b'f': return 3
+    if c == b'z': return 4
+    if c == b'i': return 5
+    if c == b'j': return 6
+    return -1
+
+cdef inline bint is_token_letter(char c):
+    return arg_index(c) >= 0 or c == b'g' or c == b't' or c == b'm' \
+        or c == b'n' or c == b'd'
+
+cdef double parse_number(char* raw, Py_ssize_t start, Py_ssize_t end) except? -1:
+    cdef char buf[64]
+    cdef Py_ssize_t k
+    cdef bint digits = False
+    for k in range(start, end):
+        if is_digit(raw[k]):
+            digits = True
+            break
+    if not digits or end - start >= 64:
+        # Let Python do the job, or raise the very same error
+        return float(raw[start:end].decode('utf-8'))
+    memcpy(buf, raw + start, end - start)
+    buf[end - start] = 0
+    return strtod(buf, NULL)
+
+cdef inline void set_arg(GLine line, int index, double value):
+    if index == 0:
+        line._x = value
+        line._status = set_has_var(line._status, pos_x)
+    elif index == 1:
+        line._y = value
+        line._status = set_has_var(line._status, pos_y)
+    elif index == 2:
+        line._e = value
+        line._status = set_has_var(line._status, pos_e)
+    elif index == 3:
+        line._f = value
+        line._status = set_has_var(line._status, pos_f)
+    elif index == 4:
+        line._z = value
+        line._status = set_has_var(line._status, pos_z)
+    elif index == 5:
+        line._i = value
+        line._status = set_has_var(line._status, pos_i)
+    elif index == 6:
+        line._j = value
+        line._status = set_has_var(line._status, pos_j)
+
+def parse_line(GLine line, bint imperial = False):
+    """Set command, is_move and coordinates of `line` in a single scan
+
+    Same as `gcoder.split` followed by `gcoder.parse_coordinates`, see
+    `gcoder.py_parse_line`.
+    """
+    cdef char* raw = line._raw
+    cdef Py_ssize_t n = strlen(raw)
+    cdef Py_ssize_t p = 0, q, num_start
+    cdef Py_ssize_t cmd_start = -1, cmd_end = -1
+    cdef char c
+    cdef int matches = 0, index
+    cdef bint is_g = False, comment_first = False, number_skipped = False
+    cdef double factor = 1.0
+    cdef char* command
+    while p < n:
+        c = to_lower(raw[p])
+        if c == b'(':
+            q = p + 1
+            while q < n and raw[q] != b'(' and raw[q] != b')':
+                q += 1
+            if q < n and raw[q] == b')':
+                if matches == 0:
+                    comment_first = True
+                    break
+                matches += 1
+                p = q + 1
+                continue
+        elif c == b';':
+            if matches == 0:
+                comment_first = True
+                break
+            matches += 1
+            while p < n and raw[p] != b'\n':
+                p += 1
+            continue
+        elif c == b'/' or c == b'*':
+            q = p + 1
+            while q < n and raw[q] != b'\n':
+                q += 1
+            if q < n:
+                if matches == 0:
+                    comment_first = True
+                    break
+                matches += 1
+                p = q + 1
+                continue
+        elif is_token_letter(c):
+            q = p + 1
+            while q < n and is_blank(raw[q]):
+                q += 1
+            num_start = q
+            if q < n and (raw[q] == b'-' or raw[q] == b'+'):
+                q += 1
+            while q < n and is_digit(raw[q]):
+                q += 1
+            if q < n and raw[q] == b'.':
+                q += 1
+            while q < n and is_digit(raw[q]):
+                q += 1
+            if matches == 0:
+                if c == b'n' and not number_skipped:
+                    # Line number, not the command
+                    number_skipped = True
+                    p = q
+                    continue
+                cmd_start = p
+                cmd_end = q
+                is_g = c == b'g'
+            elif is_g and q > num_start:
+                index = arg_index(c)
+                if index >= 0:
+                    set_arg(line, index, factor * parse_number(raw, num_start, q))
+            matches += 1
+            if matches == 1 and is_g:
+                # G20/G21 apply to their own coordinates
+                command = raw + num_start
+                if q - num_start == 2 and command[0] == b'2' and command[1] == b'0':
+                    imperial = True
+                elif q - num_start == 2 and command[0] == b'2' and command[1] == b'1':
+                    imperial = False
+                factor = 25.4 if imperial else 1.0
+            p = q
+            continue
+        p += 1
+
+    if line._command != NULL:
+        free(line._command)
+        line._command = NULL
+    line._status = unset_has_var(line._status, pos_is_move)
+    if comment_first:
+        line.command = ""
+        return
+    if cmd_start < 0:
+        line.command = line.raw
+        logging.warning("raw G-Code line \"%s\" could not be parsed" % line.raw)
+        return
+    # Command is the upper case letter followed by the number as is
+    command = <char *>malloc(cmd_end - cmd_start + 1)
+    command[0] = to_lower(raw[cmd_start]) - 32
+    q = 1
+    for p in range(cmd_start + 1, cmd_end):
+        if not is_blank(raw[p]):
+            command[q] = raw[p]
+            q += 1
+    command[q] = 0
+    line._command = command
+    line._status = set_has_var(line._status, pos_command)
+    if is_g and (strcmp(command, b"G0") == 0 or strcmp(command, b"G1") == 0
+                 or strcmp(command, b"G2") == 0 or strcmp(command, b"G3") == 0):
+        line._status = set_has_var(line._status, pos_is_move)
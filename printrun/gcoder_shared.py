@@ -0,0 +1,283 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""G-code jobs shared read-only by several processes.
+
+When several hosts print the same file on different printers, each of them
+would otherwise parse and keep its own copy of the file. A `JobStore`
+parses a file once and writes its lines, layer index and analysis results
+in a single flat job file. Each process then opens it as a `SharedGCode`,
+which memory-maps the job file read-only: all the processes share the same
+pages of the system cache, so memory does not grow with the number of
+printers.
+
+A job file holds a header, JSON encoded scalar results, the first line of
+each layer, the layer durations, the offset of each line, and finally the
+stripped lines themselves, one per line.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+
+from printrun import gcoder
+from printrun.gcoder_cache import CacheDirectory, STATE_ATTRS
+
+MAGIC = b"PRJB"
+VERSION = 1
+SUFFIX = ".gjob"
+# magic, version, metadata length, number of layers, number of lines
+_header = struct.Struct("<4sIIQQ")
+
+class ReadOnlyJobError(Exception):
+    """Raised when editing or preparing again a `SharedGCode`"""
+
+    def __init__(self, path):
+        super().__init__("G-code job %s is shared by several hosts and "
+                         "can't be changed, load the file without "
+                         "shared_gcode to edit it" % path)
+        self.path = path
+
+def _aligned(size):
+    """`size` rounded up so that the following arrays are aligned"""
+    return (size + 7) & ~7
+
+def write_job(gcode, f, identity = None):
+    """Write the lines and analysis of a prepared `gcode` to the binary
+    file object `f`, at its start"""
+    layers = gcode.all_layers[:gcode.append_layer_id]
+    meta = {
+        "identity": identity,
+        "home_pos": list(gcode.home_pos),
+        "layer_z": [layer.z for layer in layers],
+        "all_zs": list(gcode.all_zs),
+        "duration": gcode.duration.total_seconds(),
+        "state": dict((attr, getattr(gcode, attr)) for attr in STATE_ATTRS),
+    }
+    data = json.dumps(meta, default = float).encode()
+    n_layers = len(layers)
+    n_lines = sum(len(layer) for layer in layers)
+    f.write(_header.pack(MAGIC, VERSION, len(data), n_layers, n_lines))
+    f.write(data)
+    f.write(bytes(_aligned(f.tell()) - f.tell()))
+    starts = array("Q")
+    start = 0
+    for layer in layers:
+        starts.append(start)
+        start += len(layer)
+    starts.tofile(f)
+    array("d", [layer.duration for layer in layers]).tofile(f)
+    # Lines are written after their offsets, which are only known once
+    # the lines are written
+    offsets_pos = f.tell()
+    offsets = array("Q")
+    f.seek(offsets_pos + n_lines * offsets.itemsize)
+    position = f.tell()
+    for layer in layers:
+        for line in layer:
+            raw = line.raw.encode("utf-8") + b"\n"
+            offsets.append(position)
+            f.write(raw)
+            position += len(raw)
+    f.seek(offsets_pos)
+    offsets.tofile(f)
+
+class SharedGCode(gcoder.LightGCode):
+    """Read-only `LightGCode` view of a job file written by `JobStore`
+
+    Like with `MappedGCode`, line objects are created when accessed and
+    are not kept, but nothing is parsed or analyzed when opening the file:
+    only the layer objects are created. Layers cannot be edited, and the
+    object cannot be prepared again: both raise `ReadOnlyJobError`, and
+    `editable` is false so that editors can be disabled. Commands can
+    still be appended while printing (see `GCode.append`); they are only
+    seen by this object.
+
+    Objects are pickled as the path of their job file, so they can be sent
+    to other processes, where the file is mapped again.
+    """
+
+    editable = False
+
+    def __init__(self, path):
+        super().__init__(deferred = True)
+        self.path = os.fspath(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            self._load()
+        except (ValueError, TypeError, KeyError, struct.error):
+            self.close()
+            raise
+
+    def _load(self):
+        data = self._map
+        magic, version, meta_size, n_layers, n_lines = \
+            _header.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a job file" % self.path)
+        start = _header.size
+        meta = json.loads(data[start:start + meta_size])
+        self._position = _aligned(start + meta_size)
+        view = memoryview(data)
+        self._views = [view]
+        starts, durations, offsets = [
+            self._cast(view, typecode, count)
+            for typecode, count in (("Q", n_layers), ("d", n_layers),
+                                    ("Q", n_lines))]
+        if len(offsets) != n_lines:
+            raise ValueError("%s is truncated" % self.path)
+
+        self.lines = gcoder.MappedLines(data, self.line_class)
+        self.lines.offsets = offsets
+        self.all_layers = []
+        for layer_id, z in enumerate(meta["layer_z"]):
+            end = starts[layer_id + 1] if layer_id + 1 < n_layers \
+                else n_lines
+            layer = gcoder.MappedLayer(self.lines, starts[layer_id], z)
+            layer.count = end - starts[layer_id]
+            layer.duration = durations[layer_id]
+            self.all_layers.append(layer)
+        self.append_layer_id = len(self.all_layers)
+        self.append_layer = gcoder.Layer([])
+        self.all_layers.append(self.append_layer)
+        self.layer_index = gcoder.LayerIndex()
+        self.layer_index.starts = array("Q", starts)
+        self.layer_index.count = n_lines
+        self.all_zs = set(meta["all_zs"])
+        self.layers = {}
+        self.identity = meta["identity"]
+        self.home_pos = meta["home_pos"]
+        for attr in STATE_ATTRS:
+            setattr(self, attr, meta["state"][attr])
+        self.duration = datetime.timedelta(seconds = meta["duration"])
+
+    def _cast(self, view, typecode, count):
+        """Array of `count` items at the current position of the file"""
+        start = self._position
+        self._position += 8 * count
+        array_view = view[start:self._position].cast(typecode)
+        self._views.append(array_view)
+        return array_view
+
+    def __reduce__(self):
+        return (type(self), (self.path,))
+
+    def close(self):
+        """Unmap the job file, the object can't be used anymore"""
+        for view in reversed(getattr(self, "_views", ())):
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def prepare_iter(self, data = None, home_pos = None,
+                     layer_callback = None, workers = None):
+        raise ReadOnlyJobError(self.path)
+
+    def prepend_to_layer(self, commands, layer_idx):
+        raise ReadOnlyJobError(self.path)
+
+    def rewrite_layer(self, commands, layer_idx):
+        raise ReadOnlyJobError(self.path)
+
+class JobStore(CacheDirectory):
+    """Directory of job files shared by all the processes using it,
+    limited to `max_size` bytes (0 for no limit).
+
+    Jobs are named after the G-code file path, the home position and the
+    analyzer and its settings (`analyzer_key`), and are parsed again once the size, modification time or content of
+    the file changed.
+    """
+
+    suffix = SUFFIX
+
+    def _entry(self, path, home_pos, analyze, analyzer_key):
+        settings = [os.path.abspath(path), list(home_pos or ()),
+                    getattr(analyze, "__qualname__", None), analyzer_key]
+        key = hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+        return self.directory / (key + self.suffix)
+
+    def open(self, path, home_pos = None, analyze = None,
+             analyzer_key = None):
+        """Return a `SharedGCode` of the G-code file at `path`
+
+        The file is only parsed if no other process did it already.
+
+        Parameters
+        ----------
+        path : str
+            G-code file.
+        home_pos : tuple, optional
+            Home position, as (x, y, z).
+        analyze : callable, optional
+            Called with the parsed `MappedGCode` before it is stored, for
+            instance to estimate its duration more accurately.
+        analyzer_key : optional
+            JSON serializable settings `analyze` depends on, e.g. the
+            machine limits of a time estimator. Jobs analyzed with other
+            settings are kept apart.
+        """
+        entry = self._entry(path, home_pos, analyze, analyzer_key)
+        identity = self._identity(path)
+        try:
+            gcode = SharedGCode(entry)
+        except FileNotFoundError:
+            gcode = None
+        except (OSError, ValueError, TypeError, KeyError, struct.error) as e:
+            logging.warning("Ignoring G-code job %s: %s" % (entry, e))
+            gcode = None
+        if gcode is not None:
+            if gcode.identity == identity:
+                os.utime(entry)
+                return gcode
+            gcode.close()
+        self._store(entry, path, home_pos, analyze, identity)
+        # Mapped before evicting, in case another process removes it
+        gcode = SharedGCode(entry)
+        if self.max_size > 0:
+            self.evict(keep = entry)
+        return gcode
+
+    def _store(self, entry, path, home_pos, analyze, identity):
+        gcode = gcoder.MappedGCode(deferred = True)
+        try:
+            gcode.prepare(path, home_pos)
+            if analyze is not None:
+                analyze(gcode)
+            self.directory.mkdir(parents = True, exist_ok = True)
+            # Unique per process, in case several ones parse the file
+            temp = entry.with_suffix(".%d.tmp" % os.getpid())
+            with open(temp, "wb") as f:
+                write_job(gcode, f, identity)
+            os.replace(temp, entry)
+        finally:
+            if isinstance(gcode.lines, gcoder.MappedLines):
+                gcode.lines.data.close()
+
+    def remove(self, path, home_pos = None, analyze = None,
+               analyzer_key = None):
+        """Delete the job of a G-code file, if any
+
+        Objects using it keep working, but it is parsed again when opened.
+        """
+        try:
+            self._entry(path, home_pos, analyze, analyzer_key).unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,400 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Print time estimation replaying moves through a firmware-like planner.
+
+The estimate built by `GCode` while analyzing a file uses a fixed
+acceleration and no lookahead. `TimeEstimator` instead plans the moves the
+way Marlin or Klipper do: each move is limited by the requested feedrate
+and the per axis maximum velocity and acceleration, junction speeds
+between moves are limited by the junction deviation (or the classic jerk
+settings), and speeds are then propagated backward and forward through
+the whole file before computing the time of each trapezoidal velocity
+profile.
+
+Limits are the firmware defaults unless set by M201, M203, M204 and M205
+commands, either given to `MachineLimits.from_commands` (for instance
+from the settings) or found in the file itself.
+"""
+
+import datetime
+import math
+from array import array
+
+from printrun import gcoder
+
+AXES = "XYZE"
+# Slowest junction speed, mm/s, as MINIMUM_PLANNER_SPEED in Marlin
+MINIMUM_SPEED = 0.05
+# Feedrate used by the firmware until the file sets one, mm/s
+DEFAULT_FEEDRATE = 25.0
+# Commands after which the printer is stopped
+STOP_COMMANDS = frozenset(("G4", "G28", "G29", "M109", "M190", "M400",
+                           "M600"))
+
+class MachineLimits:
+    """Motion limits of the firmware, set by M201, M203, M204 and M205
+
+    Defaults are those of a stock Marlin configuration. Speeds are in
+    mm/s, accelerations in mm/s^2. When the junction deviation is None,
+    junction speeds are limited by the classic `jerk` settings instead.
+    """
+
+    def __init__(self):
+        self.max_feedrate = [300.0, 300.0, 5.0, 25.0]
+        self.max_acceleration = [3000.0, 3000.0, 100.0, 10000.0]
+        self.acceleration = 3000.0
+        self.retract_acceleration = 3000.0
+        self.travel_acceleration = 3000.0
+        self.jerk = [10.0, 10.0, 0.3, 5.0]
+        self.junction_deviation = 0.013
+
+    def copy(self):
+        limits = MachineLimits()
+        limits.__dict__.update(self.__dict__)
+        limits.max_feedrate = list(self.max_feedrate)
+        limits.max_acceleration = list(self.max_acceleration)
+        limits.jerk = list(self.jerk)
+        return limits
+
+    @classmethod
+    def from_commands(cls, commands):
+        """Default limits updated by `commands`
+
+        Parameters
+        ----------
+        commands : str or iterable of str
+            G-code commands, a string being split on commas, e.g.
+            "M201 X1000 Y1000, M204 P800".
+        """
+        limits = cls()
+        if isinstance(commands, str):
+            commands = commands.split(",")
+        for command in commands:
+            command = command.strip()
+            if command:
+                line = gcoder.PyLine(command)
+                gcoder.split(line)
+                limits.apply(line)
+        return limits
+
+    def apply(self, line):
+        """Update the limits if `line` is one of the limit commands
+
+        Returns
+        -------
+        bool
+            Whether `line` changed the limits.
+        """
+        command = line.command
+        if command == "M201":
+            self._set_axes(self.max_acceleration, line, True)
+        elif command == "M203":
+            self._set_axes(self.max_feedrate, line, True)
+        elif command == "M204":
+            # S sets both print and travel acceleration in older firmwares
+            value = gcoder.S(line)
+            if value:
+                self.acceleration = self.travel_acceleration = value
+            value = gcoder.P(line)
+            if value:
+                self.acceleration = value
+            value = gcoder.find_specific_code(line, "R")
+            if value:
+                self.retract_acceleration = value
+            value = gcoder.find_specific_code(line, "T")
+            if value:
+                self.travel_acceleration = value
+        elif command == "M205":
+            if self._set_axes(self.jerk, line, False):
+                # Jerk settings are meant for classic jerk firmwares
+                self.junction_deviation = None
+            value = gcoder.find_specific_code(line, "J")
+            if value is not None:
+                self.junction_deviation = value
+        else:
+            return False
+        return True
+
+    @staticmethod
+    def _set_axes(values, line, positive):
+        found = False
+        for i, axis in enumerate(AXES):
+            value = gcoder.find_specific_code(line, axis)
+            # Zero speeds or accelerations would stall the planner
+            if value is not None and (value > 0 or not positive):
+                values[i] = value
+                found = True
+        return found
+
+def _arc_length(line, start, target):
+    """Length of the G2/G3 arc from `start` to `target`"""
+    i = line.i or 0
+    j = line.j or 0
+    radius = math.hypot(i, j)
+    center_x = start[0] + i
+    center_y = start[1] + j
+    start_angle = math.atan2(-j, -i)
+    end_angle = math.atan2(target[1] - center_y, target[0] - center_x)
+    sweep = end_angle - start_angle
+    if line.command == "G2":
+        sweep = -sweep
+    sweep %= 2 * math.pi
+    if sweep == 0:
+        # Same start and end: full circle
+        sweep = 2 * math.pi
+    return math.hypot(radius * sweep, target[2] - start[2])
+
+def trapezoid_time(entry, exit, speed, acceleration, length):
+    """Duration of a move accelerating from `entry` up to at most `speed`
+    and decelerating to `exit`"""
+    accelerate = (speed * speed - entry * entry) / (2 * acceleration)
+    decelerate = (speed * speed - exit * exit) / (2 * acceleration)
+    if accelerate + decelerate <= length:
+        return ((speed - entry) + (speed - exit)) / acceleration \
+            + (length - accelerate - decelerate) / speed
+    # Triangular profile, top speed is not reached
+    peak = math.sqrt((2 * acceleration * length
+                      + entry * entry + exit * exit) / 2)
+    return ((peak - entry) + (peak - exit)) / acceleration
+
+def plan(lengths, speeds, accelerations, entries):
+    """Time of each move of a continuous motion
+
+    Parameters
+    ----------
+    lengths, speeds, accelerations : sequence of float
+        Length, nominal speed and acceleration of each move.
+    entries : sequence of float
+        Highest speed at the start of each move, given the junction with
+        the previous one. The motion ends at `MINIMUM_SPEED`.
+
+    Returns
+    -------
+    array
+        Duration of each move, in seconds.
+    """
+    count = len(lengths)
+    speed_at = array('d', entries)
+    speed_at.append(MINIMUM_SPEED)
+    # Backward pass: each move must be able to decelerate to the next one
+    for i in range(count - 1, -1, -1):
+        limit = speed_at[i + 1] * speed_at[i + 1] \
+            + 2 * accelerations[i] * lengths[i]
+        if speed_at[i] * speed_at[i] > limit:
+            speed_at[i] = math.sqrt(limit)
+    # Forward pass: and to accelerate from the previous one
+    for i in range(count):
+        limit = speed_at[i] * speed_at[i] + 2 * accelerations[i] * lengths[i]
+        if speed_at[i + 1] * speed_at[i + 1] > limit:
+            speed_at[i + 1] = math.sqrt(limit)
+    return array('d', (trapezoid_time(speed_at[i], speed_at[i + 1],
+                                      speeds[i], accelerations[i],
+                                      lengths[i])
+                       for i in range(count)))
+
+class TimeEstimator:
+    """Estimate print duration by planning moves as the firmware does
+
+    Parameters
+    ----------
+    limits : MachineLimits, optional
+        Limits of the printer, the defaults if not given. Limit commands
+        in the file override them from where they appear.
+    """
+
+    def __init__(self, limits = None):
+        self.limits = limits if limits is not None else MachineLimits()
+
+    def estimate(self, gcode):
+        """Set `duration` of each layer of `gcode` and the total duration
+
+        Works with any `GCode` subclass. Lines of lightweight classes are
+        parsed again, as they do not keep coordinates.
+
+        Returns
+        -------
+        float
+            Estimated duration in seconds.
+        """
+        layers = gcode.all_layers
+        lengths = array('d')
+        speeds = array('d')
+        accelerations = array('d')
+        entries = array('d')
+        move_layers = array('I')
+        dwells = [0.0] * len(layers)
+        for layer_id, layer_lines in self._moves(gcode):
+            for move in layer_lines:
+                if move[0] is None:
+                    dwells[layer_id] += move[1]
+                    continue
+                lengths.append(move[0])
+                speeds.append(move[1])
+                accelerations.append(move[2])
+                entries.append(move[3])
+                move_layers.append(layer_id)
+        durations = list(dwells)
+        for layer_id, duration in zip(move_layers,
+                                      plan(lengths, speeds, accelerations,
+                                           entries)):
+            durations[layer_id] += duration
+        for layer, duration in zip(layers, durations):
+            layer.duration = duration
+        total = sum(durations)
+        gcode.duration = datetime.timedelta(seconds = int(total))
+        return total
+
+    def _moves(self, gcode):
+        """Yield the moves of each layer, as (layer id, list of moves)
+
+        A move is (length, nominal speed, acceleration, entry speed) and
+        a dwell is (None, duration).
+        """
+        limits = self.limits.copy()
+        reparse = gcode.line_class is not gcoder.Line
+        imperial = False
+        relative = relative_e = False
+        home = (gcode.home_x, gcode.home_y, gcode.home_z, 0)
+        position = list(home)
+        offset = [0.0] * 4
+        feedrate = DEFAULT_FEEDRATE
+        previous_unit = None
+        previous_speed = 0.0
+        for layer_id, layer in enumerate(gcode.all_layers):
+            moves = []
+            for line in layer:
+                if reparse:
+                    line = gcoder.Line(line.raw)
+                    gcoder.parse_line(line, imperial)
+                command = line.command
+                if not command:
+                    continue
+                if command in gcoder.move_gcodes:
+                    if line.f is not None and line.f > 0:
+                        feedrate = line.f / 60.0
+                    target = list(position)
+                    for axis, value in enumerate((line.x, line.y, line.z,
+                                                  line.e)):
+                        if value is None:
+                            continue
+                        if relative or (axis == 3 and relative_e):
+                            target[axis] += value
+                        else:
+                            target[axis] = value + offset[axis]
+                    delta = [b - a for a, b in zip(position, target)]
+                    if command in ("G2", "G3"):
+                        length = _arc_length(line, position, target)
+                    else:
+                        length = math.sqrt(delta[0] * delta[0]
+                                           + delta[1] * delta[1]
+                                           + delta[2] * delta[2])
+                    position = target
+                    if length == 0:
+                        length = abs(delta[3])
+                        if length == 0:
+                            continue
+                        acceleration = limits.retract_acceleration
+                    elif delta[3]:
+                        acceleration = limits.acceleration
+                    else:
+                        acceleration = limits.travel_acceleration
+                    unit = [d / length for d in delta]
+                    if command in ("G2", "G3"):
+                        # Direction of the chord, good enough for junctions
+                        chord = math.sqrt(sum(d * d for d in delta[:3]))
+                        unit[:3] = [d / chord if chord else 0
+                                    for d in delta[:3]]
+                    speed = feedrate
+                    for axis in range(4):
+                        component = abs(unit[axis])
+                        if component:
+                            speed = min(speed,
+                                        limits.max_feedrate[axis] / component)
+                            acceleration = min(
+                                acceleration,
+                                limits.max_acceleration[axis] / component)
+                    entry = self._junction_speed(limits, previous_unit,
+                                                 previous_speed, unit, speed,
+                                                 acceleration)
+                    moves.append((length, speed, acceleration, entry))
+                    previous_unit = unit
+                    previous_speed = speed
+                    continue
+                if command in STOP_COMMANDS:
+                    previous_unit = None
+                    if command == "G4":
+                        dwell = gcoder.P(line)
+                        if dwell is not None:
+                            dwell /= 1000.0
+                        else:
+                            dwell = gcoder.S(line) or 0
+                        moves.append((None, dwell))
+                    elif command == "G28":
+                        home_all = line.x is None and line.y is None \
+                            and line.z is None
+                        for axis, value in enumerate((line.x, line.y,
+                                                      line.z)):
+                            if home_all or value is not None:
+                                position[axis] = home[axis]
+                                offset[axis] = 0
+                elif command == "G20":
+                    imperial = True
+                elif command == "G21":
+                    imperial = False
+                elif command == "G90":
+                    relative = relative_e = False
+                elif command == "G91":
+                    relative = relative_e = True
+                elif command == "M82":
+                    relative_e = False
+                elif command == "M83":
+                    relative_e = True
+                elif command == "G92":
+                    for axis, value in enumerate((line.x, line.y, line.z,
+                                                  line.e)):
+                        if value is not None:
+                            offset[axis] = position[axis] - value
+                else:
+                    limits.apply(line)
+            yield layer_id, moves
+
+    @staticmethod
+    def _junction_speed(limits, previous_unit, previous_speed, unit, speed,
+                        acceleration):
+        """Highest speed when going from the previous move to this one"""
+        if limits.junction_deviation is None:
+            # Classic jerk: instantaneous speed change of each axis
+            junction = speed
+            for axis in range(4):
+                before = previous_unit[axis] if previous_unit else 0
+                change = abs(unit[axis] - before)
+                if change:
+                    junction = min(junction, limits.jerk[axis] / change)
+            if previous_unit is not None:
+                junction = min(junction, previous_speed)
+            return max(junction, MINIMUM_SPEED)
+        if previous_unit is None:
+            return MINIMUM_SPEED
+        # Junction deviation, as in Marlin and Klipper
+        cos_theta = -sum(a * b for a, b in zip(previous_unit[:3], unit[:3]))
+        if cos_theta > 0.999999:
+            # Reversal
+            return MINIMUM_SPEED
+        cos_theta = max(cos_theta, -0.999999)
+        sin_theta_d2 = math.sqrt(0.5 * (1 - cos_theta))
+        junction = math.sqrt(acceleration * limits.junction_deviation
+                             * sin_theta_d2 / (1 - sin_theta_d2))
+        return max(min(junction, speed, previous_speed), MINIMUM_SPEED)
@@ -20,13 +20,22 @@ from .gui.widgets import MacroEditor
 from .utils import install_locale
 install_locale('pronterface')
 
+def check_editable(gcode):
+    if not gcode.editable:
+        logging.error(_("Layers of G-code files shared with other hosts can't be edited, disable the \"Share loaded G-code files\" option and load the file again"))
+    return gcode.editable
+
 def injector(gcode, viz_layer, layer_idx):
+    if not check_editable(gcode):
+        return
     cb = lambda toadd: inject(gcode, viz_layer, layer_idx, toadd)
     z = gcode.all_layers[layer_idx].z
     z = z if z is not None else 0
     MacroEditor(_("Inject G-Code at layer %d (Z = %.03f)") % (viz_layer, z), "", cb, True)
 
 def injector_edit(gcode, viz_layer, layer_idx):
+    if not check_editable(gcode):
+        return
     cb = lambda toadd: rewritelayer(gcode, viz_layer, layer_idx, toadd)
     layer = gcode.all_layers[layer_idx]
     z = layer.z
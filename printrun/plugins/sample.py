@@ -49,6 +49,9 @@ class SampleHandler(PrinterEventHandler):
         
     def on_temp(self, line):
         self.__write("on_temp", line)
+
+    def on_position(self, line):
+        self.__write("on_position", line)
     
     def on_start(self, resume):
         self.__write("on_start", "true" if resume else "false")
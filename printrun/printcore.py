@@ -20,15 +20,18 @@ if sys.version_info.major < 3:
     print("You need to run this on Python 3")
     sys.exit(-1)
 
+import re
 import threading
-from queue import Queue, Empty as QueueEmpty
 import time
+from queue import Queue
 import logging
 import traceback
 from functools import wraps, reduce
+from operator import xor
 from collections import deque
 from printrun import gcoder
 from printrun import device
+from printrun.eventbus import EventBus
 from .utils import set_utf8_locale, install_locale, decode_utf8
 try:
     set_utf8_locale()
@@ -51,6 +54,115 @@ PR_AGAIN = b'' #printrun's marker for timeout/no data
 SYS_EOF = b''  #python's marker for EOF
 SYS_AGAIN = None #python's marker for timeout/no data
 
+def parse_resend(line):
+    """Return the line number requested by a resend request, or None"""
+    # Teststrings for resend parsing       # Firmware     exp. result
+    # line="rs N2 Expected checksum 67"    # Teacup       2
+    for haystack in ["N:", "N", ":"]:
+        line = line.replace(haystack, " ")
+    for word in line.split():
+        try:
+            return int(word)
+        except ValueError:
+            pass
+    return None
+
+# Kinds of the lines received from the firmware, see `classify_line`
+LINE_OTHER = 'other'
+LINE_GREETING = 'greeting'
+LINE_OK = 'ok'
+LINE_OK_TEMP = 'ok_temp'
+LINE_TEMP = 'temp'
+LINE_POSITION = 'position'
+LINE_RESEND = 'resend'
+LINE_ERROR = 'error'
+LINE_BUSY = 'busy'
+LINE_ACTION = 'action'
+LINE_ECHO = 'echo'
+LINE_DEBUG = 'debug'
+LINE_CAPABILITY = 'capability'
+LINE_SD_STATUS = 'sd_status'
+
+# One alternative per kind of line, named after it. The first matching
+# alternative gives the kind, so the order matters. All the // host
+# messages are actions, not only the "//action:" ones, as the handlers of
+# actions also log the other ones.
+line_exp = re.compile(r"""
+    (?P<position>(?:ok\ C:\ ?)?X:\s*-?[\d.]+\s+Y:)
+  | (?P<ok_temp>ok.*?\bT\d*:)
+  | (?P<ok>ok)
+  | (?P<temp>\s*(?:T\d*|B):)
+  | (?P<resend>(?i:resend)|rs)
+  | (?P<error>Error)
+  | (?P<busy>(?:echo:\s*)?busy:)
+  | (?P<action>!!|//)
+  | (?P<echo>echo:)
+  | (?P<debug>DEBUG_)
+  | (?P<capability>Cap:)
+  | (?P<sd_status>SD\ printing\ byte|Not\ SD\ printing)
+""", re.VERBOSE)
+
+# Firmware capabilities of periodic reports, with the kind of the reported
+# lines and the command enabling the reports
+AUTOREPORTS = {
+    'AUTOREPORT_TEMP': (LINE_TEMP, 'M155'),
+    'AUTOREPORT_POS': (LINE_POSITION, 'M154'),
+    'AUTOREPORT_SD_STATUS': (LINE_SD_STATUS, 'M27'),
+}
+
+def parse_capability(line):
+    """Return the name of a capability reported by M115 and whether it is
+    enabled"""
+    # line="Cap:AUTOREPORT_TEMP:1"
+    name, sep, value = line[4:].strip().partition(":")
+    return name, value.strip() == "1"
+
+class ReceivedLine(str):
+    """A line received from the firmware, as classified by `classify_line`.
+
+    It is passed as is to the handlers of received lines, which can rely on
+    its attributes instead of parsing the line again.
+
+    Attributes
+    ----------
+    kind : str
+        One of the `LINE_*` constants.
+    ok : bool
+        Whether the line acknowledges a command, including ok lines
+        reporting temperatures or positions.
+    resend : int or None
+        The line number requested again by `LINE_RESEND` lines.
+
+    """
+    __slots__ = ('kind', 'ok', 'resend')
+
+def classify_line(line, greetings = ()):
+    """Classify a line received from the firmware.
+
+    Parameters
+    ----------
+    line : str
+    greetings : sequence of str, optional
+        Starts of the lines sent by the firmware when it (re)starts.
+
+    Returns
+    -------
+    ReceivedLine
+
+    """
+    received = ReceivedLine(line)
+    match = line_exp.match(line)
+    if match is not None:
+        kind = match.lastgroup
+    elif greetings and line.startswith(tuple(greetings)):
+        kind = LINE_GREETING
+    else:
+        kind = LINE_OTHER
+    received.kind = kind
+    received.ok = line.startswith('ok')
+    received.resend = parse_resend(line) if kind == LINE_RESEND else None
+    return received
+
 class printcore():
     """Core 3D printer host functionality.
 
@@ -68,21 +180,55 @@ class printcore():
     dtr : bool, optional
         On serial connections, enable/disable hardware DTR flow
         control. (Default is None)
+    window_size : int, optional
+        Number of printed lines that may await an acknowledgement from the
+        firmware. 1 sends a line only once the previous one was acknowledged,
+        0 tunes the window from the firmware replies. See `SendWindow`.
+        (Default is None, keeping the current value)
 
     Attributes (WIP)
     ----------
     analyzer : GCode
         A `printrun.gcoder.GCode` object containing all the G-code commands
         sent to the printer.
+    batch_latency : float
+        Seconds a line may wait for more lines to be written with it when
+        batching. Default is 0.01.
+    batch_size : int
+        In TCP streaming mode, lines are written to network printers in
+        batches of up to this many bytes instead of one by one, 0 to write
+        each line on its own. Default is 1024.
+    autoreport_interval : int
+        Seconds between the temperature, position and SD status reports
+        the firmware sends on its own, when it supports them. Capabilities
+        are requested with M115 once online and each supported report is
+        enabled, see `AUTOREPORTS`. 0 disables auto-reports. Default is 0.
+    autoreports : set of str
+        Kinds of the lines the firmware reports on its own, among
+        `LINE_TEMP`, `LINE_POSITION` and `LINE_SD_STATUS`. These no longer
+        need to be polled.
+    batched_lines, batched_writes : int
+        Lines queued for batching and writes of batches since the print
+        started, giving the mean number of lines per write.
     baud
+    capabilities : dict
+        Capabilities reported by the firmware in reply to M115, with whether
+        they are enabled.
     callback : Callback
         Object containing callback functions run at certain process stages.
         See `printrun.printcore.Callback`.
+    line_listener : callable or None
+        While the connection is handed over with `take_link`, called with
+        each received line instead of handling it.
     dtr
     event_handler : list of PrinterEventHandler
         Collection of event-handling objects. The relevant method of each
         handler on this list will be triggered at the relevant process
         stage. See `printrun.eventhandler.PrinterEventHandler`.
+    event_bus : EventBus
+        Events are also published on this bus, whose subscribers are called
+        from a dispatcher thread instead of the communication threads, see
+        `printrun.eventbus.EventBus`.
     mainqueue : GCode
         The main command queue. A `printrun.gcoder.GCode` object containing an
         array of G-code commands. A call to `startprint` will populate this
@@ -94,25 +240,58 @@ class printcore():
     paused : bool
         True if there is a print currently on pause.
     port
+    prepared_lines : int
+        Number of print lines encoded by a `WireBuffer` ahead of the send
+        loop, 0 to encode each line only when it is sent. Default is 256.
     printing : bool
         True if there is a print currently running.
     priqueue : Queue
         The priority command queue. Commands in this queue will be gradually
         sent to the printer. If there are commands in the `mainqueue` the ones
         in `priqueue` will be sent ahead of them. See `queue.Queue`.
+    resend_buffer_size : int
+        Number of numbered lines kept in `sentlines` to answer resend requests.
+        It must exceed the lines the firmware may still ask for, that is the
+        lines in flight, and applies from the next print. Default is 1024.
+    rx_buffer_size : int
+        Size in bytes of the firmware serial receive buffer, the lines in the
+        send window never take more than that. Marlin uses 128 by default.
+    sent : deque
+        The last `sent_log_size` commands sent to the printer.
+    sent_bytes : int
+        Bytes sent to the printer since the print started.
+    sent_count : int
+        Commands sent to the printer since the print started.
+    sent_log_size : int
+        Number of commands kept in `sent`, 0 to only update the counters.
+        Default is 10000.
+    sentlines : ResendBuffer
+        The last numbered lines of the current print, by line number.
+    window : SendWindow
+        Lines of the current print awaiting an acknowledgement, None when
+        `window_size` is 1.
+    window_size
 
     """
 
-    def __init__(self, port = None, baud = None, dtr=None):
+    def __init__(self, port = None, baud = None, dtr=None, window_size=None):
         self.baud = None
         self.dtr = None
+        self.window_size = 1
+        self.rx_buffer_size = 128
+        self.window = None
+        # Notified whenever `clear` or the send window change
+        self.send_cond = threading.Condition()
+        # Held by the send thread while writing and by `take_link` users
+        self.link_lock = threading.Lock()
+        self.line_listener = None
         self.port = None
         self.analyzer = gcoder.GCode()
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
-        # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
+        # clear to send, enabled after responses, the send window is used
+        # instead when more than one line may be in flight
         self.clear = 0
         # The printer has responded to the initial command and is active
         self.online = False
@@ -124,9 +303,18 @@ class printcore():
         self.lineno = 0
         self.resendfrom = -1
         self.paused = False
-        self.sentlines = {}
+        self.resend_buffer_size = 1024
+        self.autoreport_interval = 0
+        self.autoreports = set()
+        self.capabilities = {}
+        self.sentlines = ResendBuffer(self.resend_buffer_size)
         self.log = deque(maxlen = 10000)
-        self.sent = []
+        self.sent_log_size = 10000
+        self.sent = deque(maxlen = self.sent_log_size)
+        self.sent_count = 0
+        self.sent_bytes = 0
+        self.prepared_lines = 256
+        self.wire_buffer = None
         self.writefailures = 0
         self.callback = Callback()
         self.callback.hostcommand = self._host_command_cb
@@ -147,6 +335,12 @@ class printcore():
 
         self.loud = False  # emit sent and received lines to terminal
         self.tcp_streaming_mode = False
+        self.batch_size = 1024
+        self.batch_latency = 0.01
+        self.batch = bytearray()
+        self.batch_start = 0
+        self.batched_lines = 0
+        self.batched_writes = 0
         self.greetings = ['start', 'Grbl ']
         self.wait = 0  # default wait period for send(), send_now()
         self.read_thread = None
@@ -157,12 +351,24 @@ class printcore():
         self.readline_buf = []
         self.selector = None
         self.event_handler = PRINTCORE_HANDLER
+        self.event_bus = EventBus()
         self._callback('init')
         if port is not None and baud is not None:
-            self.connect(port, baud)
+            self.connect(port, baud, window_size = window_size)
         self.xy_feedrate = None
         self.z_feedrate = None
 
+    @property
+    def clear(self):
+        """Clear to send, enabled after responses"""
+        return self._clear
+
+    @clear.setter
+    def clear(self, value):
+        with self.send_cond:
+            self._clear = value
+            self.send_cond.notify_all()
+
     def addEventHandler(self, handler):
         '''
         Adds an event handler.
@@ -195,6 +401,7 @@ class printcore():
                 self.read_thread = None
             if self.print_thread:
                 self.printing = False
+                self._stop_waiting()
                 self.print_thread.join()
             self._stop_sender()
             try:
@@ -203,13 +410,16 @@ class printcore():
                 self._logError(traceback.format_exc())
                 pass
         self._callback('disconnect')
+        # Delivers the disconnect event, the bus is started on connection
+        self.event_bus.close()
         self.printer = None
         self.online = False
         self.printing = False
 
     @locked
-    def connect(self, port = None, baud = None, dtr=None):
-        """Set port and baudrate if given, then connect to printer
+    def connect(self, port = None, baud = None, dtr=None, window_size=None):
+        """Set port, baudrate and send window size if given, then connect to
+        printer
         """
         if self.printer:
             self.disconnect()
@@ -219,8 +429,13 @@ class printcore():
             self.baud = baud
         if dtr is not None:
             self.dtr = dtr
+        if window_size is not None:
+            self.window_size = window_size
         if self.port is not None and self.baud is not None:
             self.writefailures = 0
+            self.autoreports = set()
+            self.capabilities = {}
+            self.event_bus.start()
             self.printer = device.Device()
             self.printer.force_dtr = self.dtr
             try:
@@ -229,6 +444,12 @@ class printcore():
                 self._logError("Connection error: %s" % e)
                 self.printer = None
                 return
+            if self.window_size == 1:
+                self.window = None
+            else:
+                self.window = SendWindow(self.window_size,
+                                         self.rx_buffer_size,
+                                         self.send_cond)
             self._callback('connect')
             self.stop_read_thread = False
             self.read_thread = threading.Thread(target = self._listen,
@@ -255,7 +476,7 @@ class printcore():
                                " line_bytes is None")
                 self.stop_read_thread = True
                 return PR_EOF
-            line = line_bytes.decode('utf-8')
+            line = classify_line(line_bytes.decode('utf-8'), self.greetings)
 
             if len(line) > 1:
                 self.log.append(line)
@@ -301,45 +522,89 @@ class printcore():
                     empty_lines += 1
                     if empty_lines == 15: break
                 else: empty_lines = 0
-                if line.startswith(tuple(self.greetings)) \
-                   or line.startswith('ok') or "T:" in line:
+                if line.ok or line.kind in (LINE_GREETING, LINE_TEMP):
                     self.online = True
                     self._callback('online')
+                    self._request_capabilities()
                     return
 
+    def _request_capabilities(self):
+        if self.autoreport_interval:
+            self.send_now("M115")
+
+    def _capability(self, line):
+        name, enabled = parse_capability(line)
+        self.capabilities[name] = enabled
+        if enabled and name in AUTOREPORTS and self.autoreport_interval:
+            kind, command = AUTOREPORTS[name]
+            self.send_now("%s S%d" % (command, self.autoreport_interval))
+            self.autoreports.add(kind)
+
     def _listen(self):
         """This function acts on messages from the firmware
         """
         self.clear = True
         if not self.printing:
             self._listen_until_online()
+        resend_requested = False
+        # Whether the firmware follows resend requests with an ok. Most
+        # firmwares do, and that ok must not allow another line to be sent:
+        # it would put two lines in flight. Others don't, so the line after
+        # a request grants the next one instead, even if it is only the
+        # empty line of a read timeout. Once a request was not followed by
+        # an ok, requests grant the next line right away, so that only the
+        # first one waits for that timeout.
+        resend_ok = None
         while self._listen_can_continue():
             line = self._readline()
             if line is None:
                 logging.debug('_readline() is None, exiting _listen()')
                 break
-            if line.startswith('DEBUG_'):
+            listener = self.line_listener
+            if listener is not None:
+                listener(line)
+                continue
+            if resend_requested and resend_ok is not False:
+                if not line.ok:
+                    self.clear = True
+                resend_ok = line.ok
+            resend_requested = False
+            kind = line.kind
+            if kind == LINE_DEBUG:
                 continue
-            if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
+            if line.ok or kind == LINE_GREETING:
                 self.clear = True
-            if line.startswith('ok') and "T:" in line:
+            if self.window is not None:
+                if line.ok:
+                    self.window.ack(line)
+                elif kind == LINE_GREETING:
+                    # The firmware restarted, nothing is in flight anymore
+                    self.window.reset()
+            if kind == LINE_OK_TEMP or kind == LINE_TEMP:
                 self._callback('temp', line)
-            elif line.startswith('Error'):
+            elif kind == LINE_POSITION:
+                self._callback('position', line)
+            elif kind == LINE_CAPABILITY:
+                self._capability(line)
+            elif kind == LINE_GREETING and self.online:
+                # Reports have to be enabled again after a restart
+                self.autoreports.clear()
+                self._request_capabilities()
+            elif kind == LINE_ERROR:
                 self._logError(line)
-            # Teststrings for resend parsing       # Firmware     exp. result
-            # line="rs N2 Expected checksum 67"    # Teacup       2
-            if line.lower().startswith("resend") or line.startswith("rs"):
-                for haystack in ["N:", "N", ":"]:
-                    line = line.replace(haystack, " ")
-                linewords = line.split()
-                while len(linewords) != 0:
-                    try:
-                        toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
-                        break
-                    except:
-                        pass
-                self.clear = True
+            elif kind == LINE_RESEND:
+                toresend = line.resend
+                if toresend is not None:
+                    with self.send_cond:
+                        if (self.window is None
+                                or self.window.resend(toresend)):
+                            self.resendfrom = toresend
+                if resend_ok is False:
+                    self.clear = True
+                resend_requested = True
+        if self.window is not None:
+            # No reply will come anymore
+            self.window.reset()
         self.clear = True
         logging.debug('Exiting read thread')
 
@@ -352,20 +617,26 @@ class printcore():
     def _stop_sender(self):
         if self.send_thread:
             self.stop_send_thread = True
+            # Wake the send thread up
+            self.priqueue.put_nowait(None)
             self.send_thread.join()
             self.send_thread = None
 
     def _sender(self):
         while not self.stop_send_thread:
-            try:
-                command = self.priqueue.get(True, 0.1)
-            except QueueEmpty:
+            command = self.priqueue.get()
+            if command is None:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
-            self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            self._wait_clear()
+            # Commands wait while the connection is handed over
+            while not self.link_lock.acquire(timeout = 0.1):
+                if self.stop_send_thread:
+                    return
+            try:
+                self._send(command)
+            finally:
+                self.link_lock.release()
+            self._wait_clear()
 
     def _checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
@@ -383,7 +654,9 @@ class printcore():
         gcode : GCode
             A `printrun.gcoder.GCode` object containing the array of G-code
             commands. The print queue `mainqueue` will be replaced with the
-            contents of `gcode`.
+            contents of `gcode`. It may still be loading in another thread
+            (see `printrun.gcoder.GCode.prepare_iter`), in which case each
+            layer is printed as soon as it has been analyzed.
         startindex : int, default: 0
             The index from the `gcode` array from which the printing will be
             started.
@@ -395,14 +668,25 @@ class printcore():
             offline.
 
         """
-        if self.printing or not self.online or not self.printer:
+        if (self.printing or not self.online or not self.printer
+                or self.line_listener is not None):
             return False
         self.queueindex = startindex
         self.mainqueue = gcode
         self.printing = True
         self.lineno = 0
         self.resendfrom = -1
-        if not gcode or not gcode.lines:
+        self.sentlines = ResendBuffer(self.resend_buffer_size)
+        self.sent = deque(maxlen = self.sent_log_size)
+        self.sent_count = 0
+        self.sent_bytes = 0
+        self.batch.clear()
+        self.batched_lines = 0
+        self.batched_writes = 0
+        if self.window is not None:
+            self.window.reset()
+        # Waits for the first layer if gcode is still loading
+        if gcode is None or not gcode.has_index(0):
             return True
 
         self.clear = False
@@ -449,6 +733,7 @@ class printcore():
         if not self.printing: return False
         self.paused = True
         self.printing = False
+        self._stop_waiting()
 
         # ';@pause' in the gcode file calls pause from the print thread
         if not threading.current_thread() is self.print_thread:
@@ -550,20 +835,62 @@ class printcore():
         else:
             self._logError(_("Not connected to printer."))
 
+    def take_link(self, listener):
+        """Hand the connection over to another protocol.
+
+        Commands queued meanwhile are held back and the received lines are
+        passed to `listener` instead of being handled, until `release_link`
+        is called. The caller writes to `printer` directly.
+
+        Parameters
+        ----------
+        listener : callable
+            Called from the read thread with each received line.
+
+        Returns
+        -------
+        bool
+            False if printing, offline or already handed over.
+
+        """
+        if (self.printing or not self.online or not self.printer
+                or self.line_listener is not None):
+            return False
+        self.link_lock.acquire()
+        if self.printing or self.line_listener is not None:
+            self.link_lock.release()
+            return False
+        self.line_listener = listener
+        return True
+
+    def release_link(self):
+        """Take the connection back after `take_link`"""
+        self.line_listener = None
+        self.link_lock.release()
+
     def _print(self, resuming = False):
         self._stop_sender()
         try:
             self._callback('start', resuming)
+            if self.prepared_lines > 0:
+                self.wire_buffer = WireBuffer(
+                    self.mainqueue, self.queueindex, self.lineno,
+                    not self.printer.has_flow_control, self.prepared_lines)
+                self.wire_buffer.start()
             while self.printing and self.printer and self.online:
                 self._sendnext()
-            self.sentlines = {}
+            self._flush_batch()
+            self.sentlines.clear()
             self.log.clear()
-            self.sent = []
+            self.sent.clear()
             self._callback('end')
         except:
             self._logError(_("Print thread died due to the following error:") +
                            "\n" + traceback.format_exc())
         finally:
+            if self.wire_buffer is not None:
+                self.wire_buffer.stop()
+                self.wire_buffer = None
             self.print_thread = None
             self._start_sender()
 
@@ -572,11 +899,76 @@ class printcore():
         if command.startswith(";@pause"):
             self.pause()
 
+    def _windowed(self):
+        # Only wait for oks when using serial connections or when not using tcp
+        # in streaming mode
+        return (self.window is not None and self.printing and
+                (not self.printer.has_flow_control or
+                 not self.tcp_streaming_mode))
+
+    def _batching(self):
+        # Lines may only be held back when no acknowledgement is awaited
+        return (self.batch_size > 0 and self.printing and
+                self.tcp_streaming_mode and self.printer.has_flow_control)
+
+    def _write(self, data):
+        batch = self.batch
+        if self._batching():
+            if not batch:
+                self.batch_start = time.monotonic()
+            batch += data
+            self.batched_lines += 1
+            if (len(batch) < self.batch_size and
+                    time.monotonic() - self.batch_start < self.batch_latency):
+                return
+            data = bytes(batch)
+            batch.clear()
+            self.batched_writes += 1
+        elif batch:
+            # Keep the order of the lines held back
+            data = bytes(batch) + data
+            batch.clear()
+            self.batched_writes += 1
+        self.printer.write(data)
+
+    def _flush_batch(self):
+        if self.batch and self.printer:
+            data = bytes(self.batch)
+            self.batch.clear()
+            self.batched_writes += 1
+            try:
+                self.printer.write(data)
+            except device.DeviceError as e:
+                self._logError("Can't write to printer (disconnected?)"
+                              " {0}".format(e))
+                self.writefailures += 1
+
+    def _clear_to_send(self, nbytes = 1):
+        if self._windowed():
+            return self.window.has_room(nbytes)
+        return self.clear
+
+    def _stop_waiting(self):
+        # Wake up the print thread after unsetting `printing`
+        with self.send_cond:
+            self.send_cond.notify_all()
+
+    def _wait_clear(self, nbytes = 1):
+        # Block until a line of `nbytes` bytes can be sent or printing stops.
+        # `printing` may be unset from other modules without notification,
+        # hence the timeout.
+        if self.batch and not self._clear_to_send(nbytes):
+            # The lines held back may be the ones awaiting a reply
+            self._flush_batch()
+        with self.send_cond:
+            while (self.printer and self.printing and
+                   not self._clear_to_send(nbytes)):
+                self.send_cond.wait(0.1)
+
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
+        self._wait_clear()
         # Only wait for oks when using serial connections or when not using tcp
         # in streaming mode
         if not self.printer.has_flow_control or not self.tcp_streaming_mode:
@@ -585,14 +977,29 @@ class printcore():
             self.clear = True
             return
         if self.resendfrom < self.lineno and self.resendfrom > -1:
+            if self.resendfrom not in self.sentlines:
+                self._logError(_("Printer requested line %d again but it is "
+                                 "no longer kept, pausing print.")
+                               % self.resendfrom)
+                self.resendfrom = -1
+                self.pause()
+                return
             self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
             self.resendfrom += 1
             return
         self.resendfrom = -1
         if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
+            command = self.priqueue.get_nowait()
             self.priqueue.task_done()
+            # None is left to wake up the stopped send thread
+            if command is not None:
+                self._send(command)
+            else:
+                self.clear = True
             return
+        if self.batch and self.queueindex >= len(self.mainqueue):
+            # The next line may not be loaded yet
+            self._flush_batch()
         if self.printing and self.mainqueue.has_index(self.queueindex):
             (layer, line) = self.mainqueue.idxs(self.queueindex)
             gline = self.mainqueue.all_layers[layer][line]
@@ -605,6 +1012,7 @@ class printcore():
                 next_gline = self.mainqueue.all_layers[next_layer][next_line]
             else:
                 next_gline = None
+            queued_gline = gline
             gline = self._callback('printpresend', gline, next_gline,
                                    self.queueindex)
             if gline is None:
@@ -618,15 +1026,31 @@ class printcore():
                 self.clear = True
                 return
 
-            # Strip comments
-            tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
+            prepared = None
+            # Lines replaced by a printpresend handler are encoded here
+            if self.wire_buffer is not None and gline is queued_gline:
+                prepared = self.wire_buffer.get(self.queueindex, self.lineno,
+                                                tline)
+            if prepared is not None:
+                tline, command, data = prepared
+            else:
+                # Strip comments
+                tline = gcoder.gcode_strip_comment_exp.sub("", tline).strip()
+                command = tline
+                data = None
             if tline:
-                self._send(tline, self.lineno, True)
+                self._send(command, self.lineno, True, data, gline)
                 self.lineno += 1
                 self._callback('printsend', gline)
             else:
                 self.clear = True
             self.queueindex += 1
+        elif self._windowed() and len(self.window):
+            # Lines in flight may still be requested again
+            with self.send_cond:
+                while (self._windowed() and len(self.window) and
+                       self.resendfrom == -1):
+                    self.send_cond.wait(0.1)
         else:
             self.printing = False
             self.clear = True
@@ -635,28 +1059,44 @@ class printcore():
                 self.lineno = 0
                 self._send("M110 N-1", -1, True)
 
-    def _send(self, command, lineno = 0, calcchecksum = False):
+    def _send(self, command, lineno = 0, calcchecksum = False, data = None,
+              gline = None):
+        # `data` is given with commands already numbered by the WireBuffer,
+        # `gline` with print lines, already parsed when loaded
         # Only add checksums if over serial (tcp does the flow control itself)
         if calcchecksum and not self.printer.has_flow_control:
-            prefix = "N" + str(lineno) + " " + command
-            command = prefix + "*" + str(self._checksum(prefix))
+            if data is None:
+                prefix = "N" + str(lineno) + " " + command
+                command = prefix + "*" + str(self._checksum(prefix))
             if "M110" not in command:
                 self.sentlines[lineno] = command
         if self.printer:
             self.sent.append(command)
+            self.sent_count += 1
             # run the command through the analyzer
-            gline = None
             try:
-                gline = self.analyzer.append(command, store = False)
+                if gline is not None:
+                    gline = self.analyzer.advance(gline)
+                else:
+                    gline = self.analyzer.append(command, store = False)
             except:
+                gline = None
                 logging.warning(_("Could not analyze command %s:") % command +
                                 "\n" + traceback.format_exc())
             if self.loud:
                 logging.info("SENT: %s" % command)
 
             self._callback('send', command, gline)
+            if data is None:
+                data = (command + "\n").encode('ascii')
+            self.sent_bytes += len(data)
+            if self._windowed():
+                # Wait for the line to fit in the firmware receive buffer
+                self._wait_clear(len(data))
+                numbered = calcchecksum or command.startswith("N")
+                self.window.sent(len(data), lineno if numbered else None)
             try:
-                self.printer.write((command + "\n").encode('ascii'))
+                self._write(data)
                 self.writefailures = 0
             except device.DeviceError as e:
                 self._logError("Can't write to printer (disconnected?)"
@@ -682,6 +1122,8 @@ class printcore():
                 except Exception:
                     logging.error(f"'on_{name}' handler failed with:\n"
                                   f"{traceback.format_exc()}")
+        if self.event_bus.wants(name):
+            self.event_bus.publish(name, args)
 
         # Invoke the relevant callback function
         # TODO[v3]: Remove code kept for backwards compatibility
@@ -721,6 +1163,328 @@ class printcore():
         return self.preprintsendcb(gline, next_gline)
 
 
+class SendWindow():
+    """Lines sent to the printer that were not acknowledged yet.
+
+    Instead of waiting for an "ok" after every line, up to `size` lines are
+    kept in flight so that the firmware planner never runs dry while the
+    reply to the previous line travels back. The lines in flight never take
+    more than `rx_buffer_size` bytes, so that they fit in the firmware
+    receive buffer whatever the number of queued commands.
+
+    With a `size` of 0, the window starts at 2 lines and grows to the size of
+    the firmware command buffer, as reported by the "B" field of Marlin
+    ADVANCED_OK replies such as "ok N1234 P15 B3".
+
+    A line rejected by the firmware is requested again with "Resend: N",
+    after which the firmware drops the lines sent after it. Each of those may
+    trigger another request for the same line, these are ignored. Every
+    request is assumed to be followed by an "ok" which acknowledges nothing.
+
+    Parameters
+    ----------
+    size : int, default: 0
+        Maximum number of lines in flight, 0 to tune it automatically.
+    rx_buffer_size : int, default: 128
+        Size in bytes of the firmware receive buffer.
+    lock : threading.Condition, optional
+        Condition protecting the window, notified when lines are
+        acknowledged. A new one is created by default.
+
+    Attributes
+    ----------
+    planner_free : int
+        Free planner blocks in the last ADVANCED_OK reply, or None.
+    buffer_free : int
+        Free command buffer slots in the last ADVANCED_OK reply, or None.
+
+    """
+
+    AUTO_SIZE = 2
+    MAX_SIZE = 64
+
+    def __init__(self, size = 0, rx_buffer_size = 128, lock = None):
+        self.auto = size <= 0
+        self.size = self.AUTO_SIZE if self.auto else size
+        self.rx_buffer_size = rx_buffer_size
+        self.lock = threading.Condition() if lock is None else lock
+        self.reset()
+
+    def reset(self):
+        """Forget about the lines in flight"""
+        with self.lock:
+            # (line number or None, bytes) of each line in flight
+            self.pending = deque()
+            self.used = 0
+            self.skip_oks = 0
+            self.last_resend = None
+            self.ignored_resends = 0
+            self.rewinding = False
+            self.planner_free = None
+            self.buffer_free = None
+            self.lock.notify_all()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def has_room(self, nbytes = 1):
+        """Check whether a line of `nbytes` bytes can be sent now"""
+        with self.lock:
+            # A line longer than the buffer is still sent once alone
+            if not self.pending:
+                return True
+            return (len(self.pending) < self.size and
+                    self.used + nbytes <= self.rx_buffer_size)
+
+    def sent(self, nbytes, lineno = None):
+        """Record a line written to the printer"""
+        with self.lock:
+            self.pending.append((lineno, nbytes))
+            self.used += nbytes
+            if self.rewinding and lineno is not None:
+                if lineno == self.last_resend:
+                    self.rewinding = False
+                elif lineno > self.last_resend:
+                    # Picked before the request arrived, will be dropped too
+                    self.ignored_resends += 1
+
+    def ack(self, line):
+        """Acknowledge the oldest line in flight from an "ok" reply"""
+        lineno = None
+        for word in line.split()[1:]:
+            field, value = word[:1], word[1:]
+            if not value.isdigit():
+                continue
+            if field == "N":
+                lineno = int(value)
+            elif field == "P":
+                self.planner_free = int(value)
+            elif field == "B":
+                self.buffer_free = int(value)
+        with self.lock:
+            if self.auto and self.buffer_free is not None:
+                # The acknowledged command still holds one buffer slot
+                self.size = max(self.size,
+                                min(self.buffer_free + 1, self.MAX_SIZE))
+            if self.skip_oks:
+                self.skip_oks -= 1
+                return
+            if lineno is not None and \
+               any(n == lineno for n, _ in self.pending):
+                # Replies to lines before this one were lost
+                while self.pending:
+                    n, nbytes = self.pending.popleft()
+                    self.used -= nbytes
+                    if n == lineno:
+                        break
+            elif self.pending:
+                self.used -= self.pending.popleft()[1]
+            self.lock.notify_all()
+
+    def resend(self, lineno):
+        """Handle a resend request, returns False if it must be ignored"""
+        with self.lock:
+            self.skip_oks += 1
+            if self.ignored_resends and lineno == self.last_resend:
+                self.ignored_resends -= 1
+                return False
+            self.ignored_resends = sum(1 for n, _ in self.pending
+                                       if n is not None and n > lineno)
+            self.last_resend = lineno
+            self.rewinding = True
+            self.pending.clear()
+            self.used = 0
+            self.lock.notify_all()
+            return True
+
+
+class WireBuffer():
+    """Print lines encoded for the printer ahead of the send loop.
+
+    A producer thread strips the comments of the upcoming lines of a print,
+    numbers them and adds their checksums, so that sending a line takes no
+    more than writing ready bytes. Lines are numbered as if each non-empty
+    line was sent in turn. When the line number differs at send time, after
+    a line was skipped or replaced by a callback, the line is renumbered
+    from the checksum of its text, the checksum of a numbered line being
+    that of its "N<lineno> " prefix XOR that of the text.
+
+    Parameters
+    ----------
+    gcode : GCode
+        The G-code being printed.
+    index : int, default: 0
+        Index in `gcode` of the next line to send.
+    lineno : int, default: 0
+        Line number of the next line to send.
+    checksum : bool, default: True
+        Number lines and add their checksums, False for connections doing
+        their own flow control.
+    ahead : int, default: 256
+        Maximum number of lines encoded in advance.
+
+    """
+
+    def __init__(self, gcode, index = 0, lineno = 0, checksum = True,
+                 ahead = 256):
+        self.gcode = gcode
+        self.checksum = checksum
+        self.ahead = ahead
+        # (index, raw line, text, text checksum, lineno, command, data)
+        self.entries = deque()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+        self._next = (index, lineno)
+
+    def start(self):
+        """Start encoding lines in a background thread"""
+        self.running = True
+        self.thread = threading.Thread(target = self._produce,
+                                       name = 'wire buffer thread',
+                                       daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the producer thread, without waiting for it"""
+        with self.cond:
+            self.running = False
+            self.entries.clear()
+            self.cond.notify_all()
+
+    def _produce(self):
+        index, lineno = self._next
+        gcode = self.gcode
+        while True:
+            with self.cond:
+                while self.running and len(self.entries) >= self.ahead:
+                    self.cond.wait()
+                if not self.running:
+                    return
+            # Waits for the line if the G-code is still loading
+            if not gcode.has_index(index):
+                return
+            layer, line = gcode.idxs(index)
+            gline = gcode.all_layers[layer][line]
+            entry = self._encode(index, gline, lineno)
+            with self.cond:
+                if not self.running:
+                    return
+                self.entries.append(entry)
+            index += 1
+            if entry[2]:
+                lineno += 1
+
+    def _encode(self, index, gline, lineno):
+        raw = gline.raw
+        text = gcoder.gcode_strip_comment_exp.sub("", raw).strip()
+        if not text:
+            return (index, raw, text, 0, lineno, text, None)
+        try:
+            encoded = text.encode('ascii')
+        except UnicodeEncodeError:
+            # Left to the send loop to report
+            return (index, raw, text, 0, lineno, None, None)
+        if not self.checksum:
+            return (index, raw, text, 0, lineno, text, encoded + b"\n")
+        text_checksum = reduce(xor, encoded, 0)
+        command, data = self._number(text, text_checksum, lineno)
+        return (index, raw, text, text_checksum, lineno, command, data)
+
+    def _number(self, text, text_checksum, lineno):
+        prefix = "N%d " % lineno
+        checksum = reduce(xor, prefix.encode('ascii'), text_checksum)
+        command = "%s%s*%d" % (prefix, text, checksum)
+        return command, (command + "\n").encode('ascii')
+
+    def get(self, index, lineno, raw):
+        """The encoded line `index` of the G-code, numbered `lineno`.
+
+        Lines are matched by index and text rather than by object, since
+        the lines of mapped or packed G-code are new objects on each access.
+        A line edited since it was encoded is not used.
+
+        Parameters
+        ----------
+        index : int
+            Index of the line in the G-code.
+        lineno : int
+            Number to send the line with.
+        raw : str
+            Text of the line to send, as read from the G-code.
+
+        Returns
+        -------
+        tuple or None
+            The text of the line without comments, the command to send and
+            its bytes, or None if the line is not ready.
+
+        """
+        with self.cond:
+            entries = self.entries
+            while entries and entries[0][0] < index:
+                entries.popleft()
+            if not entries or entries[0][0] != index:
+                return None
+            entry = entries.popleft()
+            self.cond.notify_all()
+        _, expected_raw, text, text_checksum, expected_lineno, command, \
+            data = entry
+        if raw != expected_raw or command is None:
+            return None
+        if data is not None and self.checksum and lineno != expected_lineno:
+            command, data = self._number(text, text_checksum, lineno)
+        return text, command, data
+
+
+class ResendBuffer():
+    """The last numbered lines sent to the printer, by line number.
+
+    Lines are stored in a ring of `size` slots indexed by line number, so
+    that memory does not grow during a print and lookups take constant time.
+    A line is overwritten by the line numbered `size` after it, so `size`
+    must exceed the number of lines the firmware may still request again.
+
+    Parameters
+    ----------
+    size : int, default: 1024
+        Number of lines kept.
+
+    """
+
+    def __init__(self, size = 1024):
+        if size < 1:
+            raise ValueError("size must be positive")
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        """Forget all lines"""
+        self._numbers = [-1] * self.size
+        self._commands = [None] * self.size
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, lineno):
+        return lineno >= 0 and self._numbers[lineno % self.size] == lineno
+
+    def __getitem__(self, lineno):
+        if lineno not in self:
+            raise KeyError(lineno)
+        return self._commands[lineno % self.size]
+
+    def __setitem__(self, lineno, command):
+        if lineno < 0:
+            raise KeyError(lineno)
+        slot = lineno % self.size
+        if self._numbers[slot] == -1:
+            self._count += 1
+        self._numbers[slot] = lineno
+        self._commands[slot] = command
+
+
 class Callback():
     """Printcore callback functions.
 
@@ -823,6 +1587,20 @@ class Callback():
         """
         return gline
 
+    def position(self, line):
+        """Called on position reports of the printer.
+
+        Called on replies to M114 as well as on reports the firmware sends on
+        its own. See `printrun.printcore.printcore.autoreport_interval`.
+
+        Parameters
+        ----------
+        line : ReceivedLine
+            String with data read from the printer.
+
+        """
+        pass
+
     def printsend(self, gline):
         """Called on each line sent during a print.
 
@@ -843,8 +1621,9 @@ class Callback():
 
         Parameters:
         -----------
-        line : str
-            String with data read from the printer.
+        line : ReceivedLine
+            String with data read from the printer, classified by
+            `classify_line`.
 
         """
         pass
@@ -41,7 +41,8 @@ from .utils import install_locale, run_command, get_command_output, \
 install_locale('pronterface')
 from .settings import Settings, BuildDimensionsSetting
 from .power import powerset_print_start, powerset_print_stop
-from printrun import gcoder
+from printrun import gcoder, gcoder_cache, gcoder_shared, gcoder_timing
+from printrun import sdupload
 from .rpc import ProntRPC
 from printrun.spoolmanager import spoolmanager
 
@@ -59,12 +60,11 @@ try:
 except ImportError:
     READLINE = False  # neither readline module is available
 
-tempreading_exp = re.compile(r'\\bT\d*:')
-
 REPORT_NONE = 0
 REPORT_POS = 1
 REPORT_TEMP = 2
 REPORT_MANUAL = 4
+REPORT_SD = 8
 DEG = "\N{DEGREE SIGN}"
 
 class Status:
@@ -166,7 +166,8 @@ class pronsole(cmd.Cmd):
         self.sdfiles = []
         self.paused = False
         self.sdprinting = 0
-        self.uploading = 0  # Unused, just for pronterface generalization
+        self.uploading = False
+        self.upload = None  # SDUpload until finished or cancelled
         self.temps = {"PLA": "185", "ABS": "230", "Off": "0"}
         self.bedtemps = {"PLA": "60", "ABS": "110", "Off": "0"}
         self.percentdone = 0
@@ -184,6 +185,8 @@ class pronsole(cmd.Cmd):
         self.settings._port_list = self.scanserial
         self.update_build_dimensions(None, self.settings.build_dimensions)
         self.update_tcp_streaming_mode(None, self.settings.tcp_streaming_mode)
+        self.update_send_window(None, None)
+        self.update_autoreport(None, None)
         self.monitoring = 0
         self.starttime = 0
         self.extra_print_time = 0
@@ -721,6 +724,15 @@ Disables all heaters upon exit."))
 
     def update_tcp_streaming_mode(self, param, value):
         self.p.tcp_streaming_mode = self.settings.tcp_streaming_mode
+        self.p.batch_size = self.settings.tcp_batch_size
+        self.p.batch_latency = self.settings.tcp_batch_latency / 1000
+
+    def update_send_window(self, param, value):
+        self.p.window_size = self.settings.window_size
+        self.p.rx_buffer_size = self.settings.rx_buffer_size
+
+    def update_autoreport(self, param, value):
+        self.p.autoreport_interval = self.settings.autoreport_interval
 
     def update_rpc_server(self, param, value):
         if value:
@@ -894,12 +906,17 @@ Disables all heaters upon exit."))
                 self.status_thread = None
                 self.p.disconnect()
                 return
-            if do_monitoring:
-                if self.sdprinting and not self.paused:
+            # Polling commands would end up in the file being uploaded
+            if do_monitoring and not self.uploading:
+                # Only poll what the firmware does not report on its own
+                autoreports = self.p.autoreports
+                if self.sdprinting and not self.paused \
+                   and printcore.LINE_SD_STATUS not in autoreports:
                     self.p.send_now("M27")
-                if self.m105_waitcycles % 10 == 0:
-                    self.p.send_now("M105")
-                self.m105_waitcycles += 1
+                if printcore.LINE_TEMP not in autoreports:
+                    if self.m105_waitcycles % 10 == 0:
+                        self.p.send_now("M105")
+                    self.m105_waitcycles += 1
         cur_time = time.time()
         wait_time = 0
         while time.time() < cur_time + self.monitor_interval - 0.25:
@@ -939,13 +956,45 @@ Disables all heaters upon exit."))
         self.log(_("Estimated duration: %d layers, %s") % self.fgcode.estimate_duration())
 
     def load_gcode(self, filename, layer_callback = None, gcode = None):
-        if gcode is None:
-            self.fgcode = gcoder.LightGCode(deferred = True)
+        if gcode is None and self.settings.shared_gcode:
+            self.load_shared_gcode(filename, layer_callback)
+            return
+        if gcode is None and self.settings.mmap_gcode:
+            self.fgcode = gcoder.MappedGCode(deferred = True)
+        elif gcode is None:
+            self.fgcode = gcoder.LightGCode(deferred = True,
+                                            columnar = self.settings.columnar_analysis)
         else:
             self.fgcode = gcode
-        self.fgcode.prepare(open(filename, "r", encoding="utf-8"),
-                            get_home_pos(self.build_dimensions_list),
-                            layer_callback = layer_callback)
+        home_pos = get_home_pos(self.build_dimensions_list)
+        cache = gcoder_cache.AnalysisCache(self.cache_dir / "gcode",
+                                           self.settings.gcode_cache_size * 1024 * 1024)
+        if not cache.load(self.fgcode, filename, home_pos, layer_callback):
+            self.fgcode.prepare(open(filename, "r", encoding="utf-8"),
+                                home_pos, layer_callback = layer_callback)
+            if not self.fgcode.cancelled:
+                cache.store(self.fgcode, filename, home_pos)
+        if self.settings.accurate_time_estimate and not self.fgcode.cancelled:
+            limits = gcoder_timing.MachineLimits.from_commands(self.settings.machine_limits)
+            gcoder_timing.TimeEstimator(limits).estimate(self.fgcode)
+        self.fgcode.estimate_duration()
+        self.filename = filename
+
+    def load_shared_gcode(self, filename, layer_callback = None):
+        """Load a file parsed once for all the hosts sharing cache_dir"""
+        analyze = analyzer_key = None
+        if self.settings.accurate_time_estimate:
+            limits = gcoder_timing.MachineLimits.from_commands(self.settings.machine_limits)
+            analyze = gcoder_timing.TimeEstimator(limits).estimate
+            analyzer_key = vars(limits)
+        store = gcoder_shared.JobStore(self.cache_dir / "jobs",
+                                       self.settings.gcode_cache_size * 1024 * 1024)
+        self.fgcode = store.open(filename,
+                                 get_home_pos(self.build_dimensions_list),
+                                 analyze, analyzer_key)
+        if layer_callback:
+            for layer_id in range(self.fgcode.append_layer_id):
+                layer_callback(self.fgcode, layer_id)
         self.fgcode.estimate_duration()
         self.filename = filename
 
@@ -1015,6 +1064,17 @@ Disables all heaters upon exit."))
 
     def do_upload(self, l):
         names = l.split()
+        if names in (["resume"], ["cancel"]):
+            if self.upload is None:
+                self.logError(_("No upload to resume or cancel."))
+            elif names[0] == "cancel":
+                self.upload.cancel()
+                self._watch_upload()
+            elif not self.upload.resume():
+                self.logError(_("The upload is already running."))
+            else:
+                self._watch_upload()
+            return
         if len(names) == 2:
             filename = names[0]
             targetname = names[1]
@@ -1024,37 +1084,56 @@ Disables all heaters upon exit."))
         if not self.p.online:
             self.logError(_("Not connected to printer."))
             return
-        self._do_load(filename)
-        self.log(_("Uploading as %s") % targetname)
-        self.log(_("Uploading %s") % self.filename)
-        self.p.send_now("M28 " + targetname)
-        self.log(_("Press Ctrl-C to interrupt upload."))
-        self.p.startprint(self.fgcode)
+        if self.upload is not None:
+            self.logError(_("An upload is already ongoing, resume or cancel it first."))
+            return
         try:
-            sys.stdout.write(_("Progress: ") + "00.0%")
-            sys.stdout.flush()
-            while self.p.printing:
-                time.sleep(0.5)
-                sys.stdout.write("\b\b\b\b\b%04.1f%%" % (100 * float(self.p.queueindex) / len(self.p.mainqueue),))
-                sys.stdout.flush()
-            self.p.send_now("M29 " + targetname)
-            time.sleep(0.2)
-            self.p.clear = True
-            self._do_ls(False)
-            self.log("\b\b\b\b\b100%.")
-            self.log(_("Upload completed. %s should now be on the card.") % targetname)
+            with open(filename, errors = "replace") as f:
+                upload = sdupload.SDUpload(self.p, f, targetname,
+                                           None if self.settings.sd_binary_upload else False)
+        except OSError as e:
+            self.logError(_("Could not read %s: %s") % (filename, e))
             return
-        except (KeyboardInterrupt, Exception) as e:
-            if isinstance(e, KeyboardInterrupt):
-                self.logError(_("...interrupted!"))
+        self.log(_("Uploading %s as %s (%d bytes without comments)")
+                 % (filename, targetname, upload.size))
+        self.upload = upload
+        self.uploading = True
+        upload.start()
+        self._watch_upload()
+
+    def _watch_upload(self):
+        upload = self.upload
+        self.log(_("Press Ctrl-C to pause the upload."))
+        try:
+            while not upload.wait(0.5) and upload.state != sdupload.PAUSED:
+                eta = upload.eta
+                sys.stdout.write("\r" + _("Progress: %04.1f%%, %.1f kB/s, %s left ")
+                                 % (100 * upload.progress, upload.rate / 1000,
+                                    format_duration(eta) if eta is not None else "?"))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            upload.pause()
+        sys.stdout.write("\n")
+        if upload.state == sdupload.PAUSED:
+            self.logError(_("Upload paused at %04.1f%%, %s is still open on the card.")
+                          % (100 * upload.progress, upload.target))
+            self.logError(_("Use upload resume or upload cancel."))
+        elif upload.state == sdupload.INTERRUPTED:
+            self.logError(_("Upload interrupted at %04.1f%%: %s")
+                          % (100 * upload.progress, upload.error))
+            self.logError(_("Use upload resume or upload cancel."))
+        else:
+            self.upload = None
+            self.uploading = False
+            if upload.state == sdupload.DONE:
+                if upload.binary:
+                    self.log(_("Sent with the binary protocol%s.")
+                             % (_(", compressed") if upload.compression else ""))
+                self.p.clear = True
+                self._do_ls(False)
+                self.log(_("Upload completed. %s should now be on the card.") % upload.target)
             else:
-                self.logError(_("Something wrong happened while uploading:")
-                              + "\n" + traceback.format_exc())
-            self.p.pause()
-            self.p.send_now("M29 " + targetname)
-            time.sleep(0.2)
-            self.p.cancelprint()
-            self.logError(_("A partial file named %s may have been written to the sd card.") % targetname)
+                self.logError(_("A partial file named %s may have been written to the sd card.") % upload.target)
 
     def complete_upload(self, text, line, begidx, endidx):
         s = line.split()
@@ -1067,7 +1146,11 @@ Disables all heaters upon exit."))
                 return glob.glob("*/") + glob.glob("*.g*")
 
     def help_upload(self):
-        self.log(_("Uploads a gcode file to the sd card"))
+        self.log(_("Uploads a gcode file to the sd card, without its comments"))
+        self.log(_("upload file.gcode TARGET.GCO - upload file.gcode as TARGET.GCO"))
+        self.log(_("upload resume - resume a paused or interrupted upload"))
+        self.log(_("upload cancel - stop the upload, leaving a partial file"))
+        self.log(_("Marlin firmwares built with BINARY_FILE_TRANSFER get the file compressed, see the sd_binary_upload setting."))
 
     def help_print(self):
         if not self.fgcode:
@@ -1212,6 +1295,9 @@ Disables all heaters upon exit."))
     #  --------------------------------------------------------------
 
     def startcb(self, resuming = False):
+        if self.upload is not None:
+            # Text uploads go through the print pipeline but are no prints
+            return
         self.starttime = time.time()
         if resuming:
             self.log(_("Print resumed at: %s") % format_time(self.starttime))
@@ -1236,6 +1322,8 @@ Disables all heaters upon exit."))
                           + "\n" + traceback.format_exc())
 
     def endcb(self):
+        if self.upload is not None:
+            return
         try:
             powerset_print_stop()
         except:
@@ -1272,26 +1360,35 @@ Disables all heaters upon exit."))
                 self.log(_("Final command output:"))
                 self.log(output.rstrip())
 
-    def recvcb_report(self, l):
+    def recvcb_report(self, l, kind = None):
+        if kind is None:
+            kind = printcore.classify_line(l).kind
         isreport = REPORT_NONE
-        if "ok C:" in l or " Count " in l \
-           or ("X:" in l and len(gcoder.m114_exp.findall(l)) == 6):
+        if kind == printcore.LINE_POSITION:
             self.posreport = l
             isreport = REPORT_POS
             if self.userm114 > 0:
                 self.userm114 -= 1
                 isreport |= REPORT_MANUAL
-        if "ok T:" in l or tempreading_exp.findall(l):
+        elif kind in (printcore.LINE_OK_TEMP, printcore.LINE_TEMP):
             self.tempreadings = l
             isreport = REPORT_TEMP
-            if self.userm105 > 0:
+            # Reports sent on their own do not answer M105
+            if self.userm105 > 0 and (kind == printcore.LINE_OK_TEMP or
+                                      printcore.LINE_TEMP not in self.p.autoreports):
                 self.userm105 -= 1
                 isreport |= REPORT_MANUAL
             else:
                 self.m105_waitcycles = 0
+        elif kind == printcore.LINE_SD_STATUS \
+                and printcore.LINE_SD_STATUS in self.p.autoreports:
+            # Polled SD status replies are still shown
+            isreport = REPORT_SD
         return isreport
 
-    def recvcb_actions(self, l):
+    def recvcb_actions(self, l, kind = None):
+        if kind is not None and kind != printcore.LINE_ACTION:
+            return False
         if l.startswith("!!"):
             self.do_pause(None)
             msg = l.split(" ", 1)
@@ -1325,15 +1422,18 @@ Disables all heaters upon exit."))
         return False
 
     def recvcb(self, l):
+        # Lines from printcore are already classified
+        kind = getattr(l, "kind", None)
         l = l.rstrip()
         for listener in self.recvlisteners:
             listener(l)
-        if not self.recvcb_actions(l):
-            report_type = self.recvcb_report(l)
+        if not self.recvcb_actions(l, kind):
+            report_type = self.recvcb_report(l, kind)
             if report_type & REPORT_TEMP:
                 self.status.update_tempreading(l)
-            if not self.lineignorepattern.match(l) and l[:4] != "wait" and not self.sdlisting \
-               and not self.monitoring and (report_type == REPORT_NONE or report_type & REPORT_MANUAL):
+            if (report_type == REPORT_NONE or report_type & REPORT_MANUAL) \
+               and not self.sdlisting and not self.monitoring and l[:4] != "wait" \
+               and not self.lineignorepattern.match(l):
                 if l[:5] == "echo:":
                     l = l[5:].lstrip()
                 if self.silent is False: self.log("\r" + l.ljust(15))
@@ -1349,6 +1449,10 @@ Disables all heaters upon exit."))
             self.compute_eta.update_layer(newlayer, secondselapsed)
 
     def get_eta(self):
+        if self.upload is not None:
+            secondsremain = self.upload.eta or 0
+            progress = self.upload.progress
+            return secondsremain, secondsremain / max(1 - progress, 0.000001), progress
         if self.sdprinting or self.uploading:
             if self.uploading:
                 fractioncomplete = float(self.p.queueindex) / len(self.p.mainqueue)
@@ -58,9 +58,6 @@ if os.name == "nt":
 
 pronterface_quitting = False
 
-class PronterfaceQuitException(Exception):
-    pass
-
 
 from .gui import MainWindow
 from .settings import wxSetting, HiddenSetting, StringSetting, SpinSetting, \
@@ -399,6 +396,8 @@ class PronterWindow(MainWindow, pronsole.pronsole):
         pronsole.pronsole.kill(self)
         global pronterface_quitting
         pronterface_quitting = True
+        if self.loading_gcode and self.fgcode is not None:
+            self.fgcode.cancel()
         self.p.callback.recv = None
         self.p.disconnect()
         if hasattr(self, "feedrates_changed"):
@@ -1690,24 +1689,31 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.load_gcode(self.filename,
                             layer_callback = self.layer_ready_cb,
                             gcode = gcode)
-        except PronterfaceQuitException:
-            return
         except Exception as e:
             self.log(str(e))
             wx.CallAfter(self.post_gcode_load, False, True)
             return
+        if gcode.cancelled:
+            return
         wx.CallAfter(self.post_gcode_load)
 
     def layer_ready_cb(self, gcode, layer):
         global pronterface_quitting
         if pronterface_quitting:
-            raise PronterfaceQuitException
+            gcode.cancel()
+            return
+        if layer == 0 and self.p.online:
+            # Printing can start with the layers loaded so far
+            wx.CallAfter(self.printbtn.Enable)
         if not self.settings.refreshwhenloading:
             return
         self.viz_last_layer = layer
         if time.time() - self.viz_last_yield > 1.0:
             time.sleep(0.2)
-            self.loading_gcode_message = _("Loading %s: %d layers loaded (%d lines)") % (self.filename, layer + 1, len(gcode))
+            if gcode.bytes_total:
+                self.loading_gcode_message = _("Loading %s: %d%%, %d layers loaded (%d lines)") % (self.filename, 100 * gcode.bytes_processed // gcode.bytes_total, layer + 1, len(gcode))
+            else:
+                self.loading_gcode_message = _("Loading %s: %d layers loaded (%d lines)") % (self.filename, layer + 1, len(gcode))
             self.viz_last_yield = time.time()
             wx.CallAfter(self.statusbar.SetStatusText, self.loading_gcode_message)
 
@@ -1717,10 +1723,15 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
     def pre_gcode_load(self):
         self.loading_gcode = True
         self.loading_gcode_message = _("Loading %s...") % self.filename
-        if self.settings.mainviz == "None":
-            gcode = gcoder.LightGCode(deferred = True)
+        if self.settings.mainviz == "None" and self.settings.mmap_gcode:
+            gcode = gcoder.MappedGCode(deferred = True)
+        elif self.settings.mainviz == "None":
+            gcode = gcoder.LightGCode(deferred = True, columnar = self.settings.columnar_analysis)
+        elif self.settings.packed_gcode:
+            gcode = gcoder.PackedGCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion)
         else:
-            gcode = gcoder.GCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion)
+            gcode = gcoder.GCode(deferred = True, cutting_as_extrusion = self.settings.cutting_as_extrusion,
+                                 columnar = self.settings.columnar_analysis)
         self.viz_last_yield = 0
         self.viz_last_layer = -1
         self.start_viz_thread(gcode)
@@ -1736,10 +1747,12 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
             self.statusbar.SetStatusText(message)
             self.savebtn.Enable(True)
         self.loadbtn.SetLabel(_("Load File"))
-        self.printbtn.SetLabel(_("&Print"))
-        self.pausebtn.SetLabel(_("&Pause"))
-        self.pausebtn.Disable()
-        self.recoverbtn.Disable()
+        if not self.p.printing:
+            # Unless printing started while loading
+            self.printbtn.SetLabel(_("&Print"))
+            self.pausebtn.SetLabel(_("&Pause"))
+            self.pausebtn.Disable()
+            self.recoverbtn.Disable()
         if not failed and self.p.online:
             self.printbtn.Enable()
         self.toolbarsizer.Layout()
@@ -2052,7 +2065,9 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         if y is not None: self.current_pos[1] = y
         if z is not None: self.current_pos[2] = z
 
-    def recvcb_actions(self, l):
+    def recvcb_actions(self, l, kind = None):
+        if kind is not None and kind != printcore.LINE_ACTION:
+            return False
         if l.startswith("!!"):
             if not self.paused:
                 wx.CallAfter(self.pause)
@@ -2082,16 +2097,17 @@ Printrun. If not, see <http://www.gnu.org/licenses/>."""
         return False
 
     def recvcb(self, l):
+        kind = getattr(l, "kind", None)
         l = l.rstrip()
-        if not self.recvcb_actions(l):
-            report_type = self.recvcb_report(l)
+        if not self.recvcb_actions(l, kind):
+            report_type = self.recvcb_report(l, kind)
             isreport = report_type != REPORT_NONE
             if report_type & REPORT_POS:
                 self.update_pos()
             elif report_type & REPORT_TEMP:
                 wx.CallAfter(self.tempdisp.SetLabel, self.tempreadings.strip().replace("ok ", ""))
                 self.update_tempdisplay()
-            if not self.lineignorepattern.match(l) and not self.p.loud and (l not in ["ok", "wait"] and (not isreport or report_type & REPORT_MANUAL)):
+            if (not isreport or report_type & REPORT_MANUAL) and not self.p.loud and l not in ["ok", "wait"] and not self.lineignorepattern.match(l):
                 self.log(l)
         for listener in self.recvlisteners:
             listener(l)
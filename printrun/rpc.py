@@ -13,57 +13,322 @@
 # You should have received a copy of the GNU General Public License
 # along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
 
-from xmlrpc.server import SimpleXMLRPCServer
-from threading import Thread
-import socket
+"""JSON over HTTP status and control API of pronsole and pronterface.
+
+Requests are served by an asyncio server running in its own thread:
+
+- ``GET /status`` returns the print status as a JSON object.
+- ``POST /<function>`` calls one of the control functions (``settemp``,
+  ``load_file``, ``startprint``, ``send``...) with the arguments given as
+  a JSON object, such as ``{"command": "M105"}``, and returns
+  ``{"result": ...}``. Requests must have the ``application/json`` content
+  type, which web pages can't send to another site without its consent.
+- ``GET /events`` is a stream of server-sent events: a ``status`` snapshot,
+  then ``temp``, ``progress``, ``layer``, ``start`` and ``end`` events as
+  they happen.
+
+The status is kept up to date from printcore events, so that serving it
+does not parse temperature reports or wait for the printer. Connections
+are kept alive between requests.
+"""
+
+import asyncio
+import errno
+import inspect
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from threading import Thread
 
+from .eventhandler import PrinterEventHandler
 from .utils import install_locale, parse_temperature_report
 install_locale('pronterface')
 
 RPC_PORT = 7978
+# Events waiting for a slow stream client, older ones are dropped
+EVENT_QUEUE_SIZE = 256
+MAX_BODY_SIZE = 1 << 20
+
+class RPCEventHandler(PrinterEventHandler):
+    """Forwards the printcore events to the event loop of a `ProntRPC`
+
+    Subscribed to the event bus of the printcore, and so called from its
+    dispatcher thread, which only hands the events over.
+    """
+
+    def __init__(self, rpc):
+        super().__init__()
+        self.rpc = rpc
+        self.progress = None
+
+    def on_temp(self, line):
+        self.rpc.post(self.rpc.update_temps, line)
+
+    def on_layerchange(self, layer):
+        gcode = self.rpc.pronsole.p.mainqueue
+        try:
+            z = gcode.all_layers[layer].z
+        except (AttributeError, IndexError):
+            z = None
+        self.rpc.post(self.rpc.update_layer, layer, z)
+
+    def on_printsend(self, gline):
+        core = self.rpc.pronsole.p
+        gcode = core.mainqueue
+        if not gcode:
+            return
+        # Only whole percents are worth an event
+        progress = 100 * core.queueindex // len(gcode)
+        if progress != self.progress:
+            self.progress = progress
+            self.rpc.post(self.rpc.publish, "progress",
+                          {"progress": progress})
+
+    def on_start(self, resume):
+        self.progress = None
+        self.rpc.post(self.rpc.publish, "start", {"resume": resume})
+
+    def on_end(self):
+        self.rpc.post(self.rpc.publish, "end", {})
 
 class ProntRPC:
+    """HTTP server of a pronsole, see the module documentation.
+
+    The server tries the following ports if `port` is in use, `port` is
+    then the one used.
+    """
 
     server = None
 
-    def __init__(self, pronsole, port = RPC_PORT):
+    def __init__(self, pronsole, port = RPC_PORT, host = "localhost"):
         self.pronsole = pronsole
+        self.functions = {
+            'status': self.get_status,
+            'settemp': self.set_extruder_temperature,
+            'setbedtemp': self.set_bed_temperature,
+            'load_file': self.load_file,
+            'startprint': self.startprint,
+            'pauseprint': self.pauseprint,
+            'resumeprint': self.resumeprint,
+            'sendhome': self.sendhome,
+            'connect': self.connect,
+            'disconnect': self.disconnect,
+            'send': self.send,
+        }
+        self.temps = None
+        if pronsole.tempreadings:
+            self.temps = parse_temperature_report(pronsole.tempreadings)
+        self.layer = None
+        # Bumped on each event, see `status_body`
+        self.version = 0
+        self._status = (None, None)
+        self._streams = set()
+        self._clients = set()
+        # Control functions run one after the other, as they used to
+        self._executor = ThreadPoolExecutor(max_workers = 1)
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target = self.run_server, name = 'rpc server')
+        self.thread.start()
+        try:
+            self.server = asyncio.run_coroutine_threadsafe(
+                self._bind(host, port), self.loop).result()
+        except Exception:
+            self._stop()
+            raise
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.handler = RPCEventHandler(self)
+        # Called from the dispatcher thread of the bus, never delaying the
+        # communication with the printer
+        pronsole.p.event_bus.add_handler(self.handler)
+
+    async def _bind(self, host, port):
         used_port = port
         while True:
             try:
-                self.server = SimpleXMLRPCServer(("localhost", used_port),
-                                                 allow_none = True,
-                                                 logRequests = False)
-                if used_port != port:
-                    logging.warning(_("RPC server bound on non-default port %d") % used_port)
-                break
-            except socket.error as e:
-                if e.errno == 98:
+                server = await asyncio.start_server(self._serve_client,
+                                                    host, used_port)
+            except OSError as e:
+                if e.errno == errno.EADDRINUSE:
                     used_port += 1
                     continue
-                else:
-                    raise
-        self.server.register_function(self.get_status, 'status')
-        self.server.register_function(self.set_extruder_temperature,'settemp')
-        self.server.register_function(self.set_bed_temperature,'setbedtemp')
-        self.server.register_function(self.load_file,'load_file')
-        self.server.register_function(self.startprint,'startprint')
-        self.server.register_function(self.pauseprint,'pauseprint')
-        self.server.register_function(self.resumeprint,'resumeprint')
-        self.server.register_function(self.sendhome,'sendhome')
-        self.server.register_function(self.connect,'connect')
-        self.server.register_function(self.disconnect, 'disconnect')
-        self.server.register_function(self.send, 'send')
-        self.thread = Thread(target = self.run_server)
-        self.thread.start()
+                raise
+            if used_port != port:
+                logging.warning(_("RPC server bound on non-default port %d") % used_port)
+            return server
 
     def run_server(self):
-        self.server.serve_forever()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
 
     def shutdown(self):
-        self.server.shutdown()
+        self.pronsole.p.event_bus.remove_handler(self.handler)
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self._stop()
+
+    async def _close(self):
+        self.server.close()
+        for task in list(self._clients):
+            task.cancel()
+        await asyncio.gather(*self._clients, return_exceptions = True)
+
+    def _stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
         self.thread.join()
+        self.loop.close()
+        self._executor.shutdown()
+
+    def post(self, function, *args):
+        """Call `function(*args)` from the event loop, from any thread"""
+        try:
+            self.loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            # Closed while the event was being handled
+            pass
+
+    #  --------------------------------------------------------------
+    #  Status and events, only used from the event loop
+    #  --------------------------------------------------------------
+
+    def update_temps(self, line):
+        self.temps = parse_temperature_report(line)
+        self.publish("temp", {"temps": self.temps})
+
+    def update_layer(self, layer, z):
+        self.layer = layer
+        self.publish("layer", {"layer": layer, "z": z})
+
+    def publish(self, event, data):
+        """Send an event to the stream clients"""
+        self.version += 1
+        message = b"event: %s\ndata: %s\n\n" % (event.encode(),
+                                                json.dumps(data).encode())
+        for queue in self._streams:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    def status_body(self):
+        """JSON encoded status, only built again after an event or once
+        the ETA changed"""
+        key = (self.version, int(time.monotonic()))
+        if self._status[0] != key:
+            self._status = (key, json.dumps(self.get_status()).encode())
+        return self._status[1]
+
+    #  --------------------------------------------------------------
+    #  HTTP
+    #  --------------------------------------------------------------
+
+    async def _serve_client(self, reader, writer):
+        self._clients.add(asyncio.current_task())
+        try:
+            while await self._serve_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            pass
+        except asyncio.CancelledError:
+            # Shutting down, ending normally keeps the streams module from
+            # logging the cancellation as an error
+            pass
+        finally:
+            self._clients.discard(asyncio.current_task())
+            writer.close()
+
+    async def _serve_request(self, reader, writer):
+        """Answer one request, returns whether to keep the connection"""
+        head = await reader.readuntil(b"\r\n\r\n")
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = request_line.split(" ")
+            headers = {}
+            for line in header_lines:
+                if line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            await self._respond(writer, HTTPStatus.BAD_REQUEST,
+                                {"error": "malformed request"}, False)
+            return False
+        if length > MAX_BODY_SIZE:
+            await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                {"error": "request too large"}, False)
+            return False
+        body = await reader.readexactly(length)
+        keep_alive = version == "HTTP/1.1" \
+            and headers.get("connection", "").lower() != "close"
+        path = target.partition("?")[0].strip("/")
+        if method == "GET" and path == "events":
+            await self._stream(writer)
+            return False
+        status, payload = await self._dispatch(method, path, headers, body)
+        await self._respond(writer, status, payload, keep_alive)
+        return keep_alive
+
+    async def _dispatch(self, method, path, headers, body):
+        if path == "status" and method == "GET":
+            return HTTPStatus.OK, self.status_body()
+        function = self.functions.get(path)
+        if function is None:
+            return HTTPStatus.NOT_FOUND, {"error": "unknown function %s" % path}
+        if method != "POST":
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"}
+        content_type = headers.get("content-type", "").partition(";")[0]
+        if content_type.strip().lower() != "application/json":
+            return HTTPStatus.UNSUPPORTED_MEDIA_TYPE, \
+                {"error": "arguments must be sent as application/json"}
+        try:
+            args = json.loads(body) if body.strip() else {}
+            if not isinstance(args, dict):
+                raise TypeError("arguments must be a JSON object")
+            inspect.signature(function).bind(**args)
+        except (ValueError, TypeError) as e:
+            return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+        try:
+            result = await self.loop.run_in_executor(
+                self._executor, lambda: function(**args))
+        except Exception as e:
+            logging.error(_("RPC function %s failed: %s") % (path, e))
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+        return HTTPStatus.OK, {"result": result}
+
+    async def _respond(self, writer, status, payload, keep_alive):
+        if not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode()
+        writer.write(b"HTTP/1.1 %d %s\r\n"
+                     b"Content-Type: application/json\r\n"
+                     b"Content-Length: %d\r\n"
+                     b"Connection: %s\r\n\r\n"
+                     % (status, status.phrase.encode(), len(payload),
+                        b"keep-alive" if keep_alive else b"close"))
+        writer.write(payload)
+        await writer.drain()
+
+    async def _stream(self, writer):
+        queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self._streams.add(queue)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n"
+                         b"event: status\ndata: %s\n\n" % self.status_body())
+            await writer.drain()
+            while True:
+                writer.write(await queue.get())
+                # Events queued meanwhile are sent at once
+                while not queue.empty():
+                    writer.write(queue.get_nowait())
+                await writer.drain()
+        finally:
+            self._streams.discard(queue)
+
+    #  --------------------------------------------------------------
+    #  Functions
+    #  --------------------------------------------------------------
 
     def get_status(self):
         if self.pronsole.p.printing:
@@ -75,26 +340,24 @@ class ProntRPC:
             eta = self.pronsole.get_eta()
         else:
             eta = None
-        if self.pronsole.tempreadings:
-            temps = parse_temperature_report(self.pronsole.tempreadings)
-        else:
-            temps = None
         z = self.pronsole.curlayer
         return {"filename": self.pronsole.filename,
                 "progress": progress,
                 "eta": eta,
-                "temps": temps,
+                "temps": self.temps,
                 "z": z,
+                "layer": self.layer,
                 }
+
     def set_extruder_temperature(self, targettemp):
         if self.pronsole.p.online:
-           self.pronsole.p.send_now("M104 S" + targettemp)
+            self.pronsole.p.send_now("M104 S%s" % targettemp)
 
-    def set_bed_temperature(self,targettemp):
+    def set_bed_temperature(self, targettemp):
         if self.pronsole.p.online:
-           self.pronsole.p.send_now("M140 S" + targettemp)
+            self.pronsole.p.send_now("M140 S%s" % targettemp)
 
-    def load_file(self,filename):
+    def load_file(self, filename):
         self.pronsole.do_load(filename)
 
     def startprint(self):
@@ -105,11 +368,15 @@ class ProntRPC:
 
     def resumeprint(self):
         self.pronsole.do_resume("")
+
     def sendhome(self):
         self.pronsole.do_home("")
+
     def connect(self):
         self.pronsole.do_connect("")
+
     def disconnect(self):
         self.pronsole.do_disconnect("")
+
     def send(self, command):
         self.pronsole.p.send_now(command)
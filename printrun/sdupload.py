@@ -0,0 +1,706 @@
+# This file is part of the Printrun suite.
+#
+# Printrun is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Printrun is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Printrun.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Upload of G-code files to the SD card of the printer.
+
+Sending a file between M28 and M29 like a print costs a line number, a
+checksum and an acknowledgement per line. `SDUpload` first strips comments
+and spaces from the file, then uses Marlin's binary file transfer protocol
+when the firmware reports BINARY_FILE_TRANSFER: the file goes in blocks of
+hundreds of bytes, heatshrink compressed when the firmware can decompress
+them. Other firmwares get the compacted lines through the print pipeline,
+which keeps several lines in flight when the send window allows it.
+
+A binary packet is made of:
+
+- the 0xB5 0xAD token,
+- a header of the sync number, protocol and packet type, payload size and
+  Fletcher-16 checksum of these fields,
+- for packets with a payload, the payload followed by the checksum of the
+  header and payload.
+
+The firmware acknowledges each packet with "ok<sync>", requests it again
+with "rs<sync>" and asks for a new synchronization with "fe<sync>".
+"""
+
+import logging
+import re
+import struct
+import threading
+import time
+from collections import deque
+from itertools import accumulate
+from queue import Queue, Empty
+
+from printrun import gcoder
+from printrun import device
+
+# Protocols and packet types
+PROTOCOL_CONTROL = 0
+CONTROL_SYNC = 1
+CONTROL_CLOSE = 2
+PROTOCOL_FILE = 1
+FILE_QUERY = 0
+FILE_OPEN = 1
+FILE_CLOSE = 2
+FILE_WRITE = 3
+FILE_ABORT = 4
+
+PACKET_TOKEN = b"\xb5\xad"
+# sync, protocol and type, payload size
+_header = struct.Struct("<BBH")
+_checksum = struct.Struct("<H")
+
+# States of an upload, see `SDUpload.state`
+READY = 'ready'
+RUNNING = 'running'
+PAUSED = 'paused'
+INTERRUPTED = 'interrupted'
+DONE = 'done'
+CANCELLED = 'cancelled'
+
+reply_exp = re.compile(r"^(ok|rs|ss|fe)(\d+)")
+# Commands whose parameters are all numbers, so that spaces can go
+spaceless_exp = re.compile(r"^[Gg]\d")
+
+class TransferError(Exception):
+    """The printer did not accept or acknowledge the upload"""
+
+def compact_line(line):
+    """`line` without comments and unneeded spaces, may be empty"""
+    line = gcoder.gcode_strip_comment_exp.sub("", line).strip()
+    if spaceless_exp.match(line):
+        line = "".join(line.split())
+    return line
+
+def compact(lines):
+    """Yield the non-empty compacted `lines`"""
+    for line in lines:
+        line = compact_line(line)
+        if line:
+            yield line
+
+def fletcher16(data, checksum = 0):
+    """Fletcher-16 checksum of `data`, continuing `checksum`"""
+    low = checksum & 0xFF
+    high = checksum >> 8
+    for byte in data:
+        low = (low + byte) % 255
+        high = (high + low) % 255
+    return (high << 8) | low
+
+def build_packet(sync, protocol, packet_type, payload = b""):
+    """Bytes of a binary protocol packet"""
+    header = _header.pack(sync, (protocol << 4) | packet_type, len(payload))
+    header += _checksum.pack(fletcher16(header))
+    packet = PACKET_TOKEN + header
+    if payload:
+        packet += payload + _checksum.pack(
+            fletcher16(payload, fletcher16(header)))
+    return packet
+
+class HeatshrinkEncoder():
+    """Streaming LZSS compressor producing heatshrink streams.
+
+    Literal bytes are written as a 1 bit followed by the byte, repeated
+    strings as a 0 bit followed by their distance minus one on
+    `window_bits` bits and their length minus one on `lookahead_bits`
+    bits, most significant bit first. The last byte is padded with 0 bits.
+    """
+
+    # Candidates compared for each position, trading ratio for speed
+    max_chain = 8
+
+    def __init__(self, window_bits = 8, lookahead_bits = 4):
+        self.window_bits = window_bits
+        self.lookahead_bits = lookahead_bits
+        self.window = 1 << window_bits
+        self.lookahead = 1 << lookahead_bits
+        # Already encoded history followed by the input to encode
+        self._data = bytearray()
+        # Position of the first byte of `_data` in the input
+        self._base = 0
+        self._pos = 0
+        self._chains = {}
+        self._bits = 0
+        self._nbits = 0
+        self._out = bytearray()
+
+    def compress(self, data):
+        """Return the compressed bytes available after adding `data`"""
+        self._data += data
+        # The last bytes may start longer matches with the next data
+        self._encode(self._base + len(self._data) - self.lookahead)
+        return self._take()
+
+    def flush(self):
+        """Return the remaining compressed bytes, ending the stream"""
+        self._encode(self._base + len(self._data))
+        if self._nbits:
+            self._out.append((self._bits << (8 - self._nbits)) & 0xFF)
+            self._bits = self._nbits = 0
+        return self._take()
+
+    def _take(self):
+        out = bytes(self._out)
+        self._out.clear()
+        return out
+
+    def _emit(self, value, nbits):
+        self._bits = (self._bits << nbits) | value
+        self._nbits += nbits
+        while self._nbits >= 8:
+            self._nbits -= 8
+            self._out.append((self._bits >> self._nbits) & 0xFF)
+        self._bits &= (1 << self._nbits) - 1
+
+    def _encode(self, end):
+        data = self._data
+        base = self._base
+        limit = base + len(data)
+        chains = self._chains
+        window = self.window
+        pos = self._pos
+        while pos < end:
+            i = pos - base
+            length = 1
+            offset = 0
+            if pos + 1 < limit:
+                chain = chains.get(data[i] << 8 | data[i + 1])
+                if chain:
+                    max_length = min(self.lookahead, limit - pos)
+                    for candidate in reversed(chain):
+                        distance = pos - candidate
+                        if distance > window:
+                            break
+                        j = candidate - base
+                        n = 2
+                        while n < max_length and data[j + n] == data[i + n]:
+                            n += 1
+                        if n > length:
+                            length = n
+                            offset = distance
+                            if n == max_length:
+                                break
+            for p in range(pos, min(pos + length, limit - 1)):
+                k = p - base
+                chain = chains.setdefault(data[k] << 8 | data[k + 1], [])
+                chain.append(p)
+                if len(chain) > self.max_chain:
+                    del chain[0]
+            if length > 1:
+                self._emit(0, 1)
+                self._emit(offset - 1, self.window_bits)
+                self._emit(length - 1, self.lookahead_bits)
+            else:
+                self._emit(0x100 | data[i], 9)
+            pos += length
+        self._pos = pos
+        # Only the last window is needed to find matches
+        if pos - base > 4 * window:
+            cut = pos - base - window
+            del data[:cut]
+            self._base += cut
+
+def decompress(data, window_bits = 8, lookahead_bits = 4):
+    """Decompress a whole heatshrink stream, as the firmware does"""
+    out = bytearray()
+    bits = int.from_bytes(data, "big")
+    remaining = 8 * len(data)
+    while remaining >= 9:
+        remaining -= 1
+        if (bits >> remaining) & 1:
+            remaining -= 8
+            out.append((bits >> remaining) & 0xFF)
+            continue
+        if remaining < window_bits + lookahead_bits:
+            break
+        remaining -= window_bits
+        offset = ((bits >> remaining) & ((1 << window_bits) - 1)) + 1
+        remaining -= lookahead_bits
+        length = ((bits >> remaining) & ((1 << lookahead_bits) - 1)) + 1
+        for i in range(length):
+            out.append(out[-offset])
+    return bytes(out)
+
+class SDUpload():
+    """Upload of G-code lines to a file of the SD card.
+
+    The upload runs in its own thread once started. It can be paused, in
+    which case the file is kept open, and resumed where it stopped, also
+    after an error interrupted it: packets which were not acknowledged are
+    sent again after a new synchronization. Since opening a file truncates
+    it, an upload can't be resumed once the file was closed or the
+    firmware restarted.
+
+    Parameters
+    ----------
+    core : printcore
+        Connected printer.
+    lines : iterable of str
+        G-code lines, compacted with `compact` before being sent.
+    target : str
+        File name on the SD card, usually in 8.3 format.
+    binary : bool or None, optional
+        Whether to use the binary protocol, None to use it when the
+        firmware supports it.
+    compression : bool, optional
+        Whether to compress the file when the firmware supports it.
+    block_size : int, optional
+        Maximum payload of the binary packets, lowered to the size of the
+        firmware buffer.
+    window : int, optional
+        Binary packets sent ahead of their acknowledgement. Marlin only
+        buffers one packet, more rely on the serial receive buffer.
+    timeout : float, optional
+        Seconds to wait for a reply before sending a packet again.
+    retries : int, optional
+        Packets sent again in a row before the upload is interrupted.
+
+    Attributes
+    ----------
+    state : str
+        One of `READY`, `RUNNING`, `PAUSED`, `INTERRUPTED`, `DONE` and
+        `CANCELLED`.
+    size : int
+        Bytes of the compacted file.
+    sent : int
+        Bytes of the compacted file acknowledged by the firmware.
+    compression : tuple or None
+        The window and lookahead bits of the heatshrink compression used.
+    error : str or None
+        Why the upload was interrupted.
+
+    """
+
+    def __init__(self, core, lines, target, binary = None, compression = True,
+                 block_size = 512, window = 1, timeout = 2.0, retries = 10):
+        self.core = core
+        self.target = target
+        self.binary = binary
+        self.compress = compression
+        self.compression = None
+        self.block_size = block_size
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.state = READY
+        self.error = None
+        self._lines = list(compact(lines))
+        self._data = "".join(line + "\n" for line in self._lines) \
+            .encode("utf-8")
+        self.size = len(self._data)
+        self.sent = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._started = 0
+        self._started_sent = 0
+        # Binary protocol
+        self._replies = None
+        self._pft = deque()
+        self._next_sync = 0
+        self._packets = None
+        self._in_flight = deque()
+        # Text fallback
+        self._gcode = None
+        self._offsets = None
+        self._index = 0
+
+    @property
+    def progress(self):
+        """Fraction of the file acknowledged by the firmware"""
+        return self.sent / self.size if self.size else 1.0
+
+    @property
+    def rate(self):
+        """Bytes per second since the upload was last started or resumed"""
+        elapsed = time.monotonic() - self._started
+        if self.state != RUNNING or elapsed <= 0:
+            return 0.0
+        return (self.sent - self._started_sent) / elapsed
+
+    @property
+    def eta(self):
+        """Seconds left at the current rate, None if unknown"""
+        rate = self.rate
+        return (self.size - self.sent) / rate if rate else None
+
+    @property
+    def finished(self):
+        return self.state in (DONE, CANCELLED)
+
+    def start(self):
+        """Start the upload thread, returns False if already started"""
+        with self._cond:
+            if self.state != READY:
+                return False
+            self.state = RUNNING
+        self._start_thread()
+        return True
+
+    def pause(self):
+        """Stop sending once the data in flight is acknowledged, keeping
+        the file open"""
+        with self._cond:
+            if self.state != RUNNING:
+                return False
+            self.state = PAUSED
+            self._cond.notify_all()
+        return True
+
+    def resume(self):
+        """Continue a paused or interrupted upload where it stopped"""
+        with self._cond:
+            if self.state == PAUSED:
+                self.state = RUNNING
+                self._cond.notify_all()
+                return True
+            if self.state != INTERRUPTED:
+                return False
+            self.state = RUNNING
+            self.error = None
+        self._start_thread()
+        return True
+
+    def cancel(self):
+        """Stop the upload and close the incomplete file"""
+        with self._cond:
+            if self.state in (RUNNING, PAUSED):
+                self.state = CANCELLED
+                self._cond.notify_all()
+                return True
+            if self.state in (READY, INTERRUPTED):
+                self.state = CANCELLED
+                return True
+        return False
+
+    def wait(self, timeout = None):
+        """Wait for the upload thread to exit, returns False on timeout"""
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def _start_thread(self):
+        self._thread = threading.Thread(target = self._run,
+                                        name = 'upload thread',
+                                        daemon = True)
+        self._thread.start()
+
+    def _mark(self):
+        # Start of the rate measurement
+        self._started = time.monotonic()
+        self._started_sent = self.sent
+
+    def _wait_running(self):
+        """Wait while paused, returns whether the upload goes on"""
+        with self._cond:
+            while self.state == PAUSED:
+                self._cond.wait()
+            return self.state == RUNNING
+
+    def _finish(self, state):
+        with self._cond:
+            self.state = state
+
+    def _run(self):
+        try:
+            if self.binary is None:
+                self.binary = self._supports_binary()
+            if self.binary:
+                completed = self._run_binary()
+            else:
+                completed = self._run_text()
+            self._finish(DONE if completed else CANCELLED)
+        except (TransferError, device.DeviceError) as e:
+            with self._cond:
+                self.error = str(e)
+                if self.state != CANCELLED:
+                    self.state = INTERRUPTED
+            logging.error(_("Upload of %s interrupted: %s")
+                          % (self.target, self.error))
+
+    def _supports_binary(self):
+        capabilities = self.core.capabilities
+        if "BINARY_FILE_TRANSFER" not in capabilities:
+            # Capabilities are only requested with auto-reports
+            self.core.send_now("M115")
+            deadline = time.monotonic() + self.timeout
+            while ("BINARY_FILE_TRANSFER" not in capabilities
+                   and time.monotonic() < deadline):
+                time.sleep(0.05)
+        return capabilities.get("BINARY_FILE_TRANSFER", False)
+
+    #  --------------------------------------------------------------
+    #  Binary protocol
+    #  --------------------------------------------------------------
+
+    def _run_binary(self):
+        core = self.core
+        replies = Queue()
+        if not core.take_link(replies.put):
+            raise TransferError(_("The printer is busy."))
+        self._replies = replies
+        try:
+            if self._packets is None:
+                self._write(b"M28 B1\n")
+                self._sync()
+                try:
+                    self._open()
+                except TransferError:
+                    self._close_session()
+                    raise
+                self._packets = self._blocks()
+            else:
+                self._resync()
+            self._mark()
+            if self._send_packets(self._packets):
+                reply = self._request(PROTOCOL_FILE, FILE_CLOSE)
+                completed = True
+            else:
+                reply = self._request(PROTOCOL_FILE, FILE_ABORT)
+                completed = False
+            self._close_session()
+            if reply != "PFT:success":
+                raise TransferError(_("The printer could not write %s: %s")
+                                    % (self.target, reply))
+            if completed:
+                self.sent = self.size
+            return completed
+        finally:
+            self._replies = None
+            core.release_link()
+
+    def _take_sync(self):
+        sync = self._next_sync
+        self._next_sync = (sync + 1) % 256
+        return sync
+
+    def _write(self, data):
+        printer = self.core.printer
+        if printer is None:
+            raise TransferError(_("Not connected to printer."))
+        printer.write(data)
+
+    def _write_packet(self, entry):
+        sync, protocol, packet_type, payload, end = entry
+        self._write(build_packet(sync, protocol, packet_type, payload))
+
+    def _reply(self, timeout):
+        """Next protocol reply as (kind, number), None on timeout.
+        File transfer replies are kept in `_pft`"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                line = self._replies.get(timeout = remaining).strip()
+            except Empty:
+                return None
+            if line.startswith("PFT:"):
+                self._pft.append(line)
+                continue
+            match = reply_exp.match(line)
+            if match is not None:
+                return match.group(1), int(match.group(2)), line
+
+    def _sync(self):
+        for attempt in range(self.retries):
+            self._write(build_packet(0, PROTOCOL_CONTROL, CONTROL_SYNC))
+            deadline = time.monotonic() + self.timeout
+            while True:
+                reply = self._reply(deadline - time.monotonic())
+                if reply is None:
+                    break
+                kind, sync, line = reply
+                if kind == "ss":
+                    # ss<sync>,<max block size>,<protocol version>
+                    fields = line[2:].split(",")
+                    if len(fields) > 1 and fields[1].isdigit():
+                        self.block_size = min(self.block_size,
+                                              int(fields[1]))
+                    self._next_sync = sync
+                    return
+        raise TransferError(_("The printer does not answer the binary "
+                              "file transfer protocol."))
+
+    def _resync(self):
+        """Synchronize again and send the unacknowledged packets again"""
+        self._sync()
+        in_flight = self._in_flight
+        # The firmware expects the packet following the last one it got,
+        # only their acknowledgements were lost
+        while in_flight and 0 < (self._next_sync - in_flight[0][0]) % 256 \
+                <= len(in_flight):
+            self._acked(in_flight.popleft())
+        for entry in in_flight:
+            entry[0] = self._take_sync()
+            self._write_packet(entry)
+
+    def _acked(self, entry):
+        if entry[4] is not None:
+            self.sent = entry[4]
+
+    def _request(self, protocol, packet_type, payload = b""):
+        """Send a packet, returns the file transfer reply to it if any"""
+        self._pft.clear()
+        self._send_packets(iter([(protocol, packet_type, payload, None)]),
+                           hold = False)
+        if protocol != PROTOCOL_FILE:
+            return None
+        deadline = time.monotonic() + self.timeout
+        while not self._pft:
+            if time.monotonic() >= deadline:
+                raise TransferError(_("No reply from the printer."))
+            self._reply(deadline - time.monotonic())
+        return self._pft.popleft()
+
+    def _open(self):
+        reply = self._request(PROTOCOL_FILE, FILE_QUERY)
+        # PFT:version:<version>:compression:<none or heatshrink,W,L>
+        fields = reply.split(":")
+        compression = fields[4].split(",") if len(fields) > 4 else ["none"]
+        if self.compress and compression[0] == "heatshrink" \
+           and len(compression) == 3:
+            self.compression = (int(compression[1]), int(compression[2]))
+        else:
+            self.compression = None
+        payload = (b"\0" + (b"\1" if self.compression else b"\0")
+                   + self.target.encode() + b"\0")
+        reply = self._request(PROTOCOL_FILE, FILE_OPEN, payload)
+        if reply != "PFT:success":
+            raise TransferError(_("The printer could not open %s: %s")
+                                % (self.target, reply))
+
+    def _close_session(self):
+        # Back to text commands, the firmware may not acknowledge it
+        entry = [self._take_sync(), PROTOCOL_CONTROL, CONTROL_CLOSE, b"",
+                 None]
+        self._write_packet(entry)
+        self._reply(min(self.timeout, 0.5))
+
+    def _blocks(self):
+        """Yield the write packets of the file"""
+        data = self._data
+        encoder = HeatshrinkEncoder(*self.compression) \
+            if self.compression else None
+        pending = bytearray()
+        block_size = self.block_size
+        for start in range(0, len(data), block_size):
+            end = min(start + block_size, len(data))
+            chunk = data[start:end]
+            pending += encoder.compress(chunk) if encoder else chunk
+            if end == len(data) and encoder:
+                pending += encoder.flush()
+            while len(pending) >= block_size \
+                    or (pending and end == len(data)):
+                payload = bytes(pending[:block_size])
+                del pending[:block_size]
+                yield (PROTOCOL_FILE, FILE_WRITE, payload, end)
+
+    def _send_packets(self, packets, hold = True):
+        """Send `packets` keeping up to `window` of them in flight.
+
+        With `hold`, no new packet is sent while paused. Returns False if
+        cancelled.
+
+        """
+        in_flight = self._in_flight
+        retries = 0
+        more = True
+        while True:
+            while (more and len(in_flight) < self.window
+                   and (not hold or self.state == RUNNING)):
+                packet = next(packets, None)
+                if packet is None:
+                    more = False
+                    break
+                entry = [self._take_sync(), *packet]
+                in_flight.append(entry)
+                self._write_packet(entry)
+            if not in_flight:
+                if not more:
+                    return True
+                if not self._wait_running():
+                    return False
+                self._mark()
+                continue
+            reply = self._reply(self.timeout)
+            if reply is not None and reply[0] == "ok":
+                syncs = [entry[0] for entry in in_flight]
+                if reply[1] in syncs:
+                    for i in range(syncs.index(reply[1]) + 1):
+                        self._acked(in_flight.popleft())
+                    retries = 0
+                continue
+            retries += 1
+            if retries > self.retries:
+                raise TransferError(_("No reply from the printer."))
+            if reply is None:
+                resent = list(in_flight)
+            elif reply[0] == "rs":
+                resent = [entry for entry in in_flight
+                          if (entry[0] - reply[1]) % 256 < len(in_flight)]
+                resent = resent or list(in_flight)
+            elif reply[0] == "fe":
+                self._resync()
+                continue
+            else:
+                continue
+            for entry in resent:
+                self._write_packet(entry)
+
+    #  --------------------------------------------------------------
+    #  Text fallback
+    #  --------------------------------------------------------------
+
+    def _run_text(self):
+        core = self.core
+        if self._gcode is None:
+            self._gcode = gcoder.LightGCode(self._lines)
+            self._offsets = [0, *accumulate(len(line.encode("utf-8")) + 1
+                                            for line in self._lines)]
+            core.send_now("M28 " + self.target)
+        while True:
+            if not self._wait_running():
+                core.send_now("M29 " + self.target)
+                return False
+            if not core.startprint(self._gcode, self._index):
+                raise TransferError(_("The printer is busy."))
+            self._mark()
+            while core.printing and self.state == RUNNING:
+                time.sleep(0.1)
+                self.sent = self._offsets[min(core.queueindex,
+                                              len(self._lines))]
+            if core.printing:
+                core.pause()
+            if core.paused:
+                # Paused here or by the user
+                self._index = core.queueindex
+                core.cancelprint()
+                self.sent = self._offsets[self._index]
+                with self._cond:
+                    if self.state == RUNNING:
+                        self.state = PAUSED
+                continue
+            if core.mainqueue is None or not core.online:
+                self._index = core.queueindex
+                raise TransferError(_("The upload was stopped."))
+            break
+        core.send_now("M29 " + self.target)
+        self.sent = self.size
+        return True
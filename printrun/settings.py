@@ -385,7 +385,22 @@ class Settings:
         self._add(BooleanSetting("tcp_streaming_mode", False, _("TCP Streaming Mode:"),
                                  _("When using a TCP connection to the printer, the streaming mode will not wait for acks from the printer to send new commands."
                                    "This will break things such as ETA prediction, but can result in smoother prints.")), root.update_tcp_streaming_mode)
+        self._add(SpinSetting("tcp_batch_size", 1024, 0, 16384, _("TCP Batch Size:"),
+                              _("In TCP streaming mode, size in bytes of the batches of lines written at once to the printer, 0 to write each line on its own"), "Printer"), root.update_tcp_streaming_mode)
+        self._add(SpinSetting("tcp_batch_latency", 10, 0, 1000, _("TCP Batch Latency:"),
+                              _("In TCP streaming mode, milliseconds a line may wait for more lines to be written with it"), "Printer"), root.update_tcp_streaming_mode)
         self._add(BooleanSetting("rpc_server", True, _("RPC Server:"), _("Enable RPC server to allow remotely querying print status")), root.update_rpc_server)
+        self._add(SpinSetting("window_size", 1, 0, 64, _("Send Window:"),
+                              _("Number of printed lines sent ahead of the printer acknowledgements, 1 to wait for each of them, "
+                                "0 to adapt it to the firmware command buffer (needs ADVANCED_OK). Applies on next connection."), "Printer"), root.update_send_window)
+        self._add(SpinSetting("rx_buffer_size", 128, 16, 65536, _("Receive Buffer Size:"),
+                              _("Size in bytes of the firmware serial receive buffer, lines in the send window never take more than that"), "Printer"), root.update_send_window)
+        self._add(SpinSetting("autoreport_interval", 3, 0, 60, _("Auto-report Interval:"),
+                              _("Seconds between the temperature, position and SD status reports of firmwares able to send them on their own, "
+                                "which are then no longer polled. 0 to always poll the printer. Applies on next connection."), "Printer"), root.update_autoreport)
+        self._add(BooleanSetting("sd_binary_upload", True, _("Binary SD upload:"),
+                                 _("Upload files to the SD card with the binary file transfer protocol, compressed, when the firmware supports it "
+                                   "(Marlin BINARY_FILE_TRANSFER). Other firmwares get the compacted file as text (pronsole only)"), "Printer"))
         self._add(BooleanSetting("dtr", True, _("DTR:"), _("Disabling DTR would prevent Arduino (RAMPS) from resetting upon connection"), "Printer"))
         if sys.platform != "win32":
             self._add(StringSetting("devicepath", "", _("Device Name Pattern:"), _("Custom device pattern: for example /dev/3DP_* "), "Printer"))
@@ -396,6 +411,8 @@ class Settings:
         self._add(SpinSetting("xy_feedrate", 3000, 0, 50000, _("X && Y Manual Feedrate:"), _("Feedrate for Control Panel Moves in X and Y (mm/min)"), "Printer"))
         self._add(SpinSetting("z_feedrate", 100, 0, 50000, _("Z Manual Feedrate:"), _("Feedrate for Control Panel Moves in Z (mm/min)"), "Printer"))
         self._add(SpinSetting("e_feedrate", 100, 0, 1000, _("E Manual Feedrate:"), _("Feedrate for Control Panel Moves in Extrusions (mm/min)"), "Printer"))
+        self._add(BooleanSetting("accurate_time_estimate", False, _("Accurate print time estimate:"), _("Estimate print durations by planning moves like the firmware does, using the firmware motion limits"), "Printer"))
+        self._add(StringSetting("machine_limits", "", _("Firmware motion limits:"), _("M201, M203, M204 and M205 commands matching the firmware configuration, separated by commas, for example: M201 X1000 Y1000, M204 P1000 T1500. Limits set in the G-code file take precedence"), "Printer"))
         defaultslicerpath = ""
         if getattr(sys, 'frozen', False):
             if sys.platform == "darwin":
@@ -412,6 +429,11 @@ class Settings:
         self._add(DirSetting("log_path", str(Path.home()), _("Log Path:"),
                              _("Path to the log file. If the path is a directory the file will be named 'printrun.log'"), "UI"))
         self._add(BooleanSetting("log_stdout", False, _("Log to console:"), _("Duplicate log messages to stdout"), "UI"))
+        self._add(BooleanSetting("mmap_gcode", False, _("Memory-map G-code files:"), _("Read lines from loaded G-code files on demand instead of keeping them all in memory (when no visualization is used)"), "UI"))
+        self._add(BooleanSetting("shared_gcode", False, _("Share loaded G-code files:"), _("Parse loaded G-code files once for all the hosts using the same cache directory, which map the parsed file instead of keeping their own copy (pronsole only)"), "UI"))
+        self._add(SpinSetting("gcode_cache_size", 64, 0, 4096, _("G-code cache size (MB):"), _("Disk space used to remember the analysis of loaded G-code files so that they load faster next time, 0 to disable"), "UI"))
+        self._add(BooleanSetting("packed_gcode", False, _("Compact G-code storage:"), _("Store the lines of loaded G-code files in a few large arrays instead of one object per line, using much less memory with visualizations"), "UI"))
+        self._add(BooleanSetting("columnar_analysis", False, _("Vectorized G-code analysis:"), _("Analyze loaded G-code files faster with vectorized routines (requires NumPy) and keep their lines in a few large arrays, as compact storage does. The whole file is analyzed before the first layer is shown"), "UI"))
 
         self._add(HiddenSetting("project_offset_x", 0.0))
         self._add(HiddenSetting("project_offset_y", 0.0))
@@ -85,7 +85,8 @@ setup(
     package_data=get_packagedata(),
     include_package_data=False,
     data_files=get_data_files(),
-    scripts=["pronsole.py", "pronterface.py", "plater.py", "printcore.py"],
+    scripts=["pronsole.py", "pronterface.py", "plater.py", "printcore.py",
+             "printfarm.py"],
     ext_modules=get_extensions(),
     install_requires=get_install_requires(),
     zip_safe=False,
@@ -0,0 +1,352 @@
+"""Test suite for `printrun/asyncprintcore.py` and `printrun/asyncdevice.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import asyncdevice
+from printrun import asyncprintcore
+from printrun import gcoder
+from printrun import printcore
+from printrun.device import READ_EMPTY, READ_EOF
+
+TIMEOUT = 5  # in s
+
+
+class MockFirmware:
+    """Answer G-code lines like a firmware checking line numbers"""
+
+    def __init__(self, corrupt=(), resend_ok=True):
+        # Accepted commands, without line numbers
+        self.lines = []
+        self.expected = 0
+        # Line numbers to reject once, as if corrupted on the way
+        self.corrupt = set(corrupt)
+        # Whether resend requests are followed by an ok
+        self.resend_ok = resend_ok
+        self._buffer = b''
+
+    def feed(self, data):
+        """Process received bytes, returns the replies"""
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        replies = []
+        for line in lines:
+            replies.extend(self.process(line.decode()))
+        return ''.join(replies).encode()
+
+    def process(self, line):
+        """Replies to one line"""
+        if not line.startswith("N"):
+            self.lines.append(line)
+            return ["ok T:20.0 /0.0\n" if line == "M105" else "ok\n"]
+        number = int(line.split()[0][1:])
+        command = line.split(" ", 1)[1].rsplit("*", 1)[0]
+        if "M110" in command:
+            self.expected = number + 1
+        elif number != self.expected or number in self.corrupt:
+            self.corrupt.discard(number)
+            return [f"Resend: {self.expected}\n"] \
+                + ["ok\n"] * self.resend_ok
+        else:
+            self.expected = number + 1
+            self.lines.append(command)
+        return [f"ok N{number} P15 B3\n"]
+
+
+class MockTCPPrinter(asyncio.Protocol):
+    """Network printer answering with a MockFirmware"""
+
+    def __init__(self, firmware):
+        self.firmware = firmware
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(self.firmware.feed(data))
+
+
+async def start_tcp_printer(firmware):
+    """Serve a mock printer on a free port, returns the server and port"""
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: MockTCPPrinter(firmware),
+                                      "127.0.0.1", 0)
+    return server, f"127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+async def wait_print_end(events):
+    """Wait until a print finishes"""
+    async for event in events:
+        if event.name == "end":
+            await events.aclose()
+            return
+
+
+def moves(firmware):
+    """Moves accepted by a firmware"""
+    return [line for line in firmware.lines if line.startswith("G1")]
+
+
+def make_print(count):
+    """G-code of `count` moves"""
+    return gcoder.GCode([f"G1 X{i} Y{i % 7}" for i in range(count)])
+
+
+class TestLineProtocol(unittest.IsolatedAsyncioTestCase):
+    """Checks for the splitting of received data into lines"""
+
+    async def test_chunks(self):
+        """Test lines split across chunks and bursts of lines"""
+        protocol = asyncdevice.LineProtocol()
+        for chunk in (b'o', b'k\nok T:2', b'0\n', b'ok\nok\nok', b'\n'):
+            protocol.data_received(chunk)
+        protocol.data_received(b'partial')
+        protocol.connection_lost(None)
+        self.assertEqual(list(protocol.lines), [b'ok\n', b'ok T:20\n', b'ok\n', b'ok\n',
+                                 b'ok\n', b'partial', READ_EOF])
+
+    async def test_drain(self):
+        """Test writers wait while the transport is over its limit"""
+        protocol = asyncdevice.LineProtocol()
+        await asyncio.wait_for(protocol.drain(), TIMEOUT)
+        protocol.pause_writing()
+        drain = asyncio.ensure_future(protocol.drain())
+        await asyncio.sleep(0.01)
+        self.assertFalse(drain.done())
+        protocol.resume_writing()
+        await asyncio.wait_for(drain, TIMEOUT)
+        protocol.pause_writing()
+        drain = asyncio.ensure_future(protocol.drain())
+        await asyncio.sleep(0)
+        protocol.connection_lost(None)
+        await asyncio.wait_for(drain, TIMEOUT)
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs a pseudo terminal")
+class TestAsyncDeviceSerial(unittest.IsolatedAsyncioTestCase):
+    """Checks for serial connections, through a pseudo terminal"""
+
+    async def asyncSetUp(self):
+        self.enterContext(
+            mock.patch("printrun.device.Device._disable_ttyhup"))
+        self.master, slave = os.openpty()
+        self.addCleanup(os.close, self.master)
+        self.device = asyncdevice.AsyncDevice()
+        await self.device.connect(os.ttyname(slave), 115200)
+        os.close(slave)
+        self.addCleanup(self.device.disconnect)
+
+    async def test_readline(self):
+        """Test reading lines and timeouts"""
+        os.write(self.master, b'start\nok\n')
+        self.assertEqual(await self.device.readline(), b'start\n')
+        self.assertEqual(await self.device.readline(), b'ok\n')
+        self.assertEqual(await self.device.readline(0.05), READ_EMPTY)
+
+    async def test_write(self):
+        """Test writing to the serial port"""
+        self.device.write(b'M105\n')
+        await asyncio.sleep(0.05)
+        self.assertEqual(os.read(self.master, 100), b'M105\n')
+
+    async def test_drain(self):
+        """Test the write buffer is limited while the port is not read"""
+        transport = self.device._device
+        transport.set_write_buffer_limits(high=2048)
+        data = b'G1 X1 Y1\n' * 100
+        while transport.get_write_buffer_size() <= 2048:
+            self.device.write(data)
+            await asyncio.sleep(0)
+        drain = asyncio.ensure_future(self.device.drain())
+        await asyncio.sleep(0.05)
+        self.assertFalse(drain.done())
+        while not drain.done():
+            os.read(self.master, 4096)
+            await asyncio.sleep(0.001)
+        self.assertLessEqual(transport.get_write_buffer_size(), 512)
+
+    async def test_disconnect(self):
+        """Test that the device is closed on disconnection"""
+        self.assertTrue(self.device.is_connected)
+        self.device.disconnect()
+        self.assertFalse(self.device.is_connected)
+
+
+class TestAsyncPrintcore(unittest.IsolatedAsyncioTestCase):
+    """Functional checks for AsyncPrintcore with network printers"""
+
+    async def asyncSetUp(self):
+        self.firmware = MockFirmware()
+        server, self.port = await start_tcp_printer(self.firmware)
+        self.addAsyncCleanup(server.wait_closed)
+        self.addCleanup(server.close)
+        self.core = asyncprintcore.AsyncPrintcore()
+        self.addAsyncCleanup(self.core.disconnect)
+        await self.core.connect(self.port, 115200)
+        self.assertTrue(await self.core.wait_online(TIMEOUT))
+
+    async def test_send_now(self):
+        """Test that send_now returns once the command is written"""
+        events = self.core.events()
+        await self.core.send_now("M114")
+        event = await asyncio.wait_for(events.__anext__(), TIMEOUT)
+        while event.name != "send":
+            event = await asyncio.wait_for(events.__anext__(), TIMEOUT)
+        self.assertEqual(event.args[0], "M114")
+        await events.aclose()
+
+    async def test_print(self):
+        """Test that all lines are sent and events are triggered"""
+        handler = mock.Mock()
+        self.core.addEventHandler(handler)
+        code = make_print(100)
+        end = asyncio.ensure_future(wait_print_end(self.core.events()))
+        self.assertTrue(await self.core.startprint(code))
+        await asyncio.wait_for(end, TIMEOUT)
+        self.assertEqual(moves(self.firmware), [line.raw for line in code])
+        self.assertFalse(self.core.printing)
+        handler.on_start.assert_called_once_with(False)
+        self.assertEqual(handler.on_printsend.call_count, 100)
+
+    async def test_pause_resume(self):
+        """Test pausing and resuming a print"""
+        code = make_print(200)
+        await self.core.startprint(code)
+        await asyncio.sleep(0.01)
+        self.assertTrue(self.core.pause())
+        self.assertFalse(self.core.printing)
+        sent = len(self.firmware.lines)
+        await asyncio.sleep(0.05)
+        self.assertLessEqual(len(self.firmware.lines), sent + 1)
+        end = asyncio.ensure_future(wait_print_end(self.core.events()))
+        self.assertTrue(await self.core.resume())
+        await asyncio.wait_for(end, TIMEOUT)
+        printed = [line.raw for line in code]
+        # Moves back to the paused position are sent on resume
+        self.assertEqual([line for line in moves(self.firmware)
+                          if line in printed], printed)
+
+    async def test_streaming(self):
+        """Test other tasks keep running while streaming a print"""
+        self.core.tcp_streaming_mode = True
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0)
+
+        ticker = asyncio.ensure_future(tick())
+        self.addCleanup(ticker.cancel)
+        code = make_print(2000)
+        end = asyncio.ensure_future(wait_print_end(self.core.events()))
+        await self.core.startprint(code)
+        await asyncio.wait_for(end, TIMEOUT)
+        self.assertGreater(ticks, 1000)
+        await asyncio.sleep(0.1)
+        self.assertEqual(moves(self.firmware), [line.raw for line in code])
+
+    async def test_many_printers(self):
+        """Test printing on many printers from one event loop"""
+        cores = []
+        firmwares = []
+        for _ in range(20):
+            firmware = MockFirmware()
+            server, port = await start_tcp_printer(firmware)
+            self.addCleanup(server.close)
+            core = asyncprintcore.AsyncPrintcore()
+            self.addAsyncCleanup(core.disconnect)
+            await core.connect(port, 115200)
+            cores.append(core)
+            firmwares.append(firmware)
+        for core in cores:
+            self.assertTrue(await core.wait_online(TIMEOUT))
+        code = make_print(50)
+        ends = [asyncio.ensure_future(wait_print_end(core.events()))
+                for core in cores]
+        for core in cores:
+            await core.startprint(code)
+        await asyncio.wait_for(asyncio.gather(*ends), TIMEOUT)
+        for firmware in firmwares:
+            self.assertEqual(moves(firmware)[-1], code.lines[-1].raw)
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "needs a pseudo terminal")
+class TestAsyncPrintcoreSerial(unittest.IsolatedAsyncioTestCase):
+    """Functional checks for AsyncPrintcore with checksums and resends"""
+
+    async def start(self, window_size, corrupt=(), **kwargs):
+        """Connect to a firmware behind a pseudo terminal"""
+        self.enterContext(
+            mock.patch("printrun.device.Device._disable_ttyhup"))
+        self.firmware = MockFirmware(corrupt, **kwargs)
+        master, slave = os.openpty()
+        os.set_blocking(master, False)
+        self.addCleanup(os.close, master)
+
+        def answer():
+            try:
+                data = os.read(master, 4096)
+            except BlockingIOError:
+                return
+            except OSError:  # closed
+                loop.remove_reader(master)
+                return
+            os.write(master, self.firmware.feed(data))
+        loop = asyncio.get_running_loop()
+        loop.add_reader(master, answer)
+        self.addCleanup(loop.remove_reader, master)
+        core = asyncprintcore.AsyncPrintcore()
+        await core.connect(os.ttyname(slave), 115200,
+                           window_size=window_size)
+        os.close(slave)
+        self.addAsyncCleanup(core.disconnect)
+        self.assertTrue(await core.wait_online(TIMEOUT))
+        return core
+
+    async def print_all(self, core, code):
+        """Print and wait for the end of the print"""
+        end = asyncio.ensure_future(wait_print_end(core.events()))
+        await core.startprint(code)
+        await asyncio.wait_for(end, TIMEOUT)
+
+    async def test_window(self):
+        """Test a print with lines in flight"""
+        core = await self.start(4)
+        code = make_print(300)
+        await self.print_all(core, code)
+        self.assertIsInstance(core.window, printcore.SendWindow)
+        self.assertEqual(moves(self.firmware), [line.raw for line in code])
+
+    async def test_resend(self):
+        """Test that rejected lines are sent again in order"""
+        for window_size in (1, 4):
+            with self.subTest(window_size=window_size):
+                core = await self.start(window_size, corrupt=(3, 50, 51))
+                code = make_print(100)
+                await self.print_all(core, code)
+                self.assertEqual(moves(self.firmware),
+                                 [line.raw for line in code])
+                await core.disconnect()
+
+    async def test_resend_without_ok(self):
+        """Test firmwares not following resend requests with an ok"""
+        core = await self.start(1, corrupt=range(10, 60, 5), resend_ok=False)
+        code = make_print(100)
+        start = asyncio.get_running_loop().time()
+        await self.print_all(core, code)
+        self.assertEqual(moves(self.firmware), [line.raw for line in code])
+        # Only the first request waits for a read timeout of 0.25 s
+        self.assertLess(asyncio.get_running_loop().time() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
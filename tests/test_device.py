@@ -46,6 +46,19 @@ def patch_socketio(function, **kwargs):
     return mock.patch(f"socket.SocketIO.{function}", **kwargs)
 
 
+def fill_with(*chunks):
+    """Side effect for `readinto` mocks, reading one of `chunks` per call"""
+    chunks = list(chunks)
+
+    def readinto(buffer):
+        data = chunks.pop(0)
+        if not data:
+            return data  # None when no data is available, 0 on EOF
+        buffer[:len(data)] = data
+        return len(data)
+    return readinto
+
+
 def setup_serial(test):
     """Set up a Device through a mocked serial connection"""
     dev = device.Device()
@@ -239,23 +252,40 @@ class TestReadSerial(unittest.TestCase):
 
     def setUp(self):
         self.dev, _ = setup_serial(self)
+        self.enterContext(patch_serial("in_waiting",
+                                       new_callable=mock.PropertyMock,
+                                       return_value=100))
 
     def _fake_read(self, **kargs):
         # Allows mocking a serial read operation for different return values
-        with patch_serial("readline", **kargs) as mocked_read:
+        with patch_serial("readinto", **kargs) as mocked_read:
             data = self.dev.readline()
             mocked_read.assert_called_once()
             return data
 
-    def test_calls_readline(self):
-        """serial.Serial.readline is called"""
-        self._fake_read()
+    def test_calls_readinto(self):
+        """serial.Serial.readinto is called"""
+        self._fake_read(return_value=0)
 
     def test_read_data(self):
-        """Data returned by serial.Serial.readline is passed as is"""
-        data = self._fake_read(return_value=b"data\n")
+        """Data returned by serial.Serial.readinto is passed as is"""
+        data = self._fake_read(side_effect=fill_with(b"data\n"))
         self.assertEqual(data, b"data\n")
 
+    def test_read_chunks(self):
+        """Lines split across reads or read together are returned one by one"""
+        chunks = (b"o", b"k\nok T:2", b"0\n", b"ok\nbusy\nok\n")
+        with patch_serial("readinto", side_effect=fill_with(*chunks)):
+            lines = [self.dev.readline() for _ in range(5)]
+        self.assertEqual(lines, [b"ok\n", b"ok T:20\n", b"ok\n", b"busy\n",
+                                 b"ok\n"])
+
+    def test_partial_line(self):
+        """The start of a line is kept when reading times out"""
+        with patch_serial("readinto", side_effect=fill_with(b"o", 0, b"k\n")):
+            self.assertEqual(self.dev.readline(), device.READ_EMPTY)
+            self.assertEqual(self.dev.readline(), b"ok\n")
+
     def test_read_serial_exception(self):
         """DeviceError is raised on serial error during reading"""
         with self.assertRaises(device.DeviceError):
@@ -284,7 +314,7 @@ class TestReadSocket(unittest.TestCase):
         self.dev, _ = setup_socket(self)
 
     def _fake_read(self, **kargs):
-        with patch_socketio("read", **kargs) as mocked_read:
+        with patch_socketio("readinto", **kargs) as mocked_read:
             data = self.dev.readline()
             mocked_read.assert_called()
             return data
@@ -316,10 +346,71 @@ class TestReadSocket(unittest.TestCase):
         self.assertFalse(self.dev.is_connected)
 
     def test_read_data(self):
-        """Data returned by socket.socket.read is passed as is"""
-        with mock.patch('socket.SocketIO.read', return_value=b"data\n"):
+        """Data returned by socket.SocketIO.readinto is passed as is"""
+        with patch_socketio("readinto", side_effect=fill_with(b"data\n")):
             self.assertEqual(self.dev.readline(), b"data\n")
 
+    def test_read_chunks(self):
+        """Lines split across reads or read together are returned one by one"""
+        chunks = (b"ok\nok T:2", b"0 B:", b"60\nok\n", b"echo:busy\n")
+        with patch_socketio("readinto", side_effect=fill_with(*chunks)):
+            lines = [self.dev.readline() for _ in range(4)]
+        self.assertEqual(lines, [b"ok\n", b"ok T:20 B:60\n", b"ok\n",
+                                 b"echo:busy\n"])
+
+    def test_read_eof_partial(self):
+        """Data without end of line is returned at the end of the stream"""
+        with patch_socketio("readinto", side_effect=fill_with(b"ok", 0, 0)):
+            self.assertEqual(self.dev.readline(), b"ok")
+            self.assertEqual(self.dev.readline(), device.READ_EOF)
+
+
+class TestLineBuffer(unittest.TestCase):
+    """Test splitting the data read into lines"""
+
+    def test_burst(self):
+        """Many lines read at once are returned in order"""
+        buffer = device.LineBuffer(64)
+        buffer.fill(fill_with(b"ok\n" * 10 + b"o"))
+        lines = []
+        line = buffer.readline()
+        while line:
+            lines.append(line)
+            line = buffer.readline()
+        self.assertEqual(lines, [b"ok\n"] * 10)
+        self.assertEqual(len(buffer), 1)
+
+    def test_wrap(self):
+        """Incomplete lines are kept when the buffer is reused"""
+        buffer = device.LineBuffer(16)
+        received = []
+        data = b"".join(b"ok N%d\n" % i for i in range(50))
+        for start in range(0, len(data), 5):
+            buffer.fill(fill_with(data[start:start + 5]), 5)
+            line = buffer.readline()
+            while line:
+                received.append(line)
+                line = buffer.readline()
+        self.assertEqual(b"".join(received), data)
+        self.assertEqual(len(buffer), 0)
+
+    def test_long_line(self):
+        """The buffer grows for lines longer than it"""
+        buffer = device.LineBuffer(8)
+        line = b"echo:" + b"x" * 30 + b"\n"
+        for start in range(0, len(line), 8):
+            self.assertEqual(buffer.readline(), device.READ_EMPTY)
+            buffer.fill(fill_with(line[start:start + 8]), 8)
+        self.assertEqual(buffer.readline(), line)
+
+    def test_flush(self):
+        """All the data is returned by flush"""
+        buffer = device.LineBuffer()
+        buffer.fill(fill_with(b"ok\nok"))
+        buffer.readline()
+        self.assertEqual(buffer.flush(), b"ok")
+        self.assertEqual(buffer.flush(), b"")
+
 
 class TestWriteSerial(unittest.TestCase):
     """Test write functionality on serial connections"""
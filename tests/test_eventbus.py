@@ -0,0 +1,160 @@
+"""Test suite for `printrun/eventbus.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import threading
+import unittest
+
+# Custom libraries:
+from printrun import eventbus
+from printrun import eventhandler
+from printrun import printcore
+
+TIMEOUT = 5  # in s
+
+
+class RecordingHandler(eventhandler.PrinterEventHandler):
+    """Handler recording the events it overrides"""
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def on_temp(self, line):
+        self.events.append(("temp", line))
+
+    def on_layerchange(self, layer):
+        self.events.append(("layerchange", layer))
+
+
+class TestEventBus(unittest.TestCase):
+    """Functional checks of event delivery"""
+
+    def setUp(self):
+        self.bus = eventbus.EventBus(batch_interval=0)
+        self.addCleanup(self.bus.close)
+
+    def block(self):
+        """Keep the dispatcher busy until the returned event is set"""
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def wait(*args):
+            blocked.set()
+            release.wait(TIMEOUT)
+        self.bus.subscribe("block", wait)
+        self.bus.publish("block")
+        self.assertTrue(blocked.wait(TIMEOUT))
+        return release
+
+    def test_subscribe(self):
+        """Test events are delivered in order to their subscribers"""
+        received = []
+        self.bus.subscribe("send", lambda *args: received.append(args))
+        self.assertTrue(self.bus.wants("send"))
+        self.assertFalse(self.bus.wants("recv"))
+        for i in range(100):
+            self.bus.publish("send", (i, None))
+        self.bus.publish("recv", ("ok",))
+        self.assertTrue(self.bus.flush(TIMEOUT))
+        self.assertEqual(received, [(i, None) for i in range(100)])
+
+    def test_handler(self):
+        """Test handlers get the events they override, until removed"""
+        handler = RecordingHandler()
+        self.bus.add_handler(handler)
+        self.assertFalse(self.bus.wants("recv"))
+        self.bus.publish("layerchange", (1,))
+        self.bus.flush(TIMEOUT)
+        self.bus.remove_handler(handler)
+        self.bus.publish("layerchange", (2,))
+        self.bus.flush(TIMEOUT)
+        self.assertEqual(handler.events, [("layerchange", 1)])
+        self.assertFalse(self.bus.wants("layerchange"))
+
+    def test_batch(self):
+        """Test coalescing and batch subscribers"""
+        handler = RecordingHandler()
+        self.bus.add_handler(handler)
+        batches = []
+        self.bus.subscribe("temp", batches.append, batch=True)
+        self.bus.subscribe("layerchange", batches.append, batch=True)
+        release = self.block()
+        self.bus.publish("temp", ("T:20",))
+        self.bus.publish("layerchange", (1,))
+        self.bus.publish("temp", ("T:21",))
+        self.bus.publish("layerchange", (2,))
+        release.set()
+        self.bus.flush(TIMEOUT)
+        self.assertEqual(handler.events, [("layerchange", 1),
+                                          ("temp", "T:21"),
+                                          ("layerchange", 2)])
+        self.assertEqual(batches, [[("layerchange", (1,)), ("temp", ("T:21",)),
+                                    ("layerchange", (2,))]])
+
+    def test_capacity(self):
+        """Test the oldest events are dropped once the queue is full"""
+        self.bus = eventbus.EventBus(capacity=10, batch_interval=0)
+        self.addCleanup(self.bus.close)
+        received = []
+        self.bus.subscribe("send", received.append)
+        release = self.block()
+        for i in range(15):
+            self.bus.publish("send", (i,))
+        release.set()
+        self.bus.flush(TIMEOUT)
+        # The flush marker took the place of one more event
+        self.assertEqual(self.bus.dropped, 6)
+        self.assertEqual(received, list(range(6, 15)))
+
+    def test_failing_subscriber(self):
+        """Test errors are logged without stopping the dispatcher"""
+        received = []
+        self.bus.subscribe("send", lambda: 1 / 0)
+        self.bus.subscribe("send", lambda: received.append(True))
+        with self.assertLogs(level="ERROR"):
+            self.bus.publish("send")
+            self.bus.flush(TIMEOUT)
+        self.assertEqual(received, [True])
+
+    def test_close(self):
+        """Test events wait for the dispatcher to start again"""
+        received = []
+        self.bus.subscribe("send", received.append)
+        self.bus.publish("send", (1,))
+        self.bus.close()
+        self.assertEqual(received, [1])
+        self.bus.publish("send", (2,))
+        self.assertTrue(self.bus.flush(TIMEOUT))
+        self.assertEqual(received, [1])
+        self.bus.start()
+        self.assertTrue(self.bus.flush(TIMEOUT))
+        self.assertEqual(received, [1, 2])
+
+    def test_close_from_subscriber(self):
+        """Test a subscriber can stop the dispatcher"""
+        closed = threading.Event()
+
+        def close():
+            self.bus.close()
+            closed.set()
+        self.bus.subscribe("disconnect", close)
+        self.bus.publish("disconnect")
+        self.assertTrue(closed.wait(TIMEOUT))
+        self.bus.start()
+        self.assertTrue(self.bus.flush(TIMEOUT))
+
+    def test_printcore_disconnect(self):
+        """Test printcore delivers its last events and stops the bus"""
+        core = printcore.printcore()
+        core.event_handler = []
+        received = []
+        core.event_bus.subscribe("disconnect", lambda: received.append(1))
+        core.disconnect()
+        self.assertEqual(received, [1])
+        self.assertIsNone(core.event_bus._thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
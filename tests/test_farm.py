@@ -0,0 +1,140 @@
+"""Test suite for `printrun/farm.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import asyncio
+import importlib.util
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+# Custom libraries:
+from printrun import farm
+
+TIMEOUT = 10  # in s
+
+
+def load_mock_printer():
+    """Import testtools/mock-printer.py"""
+    path = Path(__file__).parent.parent / "testtools" / "mock-printer.py"
+    spec = importlib.util.spec_from_file_location("mock_printer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+mock_printer = load_mock_printer()
+
+
+def write_gcode(directory, name, count):
+    """Write a file of `count` moves over two layers"""
+    path = os.path.join(directory, name)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("G1 Z0.2\n")
+        for i in range(count):
+            if i == count // 2:
+                f.write("G1 Z0.4\n")
+            f.write(f"G1 X{i % 100} Y{i % 7} E{i}\n")
+    return path
+
+
+class TestFarm(unittest.IsolatedAsyncioTestCase):
+    """Functional checks for a farm of mock network printers"""
+
+    async def asyncSetUp(self):
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.farm = farm.Farm()
+        self.addAsyncCleanup(self.farm.close)
+
+    async def start_printers(self, count, delay=0):
+        """Serve mock printers and add them to the farm"""
+        servers, self.mocks = await mock_printer.serve(count, port=0,
+                                                       delay=delay,
+                                                       verbose=False)
+        for server in servers:
+            self.addCleanup(server.close)
+        for i, server in enumerate(servers):
+            port = server.sockets[0].getsockname()[1]
+            await self.farm.add_printer(f"printer{i}", f"127.0.0.1:{port}")
+        for printer in self.farm.printers.values():
+            self.assertTrue(await printer.core.wait_online(TIMEOUT))
+
+    async def test_shared_gcode(self):
+        """Test that a file is parsed once for all its jobs"""
+        path = write_gcode(self.directory, "part.gcode", 10)
+        first, second = await asyncio.gather(self.farm.load(path),
+                                             self.farm.load(path))
+        self.assertIs(first, second)
+        self.assertEqual(len(first), 12)
+        self.farm.forget(path)
+        self.assertIsNot(await self.farm.load(path), first)
+
+    async def test_schedule(self):
+        """Test that jobs are spread over the idle printers"""
+        await self.start_printers(10)
+        path = write_gcode(self.directory, "part.gcode", 100)
+        job = await self.farm.submit(path, copies=15)
+        await asyncio.sleep(0.01)
+        gcodes = {printer.core.mainqueue
+                  for printer in self.farm.printers.values()}
+        self.assertEqual(gcodes, {job.gcode})
+        await asyncio.wait_for(self.farm.join(), TIMEOUT)
+        self.assertEqual(job.finished, 15)
+        self.assertFalse(self.farm.busy)
+        # Each print sends its 101 lines
+        self.assertGreaterEqual(sum(mock.received for mock in self.mocks),
+                                15 * 101)
+        self.assertEqual(self.farm.status()["states"][farm.IDLE], 10)
+
+    async def test_status(self):
+        """Test the aggregate status of printers and jobs"""
+        await self.start_printers(3, delay=0.001)
+        path = write_gcode(self.directory, "part.gcode", 1000)
+        await self.farm.submit(path, copies=4, name="part")
+        await asyncio.sleep(0.05)
+        status = self.farm.status()
+        self.assertEqual(status["states"], {farm.OFFLINE: 0, farm.IDLE: 0,
+                                            farm.PRINTING: 3, farm.PAUSED: 0})
+        self.assertEqual(status["queued"], 1)
+        self.assertEqual(status["jobs"][0]["started"], 3)
+        printer = status["printers"]["printer0"]
+        self.assertEqual(printer["job"], "part")
+        self.assertGreater(printer["progress"], 0)
+        # Replies to the M105 sent when connecting
+        self.assertEqual(printer["temps"]["B"], ("23.45", "0.00"))
+
+    async def test_pause_cancel(self):
+        """Test that cancelled prints are given to the next printer"""
+        await self.start_printers(2, delay=0.001)
+        path = write_gcode(self.directory, "part.gcode", 1000)
+        job = await self.farm.submit(path, copies=3)
+        await asyncio.sleep(0.05)
+        self.assertTrue(self.farm.pause("printer0"))
+        self.assertEqual(self.farm.printers["printer0"].state, farm.PAUSED)
+        self.assertTrue(self.farm.cancel("printer0"))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.farm.printers["printer0"].state, farm.PRINTING)
+        self.assertEqual((job.started, job.failed), (3, 1))
+        await asyncio.wait_for(self.farm.join(), TIMEOUT)
+        self.assertEqual(job.finished, 2)
+        self.assertFalse(self.farm.jobs)
+
+
+class TestExpandPorts(unittest.TestCase):
+    """Checks for the parsing of printer arguments"""
+
+    def test_expand(self):
+        """Test names and port ranges"""
+        self.assertEqual(
+            farm.expand_ports(["/dev/ttyUSB0", "big=192.168.0.2:23",
+                               "localhost:8080-8081", "m=localhost:90-91"]),
+            [("/dev/ttyUSB0", "/dev/ttyUSB0"), ("big", "192.168.0.2:23"),
+             ("localhost:8080", "localhost:8080"),
+             ("localhost:8081", "localhost:8081"),
+             ("m0", "localhost:90"), ("m1", "localhost:91")])
+
+
+if __name__ == '__main__':
+    unittest.main()
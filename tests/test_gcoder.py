@@ -0,0 +1,845 @@
+"""Test suite for `printrun/gcoder.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import concurrent.futures
+import datetime
+import importlib.util
+import math
+import os
+import pathlib
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import gcoder_cache
+from printrun import gcoder_shared
+from printrun import gcoder_timing
+
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+TESTFILES = pathlib.Path(__file__).parent.parent / "testfiles"
+
+LINE_ATTRS = ("command", "is_move", "relative", "relative_e",
+              "current_tool", "x", "y", "z", "e", "f", "i", "j",
+              "current_x", "current_y", "current_z", "extruding")
+GCODE_ATTRS = ("imperial", "relative", "relative_e", "current_tool",
+               "current_x", "current_y", "current_z", "offset_x", "offset_y",
+               "offset_z", "current_e", "offset_e", "total_e", "max_e",
+               "current_f", "cutting", "current_e_multi", "offset_e_multi",
+               "total_e_multi", "max_e_multi", "filament_length",
+               "filament_length_multi", "xmin", "xmax", "ymin", "ymax",
+               "zmin", "zmax", "width", "depth", "height", "duration",
+               "all_zs", "append_layer_id")
+
+SAMPLE = """\
+; a comment first
+N1 G21 ; millimeters
+G28
+G90
+M82
+G92 E0
+G1 Z0.3 F600
+G1 X10 Y10 E1 F1200
+G1 X20 Y10 E2
+(inline) G1 X25
+G4 P500
+G91
+G1 Z0.3
+G90
+G1 X20 Y20 E3
+G92 X0 E0
+G1 X5 E0.5
+T1
+M83
+G1 X10 E1.5
+G1 Z1
+G1 X0 Y0 E2
+T0
+G20
+G1 X1 E0.1
+G21
+M3
+G1 X2
+M5
+G28 X0
+G1 Y5
+@@@
+"""
+
+
+def assert_same(test, expected, actual, label):
+    """Compare values, tolerating float rounding differences"""
+    if isinstance(expected, float) and isinstance(actual, float):
+        test.assertTrue(math.isclose(expected, actual,
+                                     rel_tol=1e-9, abs_tol=1e-9),
+                        f"{label}: {expected} != {actual}")
+    elif isinstance(expected, list) and isinstance(actual, list):
+        test.assertEqual(len(expected), len(actual), label)
+        for exp, act in zip(expected, actual):
+            assert_same(test, exp, act, label)
+    else:
+        test.assertEqual(expected, actual, label)
+
+
+def assert_same_lines(test, expected, actual):
+    """Compare line objects with the `PackedLine` views of the columnar
+    analysis, which give False for unset flags"""
+    for exp_line, act_line in zip(expected, actual):
+        for attr in LINE_ATTRS:
+            exp_value = getattr(exp_line, attr)
+            act_value = getattr(act_line, attr)
+            if act_value is False:
+                exp_value = bool(exp_value)
+            assert_same(test, exp_value, act_value,
+                        f"{exp_line.raw!r} {attr}")
+
+
+class TestParseLine(unittest.TestCase):
+    """Test `parse_line`, compiled or not, against `split`"""
+
+    LINES = ("G1 X10 Y-2.5 E.4 F1200", "N12 G1 X1*87", "n1 n2 g1 x1",
+             "(comment) G1 X1", "G1 (comment) X2 X3", "; only a comment",
+             "G20 X1", "G21 X1", "G 1 X 2", "X5", "M104 S200", "T1",
+             "G01 X1", "G1 X1 X", "G92 E0", "@@@")
+
+    def check(self, raw, imperial):
+        """Compare `parse_line` with `split` and `parse_coordinates`"""
+        expected = gcoder.PyLine(raw)
+        split_raw = gcoder.split(expected)
+        if expected.command in ("G20", "G21"):
+            imperial = expected.command == "G20"
+        if expected.command:
+            gcoder.parse_coordinates(expected, split_raw, imperial)
+        actual = gcoder.Line(raw)
+        gcoder.parse_line(actual, imperial)
+        self.assertEqual(expected.command, actual.command)
+        self.assertEqual(bool(expected.is_move), bool(actual.is_move))
+        for attr in gcoder.gcode_parsed_args:
+            expected_value = getattr(expected, attr)
+            if expected_value is None:
+                self.assertIsNone(getattr(actual, attr), attr)
+            else:
+                self.assertAlmostEqual(expected_value, getattr(actual, attr),
+                                       places=5, msg=attr)
+
+    def test_lines(self):
+        """Commands and coordinates are the same as with `split`"""
+        for raw in self.LINES:
+            for imperial in (False, True):
+                with self.subTest(raw=raw, imperial=imperial), \
+                     self.assertNoLogs(level="WARNING") \
+                     if raw != "@@@" else self.assertLogs(level="WARNING"):
+                    self.check(raw, imperial)
+
+    def test_malformed_number(self):
+        """Numbers without digits are rejected like with `float`"""
+        with self.assertRaises(ValueError):
+            gcoder.parse_line(gcoder.Line("G1 X-"))
+
+    def test_specific_code(self):
+        """S and P values are found"""
+        self.assertEqual(gcoder.S(gcoder.Line("M104 S210 ; S0")), 210)
+        self.assertEqual(gcoder.P(gcoder.Line("G4 P500")), 500)
+        self.assertIsNone(gcoder.P(gcoder.Line("G4 S1")))
+
+
+def check_edits(test, expected, actual):
+    """Check the lines and layers of edited `actual` match `expected`"""
+    test.assertEqual([gline.raw for gline in expected],
+                     [gline.raw for gline in actual])
+    test.assertEqual(expected.layer_idxs, actual.layer_idxs)
+    test.assertEqual(expected.line_idxs, actual.line_idxs)
+    for exp_layer, act_layer in zip(expected.all_layers, actual.all_layers):
+        test.assertEqual([gline.raw for gline in exp_layer],
+                         [gline.raw for gline in act_layer])
+    for i, gline in enumerate(actual.lines):
+        layer, line = actual.idxs(i)
+        test.assertEqual(actual.all_layers[layer][line].raw, gline.raw)
+
+
+class TestGCode(unittest.TestCase):
+    """Test the reference `_preprocess` engine and layer editing"""
+
+    def test_instances_independent(self):
+        """Per tool extrusion is not shared between objects"""
+        gcoder.GCode(["T2", "G1 X1 E5"])
+        self.assertEqual(gcoder.GCode(["G1 X1 E1"]).filament_length_multi,
+                         [1])
+
+    def check_index(self, gcode):
+        """Each line is found in its layer with `idxs`"""
+        self.assertEqual(len(gcode), len(gcode.lines))
+        for i, gline in enumerate(gcode.lines):
+            layer, line = gcode.idxs(i)
+            self.assertIs(gcode.all_layers[layer][line], gline)
+
+    def test_prepend_to_layer(self):
+        """Injected commands come first in the layer and in `lines`"""
+        with open(TESTFILES / "layer-detect.gcode", encoding="utf-8") as f:
+            gcode = gcoder.GCode(f)
+        count = len(gcode)
+        added = gcode.prepend_to_layer(["M117 a", " ", "M117 b"], 2)
+        self.assertEqual(added, ["M117 a", "M117 b"])
+        self.assertEqual([gline.raw for gline in gcode.all_layers[2][:2]],
+                         added)
+        self.assertEqual(len(gcode), count + 2)
+        self.check_index(gcode)
+
+    def test_rewrite_layer(self):
+        """Layers can be replaced by more, fewer or no commands"""
+        with open(TESTFILES / "layer-detect.gcode", encoding="utf-8") as f:
+            gcode = gcoder.GCode(f)
+        for layer_id, commands in ((1, ["M117 a"] * 50), (2, ["M117 b"]),
+                                   (3, [])):
+            with self.subTest(layer_id=layer_id):
+                gcode.rewrite_layer(commands, layer_id)
+                self.assertEqual([gline.raw
+                                  for gline in gcode.all_layers[layer_id]],
+                                 commands)
+                self.check_index(gcode)
+        gcode.prepend_to_layer(["M117 c"], 3)
+        self.check_index(gcode)
+        gcode.append("M105")
+        self.check_index(gcode)
+
+    def test_layer_index(self):
+        """Empty layers are skipped when looking for a line"""
+        index = gcoder.LayerIndex.from_counts([2, 0, 3, 0])
+        self.assertEqual(len(index), 5)
+        self.assertEqual([index.idxs(i) for i in range(5)],
+                         [(0, 0), (0, 1), (2, 0), (2, 1), (2, 2)])
+        self.assertEqual(index.idxs(-1), (2, 2))
+        with self.assertRaises(IndexError):
+            index.idxs(5)
+        index.resize(1, 2)
+        self.assertEqual(index.idxs(2), (1, 0))
+        self.assertEqual(list(index.layer_idxs()), [0, 0, 1, 1, 2, 2, 2])
+        self.assertEqual(list(index.line_idxs()), [0, 1, 0, 1, 0, 1, 2])
+
+
+    def test_advance(self):
+        """Parsed lines give the same state as parsing their text again"""
+        for gcode_class in (gcoder.GCode, gcoder.LightGCode,
+                            gcoder.PackedGCode):
+            with self.subTest(gcode_class=gcode_class.__name__):
+                loaded = gcode_class(SAMPLE.splitlines())
+                parsed = gcoder.GCode()
+                advanced = gcoder.GCode()
+                for gline in loaded.lines:
+                    expected = parsed.append(gline.raw, store=False)
+                    actual = advanced.advance(gline)
+                    for attr in LINE_ATTRS:
+                        assert_same(self, getattr(expected, attr),
+                                    getattr(actual, attr),
+                                    f"{gline.raw}: {attr}")
+                for attr in GCODE_ATTRS[:GCODE_ATTRS.index("max_e_multi")]:
+                    assert_same(self, getattr(parsed, attr),
+                                getattr(advanced, attr), attr)
+
+    def test_advance_untouched(self):
+        """The analyzed values of the advanced line are left as they were"""
+        gcode = gcoder.GCode(["G91", "G1 X10"])
+        analyzer = gcoder.GCode()
+        analyzer.append("G1 X5", store=False)
+        analyzer.advance(gcode.lines[0])
+        gline = analyzer.advance(gcode.lines[1])
+        self.assertEqual(gline.current_x, 15)
+        self.assertEqual(gcode.lines[1].current_x, 10)
+
+
+class TestMappedGCode(unittest.TestCase):
+    """Test lazy loading of lines from a memory-mapped file"""
+
+    def load(self, text):
+        """Write `text` to a temporary file and map it"""
+        with tempfile.NamedTemporaryFile("w", suffix=".gcode",
+                                         delete=False) as f:
+            f.write(text)
+        self.addCleanup(pathlib.Path(f.name).unlink)
+        gcode = gcoder.MappedGCode(f.name)
+        self.addCleanup(gcode.lines.data.close)
+        return gcode
+
+    def test_same_as_light(self):
+        """Lines, layers and indexes match `LightGCode`"""
+        path = TESTFILES / "layer-detect.gcode"
+        with open(path, "r", encoding="utf-8") as f:
+            expected = gcoder.LightGCode(f)
+        with open(path, "r", encoding="utf-8") as f:
+            actual = gcoder.MappedGCode(f)
+        self.addCleanup(actual.lines.data.close)
+        self.assertEqual(len(expected), len(actual))
+        self.assertEqual(expected.layer_idxs, actual.layer_idxs)
+        self.assertEqual(expected.line_idxs, actual.line_idxs)
+        self.assertEqual([line.raw for line in expected],
+                         [line.raw for line in actual])
+        for exp_layer, act_layer in zip(expected.all_layers,
+                                        actual.all_layers):
+            self.assertEqual((exp_layer.z, exp_layer.duration),
+                             (act_layer.z, act_layer.duration))
+            self.assertEqual([line.raw for line in exp_layer],
+                             [line.raw for line in act_layer])
+        self.assertEqual(expected.duration, actual.duration)
+
+    def test_lines_on_demand(self):
+        """Lines are stripped, blank ones are skipped"""
+        gcode = self.load("G28\r\n\n  G1 X10 E1  \nM84")
+        self.assertEqual(len(gcode), 3)
+        self.assertEqual(len(gcode.lines.offsets), 3)
+        layer, line = gcode.idxs(1)
+        self.assertEqual(gcode.all_layers[layer][line].raw, "G1 X10 E1")
+        self.assertEqual(gcode.lines[-1].raw, "M84")
+        self.assertTrue(gcode.has_index(2))
+        self.assertFalse(gcode.has_index(3))
+
+    def test_append(self):
+        """Commands can still be added while printing"""
+        gcode = self.load("G28\nG1 X10 E1\n")
+        gline = gcode.append("M105")
+        self.assertEqual(len(gcode), 3)
+        layer, line = gcode.idxs(2)
+        self.assertIs(gcode.all_layers[layer][line], gline)
+        self.assertIs(gcode.lines[2], gline)
+
+    def test_edit_layers(self):
+        """Layers are edited as in `GCode`, the file is left untouched"""
+        path = TESTFILES / "layer-detect.gcode"
+        with open(path, "r", encoding="utf-8") as f:
+            expected = gcoder.GCode(f)
+        actual = gcoder.MappedGCode(str(path))
+        self.addCleanup(actual.lines.data.close)
+        for gcode in (expected, actual):
+            gcode.rewrite_layer(["M117 a"] * 50, 1)
+            gcode.prepend_to_layer(["M117 b", "M117 c"], 2)
+            gcode.rewrite_layer([], 3)
+            gcode.append("M105")
+        check_edits(self, expected, actual)
+        self.assertEqual(actual.lines.raw(0), expected.lines[0].raw)
+
+    def test_empty(self):
+        """Empty files give an empty queue"""
+        with tempfile.NamedTemporaryFile(suffix=".gcode") as f:
+            gcode = gcoder.MappedGCode(f.name)
+        self.assertFalse(gcode.lines)
+        self.assertEqual(len(gcode), 0)
+
+
+class TestStreamingLoad(unittest.TestCase):
+    """Test loading layer by layer with `prepare_iter`"""
+
+    PATH = TESTFILES / "layer-detect.gcode"
+
+    def test_same_as_prepare(self):
+        """Each layer is yielded once and the result is unchanged"""
+        with open(self.PATH, "r", encoding="utf-8") as f:
+            expected = gcoder.GCode(f)
+        gcode = gcoder.GCode(deferred=True)
+        progress = []
+        with open(self.PATH, "r", encoding="utf-8") as f:
+            for layer_id in gcode.prepare_iter(f):
+                progress.append((layer_id, gcode.bytes_processed))
+                self.assertTrue(gcode.has_index(len(gcode) - 1))
+        self.assertEqual([layer_id for layer_id, _ in progress],
+                         list(range(expected.append_layer_id)))
+        processed = [done for _, done in progress]
+        self.assertEqual(processed, sorted(processed))
+        self.assertEqual(gcode.bytes_total, os.path.getsize(self.PATH))
+        self.assertEqual(gcode.bytes_processed, gcode.bytes_total)
+        self.assertFalse(gcode.loading)
+        self.assertEqual(expected.layer_idxs, gcode.layer_idxs)
+        self.assertEqual(expected.line_idxs, gcode.line_idxs)
+        for attr in GCODE_ATTRS:
+            assert_same(self, getattr(expected, attr), getattr(gcode, attr),
+                        attr)
+
+    def test_cancel(self):
+        """Cancelled loads stop quietly, keeping the lines read so far"""
+        for gcode_class in (gcoder.LightGCode, gcoder.MappedGCode):
+            with self.subTest(gcode_class=gcode_class.__name__):
+                gcode = gcode_class(deferred=True)
+                with open(self.PATH, "r", encoding="utf-8") as f:
+                    for layer_id in gcode.prepare_iter(f):
+                        if layer_id == 1:
+                            gcode.cancel()
+                if gcode_class is gcoder.MappedGCode:
+                    self.addCleanup(gcode.lines.data.close)
+                self.assertTrue(gcode.cancelled)
+                self.assertLess(gcode.bytes_processed, gcode.bytes_total)
+                self.assertEqual(len(gcode), len(gcode.lines))
+                self.assertEqual(len(gcode),
+                                 sum(len(layer) for layer in gcode.all_layers))
+                self.assertIs(gcode.all_layers[-1], gcode.append_layer)
+
+    def test_print_while_loading(self):
+        """Lines can be waited for while later layers are analyzed"""
+        with open(self.PATH, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        gcode = gcoder.GCode(deferred=True)
+        loader = gcode.prepare_iter(lines)
+        next(loader)
+        self.assertTrue(gcode.loading)
+        self.assertTrue(gcode.has_index(0))
+        loaded = len(gcode)
+        self.assertLess(loaded, len(lines))
+        self.assertIsNone(gcode.append("M105"))
+        thread = threading.Thread(target=lambda: list(loader))
+        waiter = threading.Timer(0.1, thread.start)
+        waiter.start()
+        self.assertTrue(gcode.has_index(loaded))
+        self.assertFalse(gcode.has_index(len(lines) + 1))
+        waiter.join()
+        thread.join()
+        self.assertEqual(gcode.lines[-1].raw, "M105")
+        layer, line = gcode.idxs(len(gcode) - 1)
+        self.assertIs(gcode.all_layers[layer][line], gcode.lines[-1])
+
+
+class TestPackedGCode(unittest.TestCase):
+    """Test column storage of analyzed lines"""
+
+    def test_same_as_gcode(self):
+        """Line attributes, layers and results match `GCode`"""
+        with self.assertLogs(level="WARNING"):
+            expected = gcoder.GCode(SAMPLE.splitlines())
+            actual = gcoder.PackedGCode(SAMPLE.splitlines())
+        self.assertIsInstance(actual.lines, gcoder.PackedLines)
+        self.assertEqual(expected.layer_idxs, actual.layer_idxs)
+        self.assertEqual(expected.line_idxs, actual.line_idxs)
+        for exp_line, act_line in zip(expected.lines, actual.lines):
+            self.assertEqual(exp_line.raw, act_line.raw)
+            for attr in LINE_ATTRS:
+                exp_value = getattr(exp_line, attr)
+                act_value = getattr(act_line, attr)
+                if act_value is False:
+                    exp_value = bool(exp_value)
+                self.assertEqual(exp_value, act_value,
+                                 f"{attr} of {exp_line.raw}")
+        for attr in GCODE_ATTRS:
+            assert_same(self, getattr(expected, attr), getattr(actual, attr),
+                        attr)
+
+    def test_write_through(self):
+        """Attributes set on views are stored in the columns"""
+        gcode = gcoder.PackedGCode(["G28", "G1 X10 E1"])
+        layer, line = gcode.idxs(1)
+        gcode.all_layers[layer][line].gcview_end_vertex = 42
+        self.assertEqual(gcode.lines[1].gcview_end_vertex, 42)
+        self.assertIsNone(gcode.lines[0].gcview_end_vertex)
+        gcode.lines[1].extruding = False
+        self.assertFalse(gcode.lines[1].extruding)
+        self.assertTrue(gcode.lines[1].is_move)
+        self.assertTrue(math.isnan(gcode.lines.x[0]))
+        self.assertEqual(gcode.lines.x[1], 10)
+
+    def test_edit_layers(self):
+        """Layers are edited as in `GCode`, columns are left untouched"""
+        with open(TESTFILES / "layer-detect.gcode", encoding="utf-8") as f:
+            data = f.readlines()
+        expected = gcoder.GCode(data)
+        actual = gcoder.PackedGCode(data)
+        count = len(actual.lines.offsets)
+        for gcode in (expected, actual):
+            gcode.prepend_to_layer(["M117 a"], 2)
+            gcode.rewrite_layer(["M117 b", "M117 c"], 1)
+            gcode.rewrite_layer([], 4)
+            gcode.append("M105")
+        check_edits(self, expected, actual)
+        self.assertEqual(len(actual.lines.offsets), count)
+        layer, line = actual.idxs(len(actual) - 1)
+        self.assertIs(actual.all_layers[layer][line], actual.lines[-1])
+
+    def test_append(self):
+        """Commands can still be added while printing"""
+        gcode = gcoder.PackedGCode(["G28", "G1 X10 E1"])
+        gline = gcode.append("M105")
+        self.assertEqual(len(gcode), 3)
+        self.assertIs(gcode.lines[2], gline)
+        self.assertEqual([line.raw for line in gcode],
+                         ["G28", "G1 X10 E1", "M105"])
+
+
+class TestTimeEstimator(unittest.TestCase):
+    """Test the planner based print time estimation"""
+
+    def estimate(self, lines, gcode_class=gcoder.GCode, limits=None):
+        """Estimated duration of `lines`, in seconds"""
+        gcode = gcode_class(lines)
+        total = gcoder_timing.TimeEstimator(limits).estimate(gcode)
+        self.assertAlmostEqual(total, sum(layer.duration
+                                          for layer in gcode.all_layers))
+        self.assertEqual(gcode.duration.total_seconds(), int(total))
+        return total
+
+    def test_trapezoid(self):
+        """A long move accelerates, cruises then decelerates"""
+        total = self.estimate(["G1 X100 F6000"])
+        # 100 mm at 100 mm/s, plus the time lost accelerating at 3000
+        self.assertAlmostEqual(total, 1 + 100 / 3000, places=3)
+
+    def test_triangle(self):
+        """Short moves never reach their feedrate"""
+        total = self.estimate(["G1 X1 F6000"])
+        self.assertAlmostEqual(total, 2 * math.sqrt(1 / 3000), places=3)
+
+    def test_axis_limits(self):
+        """Per axis feedrate limits apply, from the file or settings"""
+        self.assertAlmostEqual(self.estimate(["G1 Z10 F6000"]), 2 + 5 / 100,
+                               places=2)
+        limits = gcoder_timing.MachineLimits.from_commands(
+            "M203 X50, M201 X1000")
+        self.assertAlmostEqual(
+            self.estimate(["G1 X100 F6000"], limits=limits),
+            2 + 50 / 1000, places=3)
+        self.assertAlmostEqual(
+            self.estimate(["M203 X50", "M201 X1000", "G1 X100 F6000"]),
+            2 + 50 / 1000, places=3)
+
+    def test_junctions(self):
+        """Straight junctions are free, reversals stop the head"""
+        straight = self.estimate(["G1 X50 F6000", "G1 X100"])
+        self.assertAlmostEqual(straight, self.estimate(["G1 X100 F6000"]),
+                               places=3)
+        reversal = self.estimate(["G1 X50 F6000", "G1 X0"])
+        self.assertAlmostEqual(reversal, 2 * (0.5 + 100 / 3000), places=3)
+        corner = self.estimate(["G1 X50 F6000", "G1 Y50"])
+        self.assertLess(straight, corner)
+        self.assertLess(corner, reversal)
+        classic = self.estimate(["M205 X10 Y10", "G1 X50 F6000", "G1 Y50"])
+        self.assertLess(classic, reversal)
+
+    def test_dwell(self):
+        """Dwells are added to the layer they are in"""
+        self.assertAlmostEqual(self.estimate(["G4 P500", "G4 S2"]), 2.5)
+
+    def test_light(self):
+        """Lines of lightweight classes are parsed again"""
+        with open(TESTFILES / "arc_test.gcode", encoding="utf-8") as f:
+            lines = f.readlines()
+        expected = self.estimate(lines)
+        self.assertGreater(expected, 0)
+        for gcode_class in (gcoder.LightGCode, gcoder.PackedGCode):
+            with self.subTest(gcode_class=gcode_class.__name__):
+                self.assertAlmostEqual(expected,
+                                       self.estimate(lines, gcode_class))
+
+
+class TestAnalysisCache(unittest.TestCase):
+    """Test the persistent G-code analysis cache"""
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = pathlib.Path(tempdir.name) / "part.gcode"
+        shutil.copy(TESTFILES / "layer-detect.gcode", self.path)
+        self.cache = gcoder_cache.AnalysisCache(
+            pathlib.Path(tempdir.name) / "cache", 1024 * 1024)
+
+    def reload(self, gcode_class, home_pos=(1, 2, 3)):
+        """Analyze the file, store it, and load it back from the cache"""
+        expected = gcode_class(deferred=True)
+        self.assertFalse(self.cache.load(expected, self.path, home_pos))
+        with open(self.path, "r", encoding="utf-8") as f:
+            expected.prepare(f, home_pos)
+        self.cache.store(expected, self.path, home_pos)
+        layers = []
+        actual = gcode_class(deferred=True)
+        self.assertTrue(self.cache.load(actual, self.path, home_pos,
+                                        lambda g, i: layers.append(i)))
+        self.assertEqual(layers, list(range(len(actual.all_layers) - 1)))
+        return expected, actual
+
+    def check_same(self, expected, actual):
+        """Compare analysis results and layers content"""
+        for attr in gcoder_cache.STATE_ATTRS + ("duration", "all_zs",
+                                                "append_layer_id",
+                                                "layer_idxs", "line_idxs"):
+            self.assertEqual(getattr(expected, attr), getattr(actual, attr),
+                             attr)
+        self.assertEqual(
+            [(layer.z, layer.duration, [line.raw for line in layer])
+             for layer in expected.all_layers],
+            [(layer.z, layer.duration, [line.raw for line in layer])
+             for layer in actual.all_layers])
+
+    def test_light(self):
+        """Cached `LightGCode` analysis is restored"""
+        self.check_same(*self.reload(gcoder.LightGCode))
+
+    def test_mapped(self):
+        """Cached `MappedGCode` analysis and line offsets are restored"""
+        expected, actual = self.reload(gcoder.MappedGCode)
+        self.addCleanup(expected.lines.data.close)
+        self.addCleanup(actual.lines.data.close)
+        self.check_same(expected, actual)
+        self.assertEqual(expected.lines.offsets, actual.lines.offsets)
+
+    def test_full_gcode_not_cached(self):
+        """Objects with per line results are always analyzed"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            gcode = gcoder.GCode(f)
+        self.cache.store(gcode, self.path)
+        self.assertFalse(self.cache.load(gcoder.GCode(deferred=True),
+                                         self.path))
+
+    def test_changed_file(self):
+        """Entries are not used once the file changed"""
+        self.reload(gcoder.LightGCode)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("G1 X0\n")
+        self.assertFalse(self.cache.load(gcoder.LightGCode(deferred=True),
+                                         self.path, (1, 2, 3)))
+
+    def test_settings(self):
+        """Analyzer settings are part of the key"""
+        self.reload(gcoder.LightGCode)
+        self.assertFalse(self.cache.load(gcoder.LightGCode(deferred=True),
+                                         self.path, (0, 0, 0)))
+
+    def test_eviction(self):
+        """Least recently used entries are removed first"""
+        self.reload(gcoder.LightGCode, (0, 0, 0))
+        old_entry, = self.cache.directory.iterdir()
+        os.utime(old_entry, ns=(0, 0))
+        self.reload(gcoder.LightGCode, (1, 1, 1))
+        self.cache.max_size = max(entry.stat().st_size for entry
+                                  in self.cache.directory.iterdir())
+        self.cache.evict()
+        self.assertEqual(len(list(self.cache.directory.iterdir())), 1)
+        self.assertFalse(old_entry.exists())
+
+
+class TestJobStore(unittest.TestCase):
+    """Test G-code jobs shared through mapped job files"""
+
+    def setUp(self):
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.path = pathlib.Path(tempdir.name) / "part.gcode"
+        shutil.copy(TESTFILES / "layer-detect.gcode", self.path)
+        self.store = gcoder_shared.JobStore(
+            pathlib.Path(tempdir.name) / "jobs", 0)
+
+    def open(self, *args):
+        """Open the job of the file, closed at the end of the test"""
+        gcode = self.store.open(self.path, *args)
+        self.addCleanup(gcode.close)
+        return gcode
+
+    def test_same_as_mapped(self):
+        """Lines, layers and analysis match `MappedGCode`"""
+        expected = gcoder.MappedGCode(self.path, home_pos=(1, 2, 3))
+        self.addCleanup(expected.lines.data.close)
+        actual = self.open((1, 2, 3))
+        for attr in gcoder_cache.STATE_ATTRS + ("duration", "all_zs",
+                                                "append_layer_id", "home_pos",
+                                                "layer_idxs", "line_idxs"):
+            self.assertEqual(getattr(expected, attr), getattr(actual, attr),
+                             attr)
+        self.assertEqual(
+            [(layer.z, layer.duration, [line.raw for line in layer])
+             for layer in expected.all_layers],
+            [(layer.z, layer.duration, [line.raw for line in layer])
+             for layer in actual.all_layers])
+        layer, line = actual.idxs(len(actual) - 1)
+        self.assertEqual(actual.all_layers[layer][line].raw,
+                         expected.lines[-1].raw)
+        self.assertFalse(actual.has_index(len(actual)))
+
+    def test_parsed_once(self):
+        """Later opens map the job file written by the first one"""
+        first = self.open()
+        with mock.patch.object(gcoder.MappedGCode, "prepare") as prepare:
+            second = self.open()
+        prepare.assert_not_called()
+        self.assertEqual(second.identity, first.identity)
+        self.assertEqual(second.layer_idxs, first.layer_idxs)
+        self.assertEqual(len(list(self.store.directory.iterdir())), 1)
+
+    def test_changed_file(self):
+        """Jobs are parsed again once the file changed"""
+        first = self.open()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("G1 X0\n")
+        second = self.open()
+        self.assertEqual(len(second), len(first) + 1)
+        self.assertEqual(second.lines[-1].raw, "G1 X0")
+        # The old job file was replaced but stays mapped
+        self.assertEqual(first.lines[-1].raw, second.lines[-2].raw)
+
+    def test_analyzer_key(self):
+        """Jobs analyzed with other settings are kept apart"""
+        def estimator(seconds):
+            def analyze(gcode):
+                gcode.duration = datetime.timedelta(seconds=seconds)
+            return analyze
+
+        slow = self.open(None, estimator(1), {"seconds": 1})
+        fast = self.open(None, estimator(2), {"seconds": 2})
+        self.assertEqual(slow.duration.total_seconds(), 1)
+        self.assertEqual(fast.duration.total_seconds(), 2)
+        self.assertEqual(len(list(self.store.directory.iterdir())), 2)
+
+    def test_too_big(self):
+        """Jobs bigger than the size limit are still opened and kept"""
+        other = self.open()
+        self.store.max_size = 1000
+        gcode = self.open((1, 2, 3))
+        self.assertGreater(os.path.getsize(gcode.path), 1000)
+        self.assertEqual(len(gcode), len(other))
+        self.assertEqual(list(self.store.directory.iterdir()),
+                         [pathlib.Path(gcode.path)])
+
+    def test_append(self):
+        """Appended commands are only seen by their object"""
+        first = self.open()
+        second = self.open()
+        gline = first.append("M105")
+        self.assertEqual(len(first), len(second) + 1)
+        layer, line = first.idxs(len(first) - 1)
+        self.assertIs(first.all_layers[layer][line], gline)
+        self.assertFalse(first.editable)
+        self.assertRaises(gcoder_shared.ReadOnlyJobError,
+                          first.rewrite_layer, [], 0)
+        self.assertRaises(gcoder_shared.ReadOnlyJobError, first.prepare, [])
+
+    def test_pickle(self):
+        """Objects sent to other processes map the same job file"""
+        gcode = self.open()
+        copy = pickle.loads(pickle.dumps(gcode))
+        self.addCleanup(copy.close)
+        self.assertEqual(copy.path, gcode.path)
+        self.assertEqual([line.raw for line in copy],
+                         [line.raw for line in gcode])
+
+    def test_invalid(self):
+        """Damaged job files are written again"""
+        self.open().close()
+        entry, = self.store.directory.iterdir()
+        with open(entry, "r+b") as f:
+            f.truncate(100)
+        with self.assertLogs(level="WARNING"):
+            gcode = self.open()
+        self.assertEqual(len(gcode.lines.offsets), len(gcode))
+
+
+@unittest.skipUnless(HAS_NUMPY, "NumPy is required for columnar analysis")
+class TestColumnarAnalysis(unittest.TestCase):
+    """Check the columnar engine gives the same results as `_preprocess`"""
+
+    def compare(self, data, gcode_class=gcoder.GCode, **kwargs):
+        """Load `data` with both engines and compare everything"""
+        callbacks = ([], [])
+        expected = gcode_class(
+            data, layer_callback=lambda g, i: callbacks[0].append(i),
+            **kwargs)
+        actual = gcode_class(
+            data, layer_callback=lambda g, i: callbacks[1].append(i),
+            columnar=True, **kwargs)
+        for attr in GCODE_ATTRS:
+            assert_same(self, getattr(expected, attr), getattr(actual, attr),
+                        attr)
+        self.assertEqual(callbacks[0], callbacks[1])
+        self.assertEqual(expected.layer_idxs, actual.layer_idxs)
+        self.assertEqual(expected.line_idxs, actual.line_idxs)
+        self.assertEqual(
+            [(layer.z, len(layer)) for layer in expected.all_layers],
+            [(layer.z, len(layer)) for layer in actual.all_layers])
+        for exp_layer, act_layer in zip(expected.all_layers,
+                                        actual.all_layers):
+            assert_same(self, float(exp_layer.duration),
+                        float(act_layer.duration), "layer duration")
+        # Lines are stored in columns, as by `PackedGCode`
+        self.assertIsInstance(actual.lines, gcoder.PackedLines)
+        self.assertEqual([line.raw for line in expected.lines],
+                         [line.raw for line in actual.lines])
+        if gcode_class.line_class is gcoder.Line:
+            assert_same_lines(self, expected.lines, actual.lines)
+        return actual
+
+    def test_sample(self):
+        """Modal states, offsets, tools and units are tracked"""
+        with self.assertLogs(level="WARNING"):
+            gcode = self.compare(SAMPLE.splitlines())
+        self.assertEqual(len(gcode.filament_length_multi), 2)
+
+    def test_cutting_as_extrusion(self):
+        """Moves are extruding when a cutting tool is on"""
+        with self.assertLogs(level="WARNING"):
+            self.compare(SAMPLE.splitlines(), cutting_as_extrusion=True)
+
+    def test_light(self):
+        """Light lines are left untouched"""
+        with self.assertLogs(level="WARNING"):
+            self.compare(SAMPLE.splitlines(), gcoder.LightGCode)
+
+    def test_numbers(self):
+        """Numbers are parsed like `float` does"""
+        gcode = self.compare([
+            "G1 X-0 Y5. Z.5 E+3 F1200", "G1 X 12.5 Y\t-3 (comment X1)",
+            "G1 X123456789.0123456789 Y0.1234567890123456789 E1e5",
+            "G1 X0.30000000000000004 Y1.2.3 Z7", "G1 X1 X2 Y Z", "M117 X-",
+            "G1 X.1 Y-.25 E0.00001"])
+        self.assertEqual(gcode.lines[1].y, -3)
+        self.assertEqual(gcode.lines[4].x, 2)
+
+    def test_blank(self):
+        """Files without any command give no layer"""
+        gcode = self.compare(["", "   "])
+        self.assertEqual(len(gcode.all_layers), 1)
+
+    def test_workers(self):
+        """Parsing in several processes gives the same results"""
+        with open(TESTFILES / "layer-detect.gcode", "r",
+                  encoding="utf-8") as f:
+            data = f.readlines()
+        expected = gcoder.GCode(data)
+        actual = gcoder.GCode(deferred=True)
+        # Small files are otherwise parsed serially
+        with mock.patch.object(gcoder, "MIN_LINES_PER_WORKER", 1), \
+             mock.patch("os.sched_getaffinity", create=True,
+                        return_value=set(range(3))), \
+             mock.patch.object(concurrent.futures, "ProcessPoolExecutor",
+                               wraps=concurrent.futures.ProcessPoolExecutor
+                               ) as pool:
+            actual.prepare(data, workers=3)
+        pool.assert_called_once_with(3)
+        for attr in GCODE_ATTRS + ("layer_idxs", "line_idxs"):
+            assert_same(self, getattr(expected, attr), getattr(actual, attr),
+                        attr)
+        assert_same_lines(self, expected.lines, actual.lines)
+
+    def test_workers_fallback(self):
+        """Files too small to share between processes are parsed serially"""
+        data = ["G28", "G1 X10 E1"]
+        with mock.patch.object(gcoder.GCode, "_prepare_columnar") as columnar:
+            gcode = gcoder.GCode(deferred=True)
+            gcode.prepare(iter(data), workers=4)
+        columnar.assert_not_called()
+        self.assertEqual([line.raw for line in gcode], data)
+        with mock.patch("os.sched_getaffinity", create=True,
+                        return_value=set(range(8))):
+            count = 3 * gcoder.MIN_LINES_PER_WORKER
+            self.assertEqual(gcoder._parallel_workers(count, 4), 3)
+            self.assertEqual(gcoder._parallel_workers(count, 2), 2)
+            self.assertEqual(gcoder._parallel_workers(10, 4), 1)
+            self.assertEqual(gcoder._parallel_workers(count, None), 1)
+        with mock.patch("os.sched_getaffinity", create=True,
+                        return_value={0}):
+            self.assertEqual(gcoder._parallel_workers(count, 4), 1)
+
+    def test_files(self):
+        """Sample files are analyzed identically"""
+        for path in sorted(TESTFILES.glob("*.gcode")):
+            with self.subTest(path=path.name):
+                with open(path, "r", encoding="utf-8") as data:
+                    self.compare(data.readlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -43,11 +43,42 @@ def mock_sttyhup(cls):
         mock.patch("printrun.device.Device._disable_ttyhup"))
 
 
+class FakeReadinto:
+    """Side effect for `readinto` mocks, reading the lines `read_function`
+    returns, which are given an end of line if they lack one"""
+
+    def __init__(self, read_function, none_error=None):
+        self.read_function = read_function
+        # Raised when `read_function` returns None, which otherwise means
+        # no data is available
+        self.none_error = none_error
+        self.pending = b''
+
+    def __call__(self, buffer):
+        if not self.pending:
+            data = self.read_function()
+            if data is None:
+                if self.none_error is not None:
+                    raise self.none_error
+                return None
+            if data and not data.endswith(b'\n'):
+                data += b'\n'
+            self.pending = data
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
 def mock_serial(test, read_function=slow_printer):
     """Fake Serial device with slow response and always open"""
     class_mock = mock.create_autospec(serial.Serial)
     instance_mock = class_mock.return_value
-    instance_mock.readline.side_effect = read_function
+    readinto = FakeReadinto(read_function, serial.SerialException(
+        "device reports readiness to read but returned no data"))
+    instance_mock.readinto.side_effect = readinto
+    type(instance_mock).in_waiting = mock.PropertyMock(
+        side_effect=lambda: len(readinto.pending))
     instance_mock.is_open = True
     return test.enterContext(mock.patch("serial.Serial", class_mock))
 
@@ -57,7 +88,7 @@ def mock_socket(test, read_function=slow_printer):
     class_mock = mock.create_autospec(socket.socket)
     instance_mock = class_mock.return_value
     socket_file = instance_mock.makefile.return_value
-    socket_file.read.side_effect = read_function
+    socket_file.readinto.side_effect = FakeReadinto(read_function)
     return test.enterContext(mock.patch("socket.socket", class_mock))
 
 
@@ -293,6 +324,16 @@ class TestDisconnect(unittest.TestCase):
             self.assertIsNone(self.core.read_thread)
             self.assertIsNone(self.core.send_thread)
 
+    def test_event_bus(self):
+        """Test that events are published on the event bus"""
+        received = []
+        self.core.event_bus.subscribe("disconnect",
+                                      lambda: received.append("disconnect"))
+        self.addCleanup(self.core.event_bus.close)
+        self.core.disconnect()
+        self.assertTrue(self.core.event_bus.flush(1))
+        self.assertEqual(received, ["disconnect"])
+
     def test_disconnect_error(self):
         """Test that an error is logged if disconnection fails"""
         with (
@@ -600,6 +641,58 @@ class TestPrint(unittest.TestCase):
                      (self.mocked_handler.on_end, self.end_cb),
                      "assert_called_once")
 
+    def test_windowed_print(self):
+        """Test a print keeping several lines in flight"""
+        window_size = 4
+        self.core.connect("/mocked/port", 1000, window_size=window_size)
+        wait_printer_cycles(2)
+        in_flight = []
+        self.mocked_serial.return_value.write.side_effect = \
+            lambda data: in_flight.append(len(self.core.window))
+        self.core.startprint(self.print_code)
+        wait_printer_cycles(self.print_line_count*1.5)
+
+        with self.subTest("Check that serial.Serial.write() was called"):
+            self.check_finished_print()
+
+        with self.subTest("Check the window size is not exceeded"):
+            self.assertLessEqual(max(in_flight), window_size)
+
+    def test_bounded_history(self):
+        """Test that only counters and recent lines are kept"""
+        self.core.resend_buffer_size = 4
+        self.core.sent_log_size = 0
+        kept = []
+        self.mocked_serial.return_value.write.side_effect = \
+            lambda data: kept.append(len(self.core.sentlines))
+        self.core.startprint(self.print_code)
+        wait_printer_cycles(self.print_line_count*1.5)
+
+        with self.subTest("Check that serial.Serial.write() was called"):
+            self.check_finished_print()
+
+        with self.subTest("Check no more lines than requested were kept"):
+            self.assertLessEqual(max(kept), 4)
+            self.assertEqual(len(self.core.sent), 0)
+
+        with self.subTest("Check commands and bytes were counted"):
+            # Line numbers are reset before and after the print
+            self.assertEqual(self.core.sent_count, self.print_line_count + 2)
+            self.assertGreater(self.core.sent_bytes,
+                               sum(map(len, self.parsed_print_code)))
+
+    def test_print_lines_not_parsed(self):
+        """Test that printed lines are not parsed again when sent"""
+        analyzer = self.core.analyzer
+        with mock.patch.object(analyzer, "append",
+                               wraps=analyzer.append) as append:
+            self.core.startprint(self.print_code)
+            wait_printer_cycles(self.print_line_count*1.5)
+        self.check_finished_print()
+        # Only line number resets are parsed
+        self.assertEqual(append.call_count, 2)
+        self.assertEqual(analyzer.abs_z, self.print_layer_count - 1)
+
     def test_host_command(self):
         """Test calling host-commands"""
         print_lines = []
@@ -612,6 +705,346 @@ class TestPrint(unittest.TestCase):
         self.assertTrue(self.core.paused)
 
 
+class TestBatchedWrites(unittest.TestCase):
+    """Checks for the batching of lines in TCP streaming mode"""
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def setUp(self):
+        self.core, mocked_socket = setup_socket_core(self)
+        self.socket_file = mocked_socket.return_value.makefile.return_value
+        self.core.tcp_streaming_mode = True
+        self.commands = [f"G1 X{i} Y{i}" for i in range(100)]
+
+    def written(self):
+        """Data written to the socket"""
+        return b''.join(call.args[0]
+                        for call in self.socket_file.write.call_args_list)
+
+    def print_all(self):
+        """Print the commands and wait for the end of the print"""
+        self.socket_file.write.reset_mock()
+        self.assertTrue(self.core.startprint(gcoder.GCode(self.commands)))
+        for _ in range(100):
+            if not self.core.printing:
+                break
+            wait_printer_cycles(1)
+        self.assertFalse(self.core.printing)
+
+    def test_batches(self):
+        """Test lines are written in batches of the requested size"""
+        self.core.batch_size = 64
+        self.core.batch_latency = 10
+        self.print_all()
+        expected = "".join(f"{command}\n" for command in self.commands)
+        with self.subTest("Check all lines were written in order"):
+            self.assertIn(expected.encode(), self.written())
+        with self.subTest("Check writes did not exceed the batch size"):
+            # A batch is written once a line makes it reach the size, the
+            # last one also holds the line number reset of the print end
+            limit = 64 + max(map(len, self.commands))
+            for call in self.socket_file.write.call_args_list[:-1]:
+                self.assertLessEqual(len(call.args[0]), limit)
+        self.assertGreater(self.core.batched_lines,
+                           4 * self.core.batched_writes)
+
+    def test_disabled(self):
+        """Test lines are written one by one without batching"""
+        self.core.batch_size = 0
+        self.print_all()
+        self.assertIn(b"G1 X99 Y99\n", [call.args[0] for call
+                      in self.socket_file.write.call_args_list])
+        self.assertEqual(self.core.batched_writes, 0)
+
+
+class TestSendWindow(unittest.TestCase):
+    """Checks for the acknowledgement accounting of printcore.SendWindow"""
+
+    def test_line_limit(self):
+        """Test that no more than `size` lines are in flight"""
+        window = printcore.SendWindow(3)
+        for i in range(3):
+            self.assertTrue(window.has_room(10))
+            window.sent(10, i)
+        self.assertFalse(window.has_room(10))
+        window.ack("ok")
+        self.assertTrue(window.has_room(10))
+        self.assertEqual(len(window), 2)
+
+    def test_byte_budget(self):
+        """Test that lines in flight fit in the receive buffer"""
+        window = printcore.SendWindow(8, rx_buffer_size=64)
+        window.sent(40, 0)
+        self.assertTrue(window.has_room(24))
+        self.assertFalse(window.has_room(25))
+        window.ack("ok")
+        with self.subTest("Check a long line can be sent alone"):
+            self.assertTrue(window.has_room(100))
+
+    def test_advanced_ok(self):
+        """Test acknowledgements and tuning from ADVANCED_OK replies"""
+        window = printcore.SendWindow(0)
+        self.assertEqual(window.size, printcore.SendWindow.AUTO_SIZE)
+        for i in range(4):
+            window.sent(10, i)
+        # The reply to line 0 was lost
+        window.ack("ok N1 P15 B3")
+        with self.subTest("Check lines up to N are acknowledged"):
+            self.assertEqual([n for n, _ in window.pending], [2, 3])
+            self.assertEqual(window.used, 20)
+        with self.subTest("Check the window grows to the buffer size"):
+            self.assertEqual(window.size, 4)
+            self.assertEqual(window.planner_free, 15)
+            self.assertEqual(window.buffer_free, 3)
+        window.ack("ok N3 P15 B0")
+        with self.subTest("Check the window does not shrink"):
+            self.assertEqual(window.size, 4)
+
+    def test_resend(self):
+        """Test resend requests for lines in the window"""
+        window = printcore.SendWindow(4)
+        for i in range(4):
+            window.sent(10, i)
+        with self.subTest("Check the first request is honoured"):
+            self.assertTrue(window.resend(1))
+            self.assertEqual(len(window), 0)
+        window.ack("ok")
+        window.sent(10, 1)
+        with self.subTest("Check requests from dropped lines are ignored"):
+            self.assertFalse(window.resend(1))
+            window.ack("ok")
+            self.assertFalse(window.resend(1))
+            window.ack("ok")
+            self.assertEqual(len(window), 1)
+        with self.subTest("Check a new request is honoured"):
+            self.assertTrue(window.resend(1))
+
+
+class TestWireBuffer(unittest.TestCase):
+    """Checks for the lines encoded ahead by printcore.WireBuffer"""
+
+    def setUp(self):
+        self.code = gcoder.GCode(["G28 ; home", "; comment only", "G1 X1",
+                                  "M117 (message) done", "G1 X2"])
+
+    def prepare(self, **kwargs):
+        """Start a wire buffer and wait for all lines to be encoded"""
+        wire = printcore.WireBuffer(self.code, **kwargs)
+        self.addCleanup(wire.stop)
+        wire.start()
+        while wire.thread.is_alive() and len(wire.entries) < wire.ahead:
+            time.sleep(0.001)
+        return wire
+
+    def test_encoding(self):
+        """Test lines are stripped, numbered and checksummed"""
+        wire = self.prepare()
+        sent = []
+        lineno = 0
+        for i, gline in enumerate(self.code.lines):
+            text, command, data = wire.get(i, lineno, gline.raw)
+            if text:
+                self.assertEqual(command + "\n", data.decode())
+                sent.append(data)
+                lineno += 1
+        self.assertEqual(sent, [checksum_command("G28", 0),
+                                checksum_command("G1 X1", 1),
+                                checksum_command("M117  done", 2),
+                                checksum_command("G1 X2", 3)])
+
+    def test_renumbering(self):
+        """Test lines sent with another number are renumbered"""
+        wire = self.prepare(index=2, lineno=10)
+        _, _, data = wire.get(2, 42, self.code.lines[2].raw)
+        self.assertEqual(data, checksum_command("G1 X1", 42))
+
+    def test_flow_control(self):
+        """Test lines are not numbered without checksums"""
+        wire = self.prepare(checksum=False)
+        self.assertEqual(wire.get(0, 5, self.code.lines[0].raw),
+                         ("G28", "G28", b'G28\n'))
+
+    def test_fallback(self):
+        """Test that lines not ready or replaced are not returned"""
+        wire = self.prepare(ahead=2)
+        self.assertIsNone(wire.get(0, 0, "G28"))
+        wire.stop()
+        self.assertIsNone(wire.get(2, 1, self.code.lines[2].raw))
+
+    def test_packed_lines(self):
+        """Test lines created on each access, as in packed G-code, match"""
+        self.code = gcoder.PackedGCode([line.raw for line in self.code])
+        wire = self.prepare()
+        self.assertIsNot(self.code.lines[2], self.code.lines[2])
+        _, _, data = wire.get(2, 1, self.code.lines[2].raw)
+        self.assertEqual(data, checksum_command("G1 X1", 1))
+
+
+class TestResendBuffer(unittest.TestCase):
+    """Checks for the line history of printcore.ResendBuffer"""
+
+    def test_lookup(self):
+        """Test lines are found by line number"""
+        lines = printcore.ResendBuffer(8)
+        for i in range(5):
+            lines[i] = f"N{i} G1 X{i}"
+        self.assertEqual(lines[3], "N3 G1 X3")
+        self.assertIn(0, lines)
+        self.assertNotIn(5, lines)
+        self.assertNotIn(-1, lines)
+        self.assertEqual(len(lines), 5)
+        with self.assertRaises(KeyError):
+            lines[6]
+
+    def test_eviction(self):
+        """Test that only the last `size` lines are kept"""
+        lines = printcore.ResendBuffer(4)
+        for i in range(10):
+            lines[i] = f"N{i} G1 X{i}"
+        self.assertEqual(len(lines), 4)
+        self.assertEqual([i for i in range(10) if i in lines], [6, 7, 8, 9])
+        with self.assertRaises(KeyError):
+            lines[5]
+        with self.subTest("Check a line can be sent again"):
+            lines[8] = "N8 G1 X8"
+            self.assertEqual(len(lines), 4)
+        lines.clear()
+        self.assertEqual(len(lines), 0)
+        self.assertNotIn(9, lines)
+
+
+class TestClassifyLine(unittest.TestCase):
+    """Checks for the classification of received lines"""
+
+    def test_kinds(self):
+        """Test lines from different firmwares"""
+        lines = {
+            "ok\n": printcore.LINE_OK,
+            "ok N12 P15 B3\n": printcore.LINE_OK,
+            "ok T:20.0 /0.0 B:21.0 /0.0 @:0 B@:0\n": printcore.LINE_OK_TEMP,
+            "ok T0:24.06 /34.00 B:23.45 /0.00 T1:44.28 /54\n":
+                printcore.LINE_OK_TEMP,
+            " T:210.00 /210.00 B:60.00 /60.00 @:0 B@:0\n":
+                printcore.LINE_TEMP,
+            "T:200.5 E:0 W:?\n": printcore.LINE_TEMP,
+            "X:1.00 Y:2.00 Z:0.30 E:0.00 Count X:80 Y:160 Z:120\n":
+                printcore.LINE_POSITION,
+            "ok C: X:1.00 Y:2.00 Z:0.30 E:0.00\n": printcore.LINE_POSITION,
+            "Resend: 12\n": printcore.LINE_RESEND,
+            "rs N2 Expected checksum 67\n": printcore.LINE_RESEND,
+            "Error:checksum mismatch, Last Line: 11\n": printcore.LINE_ERROR,
+            "echo:busy: processing\n": printcore.LINE_BUSY,
+            "busy: paused for user\n": printcore.LINE_BUSY,
+            "//action:pause\n": printcore.LINE_ACTION,
+            "// Printing layer 3\n": printcore.LINE_ACTION,
+            "!! Heater decoupled\n": printcore.LINE_ACTION,
+            "echo:SD card ok\n": printcore.LINE_ECHO,
+            "DEBUG_INFO ENABLED\n": printcore.LINE_DEBUG,
+            "Cap:AUTOREPORT_TEMP:1\n": printcore.LINE_CAPABILITY,
+            "SD printing byte 123/4567\n": printcore.LINE_SD_STATUS,
+            "Not SD printing\n": printcore.LINE_SD_STATUS,
+            "start\n": printcore.LINE_GREETING,
+            "Grbl 1.1h ['$' for help]\n": printcore.LINE_GREETING,
+            "Begin file list\n": printcore.LINE_OTHER,
+            "": printcore.LINE_OTHER,
+        }
+        for line, kind in lines.items():
+            with self.subTest(line=line):
+                received = printcore.classify_line(line, ["start", "Grbl "])
+                self.assertEqual(received.kind, kind)
+                self.assertEqual(received, line)
+                self.assertEqual(received.ok, line.startswith("ok"))
+
+    def test_resend(self):
+        """Test that the requested line number is parsed"""
+        self.assertEqual(printcore.classify_line("Resend: 12\n").resend, 12)
+        self.assertEqual(printcore.classify_line("resend:3\n").resend, 3)
+        self.assertIsNone(printcore.classify_line("ok 12\n").resend)
+
+    def test_greetings(self):
+        """Test that greetings are only known when given"""
+        self.assertEqual(printcore.classify_line("start\n").kind,
+                         printcore.LINE_OTHER)
+
+    def test_capability(self):
+        """Test the parsing of capabilities reported by M115"""
+        self.assertEqual(printcore.parse_capability("Cap:AUTOREPORT_POS:1\n"),
+                         ("AUTOREPORT_POS", True))
+        self.assertEqual(printcore.parse_capability("Cap:EEPROM:0\n"),
+                         ("EEPROM", False))
+
+
+class TestAutoreport(unittest.TestCase):
+    """Checks for the reports sent by the firmware on its own"""
+
+    @classmethod
+    def setUpClass(cls):
+        mock_sttyhup(cls)
+
+    def setUp(self):
+        self.answers = iter([])
+        self.mocked_serial = mock_serial(self, self.printer)
+        self.write = self.mocked_serial.return_value.write
+        self.core = printcore.printcore()
+        self.addCleanup(self.core.disconnect)
+        self.mocked_handler = add_mocked_handler(self.core)
+
+    def printer(self):
+        """Give the queued answers, then acknowledgements"""
+        time.sleep(CNC_PROCESS_TIME/10)
+        return next(self.answers, DEFAULT_ANSWER).encode()
+
+    def test_enable(self):
+        """Test that supported reports are enabled once online"""
+        self.core.autoreport_interval = 2
+        self.core.connect("/mocked/port", 1000)
+        wait_printer_cycles(2)
+        self.write.assert_any_call(b"M115\n")
+        self.answers = iter(["FIRMWARE_NAME:Marlin 2.1.2\n",
+                             "Cap:AUTOREPORT_TEMP:1\n",
+                             "Cap:AUTOREPORT_POS:0\n",
+                             "Cap:AUTOREPORT_SD_STATUS:1\n"])
+        wait_printer_cycles(5)
+        self.write.assert_any_call(b"M155 S2\n")
+        self.write.assert_any_call(b"M27 S2\n")
+        self.assertNotIn(mock.call(b"M154 S2\n"), self.write.call_args_list)
+        self.assertEqual(self.core.autoreports,
+                         {printcore.LINE_TEMP, printcore.LINE_SD_STATUS})
+        self.assertEqual(self.core.capabilities,
+                         {"AUTOREPORT_TEMP": True, "AUTOREPORT_POS": False,
+                          "AUTOREPORT_SD_STATUS": True})
+        with self.subTest("Check reports are enabled again on restart"):
+            self.write.reset_mock()
+            self.answers = iter(["start\n", "Cap:AUTOREPORT_TEMP:1\n"])
+            wait_printer_cycles(5)
+            self.write.assert_any_call(b"M115\n")
+            self.assertEqual(self.core.autoreports, {printcore.LINE_TEMP})
+
+    def test_disabled(self):
+        """Test that capabilities are not requested by default"""
+        self.core.connect("/mocked/port", 1000)
+        wait_printer_cycles(2)
+        self.answers = iter(["Cap:AUTOREPORT_TEMP:1\n"])
+        wait_printer_cycles(5)
+        self.assertNotIn(mock.call(b"M115\n"), self.write.call_args_list)
+        self.assertNotIn(mock.call(b"M155 S0\n"), self.write.call_args_list)
+        self.assertEqual(self.core.autoreports, set())
+        self.assertEqual(self.core.capabilities, {"AUTOREPORT_TEMP": True})
+
+    def test_reports(self):
+        """Test that reports trigger the `on_temp` and `on_position` events"""
+        self.core.connect("/mocked/port", 1000)
+        wait_printer_cycles(2)
+        temp = " T:210.00 /210.00 B:60.00 /60.00 @:0 B@:0\n"
+        position = "X:1.00 Y:2.00 Z:0.30 E:0.00 Count X:80 Y:160 Z:120\n"
+        self.answers = iter([temp, position])
+        wait_printer_cycles(5)
+        self.mocked_handler.on_temp.assert_any_call(temp)
+        self.mocked_handler.on_position.assert_any_call(position)
+
+
 class TestReset(unittest.TestCase):
     """Functional checks for the reset method"""
 
@@ -680,6 +1113,23 @@ class TestSendThread(unittest.TestCase):
                 assert_equal_glines(self, self.parsed_gline,
                                     item.call_args.args[1])
 
+    def test_stop_idle_sender(self):
+        """Test that an idle send thread is woken up to be stopped"""
+        send_thread = self.core.send_thread
+        # pylint: disable-next=protected-access
+        self.core._stop_sender()
+        with self.subTest("Check the send thread is stopped"):
+            self.assertFalse(send_thread.is_alive())
+        with self.subTest("Check nothing was written to the printer"):
+            self.mocked_serial.return_value.write.assert_called_once()
+        with self.subTest("Check a print ignores the wake-up marker"):
+            self.core.priqueue.put_nowait(None)
+            self.core.startprint(gcoder.GCode(["G1 X1"]))
+            wait_printer_cycles(4)
+            self.mocked_serial.return_value.write.assert_any_call(
+                checksum_command("G1 X1"))
+            self.assertTrue(self.core.priqueue.empty())
+
     def test_write_serial_error(self):
         """Test an error is logged when serial error during writing"""
         with (
@@ -736,17 +1186,54 @@ class TestListenThread(unittest.TestCase):
         """Test that the `on_temp` event is triggered"""
         event = self.mocked_handler.on_temp
         cb = mock_callback(self, self.core, "tempcb")
-        answer = f"{DEFAULT_ANSWER} T:"
+        # Lines are split at their end of line when read
+        answer = f"{DEFAULT_ANSWER.rstrip()} T:\n"
         self.printer_answer = answer.encode()
         wait_printer_cycles(2)
         subtest_mock(self, "", (event, cb), "assert_any_call", answer)
 
+    def test_recv_classified(self):
+        """Test that received lines are passed classified to handlers"""
+        line = self.mocked_handler.on_recv.call_args.args[0]
+        self.assertEqual(line.kind, printcore.LINE_OK)
+        self.assertTrue(line.ok)
+
     def test_read_resend(self):
         """Check resendfrom is set when resend is read"""
         self.printer_answer = "rs N2 Expected checksum 67".encode()
         wait_printer_cycles(2)
         self.assertEqual(self.core.resendfrom, 2)
 
+    def test_resend_without_ok(self):
+        """Check resend requests grant a line when no ok follows them"""
+        firmwares = {
+            "ok after resends": (["Resend: 2\n", "ok\n", "Resend: 3\n",
+                                  "ok\n"], [True, False, True, False, True]),
+            # The first request waits for a read timeout, the next ones
+            # grant a line right away
+            "no ok after resends": (["Resend: 2\n", "", "Resend: 3\n",
+                                     "ok\n", "Resend: 4\n"],
+                                    [True, False, True, True, True, True]),
+        }
+        for name, (replies, expected) in firmwares.items():
+            with self.subTest(name):
+                core = printcore.printcore()
+                core.printer = mock.Mock(is_connected=True)
+                core.printing = True
+                replies = iter(replies)
+                granted = []
+
+                def readline():
+                    # Whether a line could be sent before this reply
+                    granted.append(core.clear)
+                    core.clear = False
+                    reply = next(replies, None)
+                    return (None if reply is None
+                            else printcore.classify_line(reply))
+                with mock.patch.object(core, "_readline", readline):
+                    core._listen()  # pylint: disable=protected-access
+                self.assertEqual(granted, expected)
+
     def test_read_none(self):
         """Test that an error is logged if None is read"""
         with self.assertLogs(level="ERROR"):
@@ -763,7 +1250,7 @@ class TestListenThread(unittest.TestCase):
         """Check error is logged when serial error while reading"""
         with (
             self.assertLogs(level="ERROR"),
-            mock.patch.object(self.mocked_serial.return_value, "readline",
+            mock.patch.object(self.mocked_serial.return_value, "readinto",
                               side_effect=serial.SerialException)
         ):
             wait_printer_cycles(2)
@@ -772,13 +1259,13 @@ class TestListenThread(unittest.TestCase):
         """Test that socket file resource is read"""
         core, mocked_socket = setup_socket_core(self)
         socket_file = mocked_socket.return_value.makefile.return_value
-        socket_file.read.assert_called()
+        socket_file.readinto.assert_called()
 
     def test_read_socket_error(self):
         """Check error is logged when socket error while reading"""
         with (
             self.assertLogs(level="ERROR"),
-            mock.patch.object(self.mocked_serial.return_value, "readline",
+            mock.patch.object(self.mocked_serial.return_value, "readinto",
                               side_effect=socket.error)
         ):
             wait_printer_cycles(2)
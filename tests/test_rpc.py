@@ -0,0 +1,168 @@
+"""Test suite for `printrun/rpc.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import http.client
+import json
+import time
+import unittest
+
+# Custom libraries:
+from printrun import gcoder
+from printrun import rpc
+from printrun.eventbus import EventBus
+
+TIMEOUT = 5  # in s
+TEMP_REPORT = "ok T:200.0 /210.0 B:60.0 /60.0"
+
+
+class FakeCore:
+    """The parts of printcore used by the server"""
+
+    def __init__(self):
+        self.online = True
+        self.printing = False
+        self.queueindex = 0
+        self.mainqueue = None
+        self.event_bus = EventBus()
+        self.sent = []
+
+    def send_now(self, command):
+        self.sent.append(command)
+
+
+class FakePronsole:
+    """The parts of pronsole used by the server"""
+
+    def __init__(self):
+        self.p = FakeCore()
+        self.filename = None
+        self.sdprinting = False
+        self.percentdone = 0
+        self.curlayer = 0
+        self.tempreadings = ""
+
+    def do_load(self, filename):
+        self.filename = filename
+
+    def do_print(self, l):
+        self.p.printing = True
+
+    def get_eta(self):
+        return 60, 120, self.p.queueindex
+
+
+def wait_for(condition):
+    """Wait until `condition()` is true"""
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
+
+
+class TestProntRPC(unittest.TestCase):
+    """Functional checks of the HTTP API"""
+
+    def setUp(self):
+        self.pronsole = FakePronsole()
+        self.addCleanup(self.pronsole.p.event_bus.close)
+        self.server = rpc.ProntRPC(self.pronsole, port=0)
+        self.addCleanup(self.server.shutdown)
+        self.handler = self.server.handler
+        self.connection = self.connect()
+
+    def connect(self):
+        """Open a connection to the server"""
+        connection = http.client.HTTPConnection("localhost", self.server.port,
+                                                timeout=TIMEOUT)
+        self.addCleanup(connection.close)
+        return connection
+
+    def request(self, method, path, args=None,
+                content_type="application/json"):
+        """Send a request, returns the status and decoded answer"""
+        body = json.dumps(args) if args is not None else None
+        self.connection.request(method, path, body,
+                                {"Content-Type": content_type})
+        response = self.connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def status(self):
+        return self.request("GET", "/status")[1]
+
+    def test_status(self):
+        """Test the status snapshot, updated from events"""
+        self.assertEqual(self.status(), {"filename": None, "progress": None,
+                                         "eta": None, "temps": None,
+                                         "z": 0, "layer": None})
+        # Delivered by the dispatcher thread of the bus
+        self.pronsole.p.event_bus.publish("temp", (TEMP_REPORT,))
+        wait_for(lambda: self.status()["temps"] is not None)
+        self.assertEqual(self.status()["temps"],
+                         {"T": ["200.0", "210.0"], "B": ["60.0", "60.0"]})
+
+    def test_functions(self):
+        """Test calling control functions on a kept alive connection"""
+        self.assertEqual(self.request("POST", "/send", {"command": "M105"}),
+                         (200, {"result": None}))
+        self.assertEqual(self.request("POST", "/settemp",
+                                      {"targettemp": 210}),
+                         (200, {"result": None}))
+        self.assertEqual(self.request("POST", "/load_file",
+                                      {"filename": "part.gcode"}),
+                         (200, {"result": None}))
+        self.assertEqual(self.request("POST", "/startprint"),
+                         (200, {"result": None}))
+        self.assertEqual(self.pronsole.p.sent, ["M105", "M104 S210"])
+        self.assertEqual(self.pronsole.filename, "part.gcode")
+        self.assertTrue(self.pronsole.p.printing)
+
+    def test_errors(self):
+        """Test the answers to invalid requests"""
+        self.assertEqual(self.request("POST", "/send", {"cmd": "M105"})[0],
+                         400)
+        self.assertEqual(self.request("POST", "/send", ["M105"])[0], 400)
+        self.assertEqual(self.request("POST", "/explode")[0], 404)
+        self.assertEqual(self.request("GET", "/send")[0], 405)
+        self.assertEqual(self.request("POST", "/send", {"command": "M105"},
+                                      "text/plain")[0], 415)
+        self.assertEqual(self.pronsole.p.sent, [])
+
+    def test_events(self):
+        """Test the stream of events"""
+        # Heights exact in float32, as stored by the compiled line class
+        gcode = gcoder.GCode(["G1 Z0.2", "G1 X1 E1", "G1 Z0.5", "G1 X2 E2"])
+        self.pronsole.p.mainqueue = gcode
+        stream = self.connect()
+        stream.request("GET", "/events")
+        response = stream.getresponse()
+        self.assertEqual(response.getheader("Content-Type"),
+                         "text/event-stream")
+
+        def read_event():
+            event = response.fp.readline().decode().strip()
+            data = response.fp.readline().decode().strip()
+            self.assertEqual(response.fp.readline(), b"\n")
+            return (event.removeprefix("event: "),
+                    json.loads(data.removeprefix("data: ")))
+
+        self.assertEqual(read_event()[0], "status")
+        self.handler.on_start(False)
+        self.pronsole.p.queueindex = 2
+        self.handler.on_printsend(None)
+        self.handler.on_printsend(None)
+        self.handler.on_layerchange(1)
+        self.handler.on_temp(TEMP_REPORT)
+        self.handler.on_end()
+        self.assertEqual(read_event(), ("start", {"resume": False}))
+        self.assertEqual(read_event(), ("progress", {"progress": 50}))
+        self.assertEqual(read_event(), ("layer", {"layer": 1, "z": 0.5}))
+        self.assertEqual(read_event()[0], "temp")
+        self.assertEqual(read_event(), ("end", {}))
+        self.assertEqual(self.status()["layer"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+"""Test suite for `printrun/sdupload.py`"""
+# How to run the tests (requires Python 3.11+):
+#   python3 -m unittest discover tests
+
+# Standard libraries:
+import random
+import socket
+import struct
+import threading
+import time
+import unittest
+
+# Custom libraries:
+from printrun import printcore
+from printrun import sdupload
+
+TIMEOUT = 5  # in s
+GCODE = ["; generated for the tests", "G28 ; home", "", "M117 Hello world"] \
+    + [f"G1 X{i % 100} Y{i % 7}.5 E{i} ; move {i}" for i in range(2000)]
+
+
+def wait_for(condition):
+    """Wait until `condition()` is true"""
+    deadline = time.monotonic() + TIMEOUT
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.001)
+
+
+class FakeFirmware:
+    """Network printer with an SD card, accepting uploads between M28 and
+    M29 or with the binary file transfer protocol"""
+
+    def __init__(self, binary=True, compression=True):
+        self.binary = binary
+        self.compression = compression
+        self.files = {}
+        self.writes = 0
+        # Set to stop answering, as if packets were lost
+        self.mute = False
+        # Write packets replied to with a resend request, or ignored
+        self.corrupt = set()
+        self.dropped = set()
+        # Cleared to hold the acknowledgements of write packets back
+        self.gate = threading.Event()
+        self.gate.set()
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.connection = None
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.close()
+        if self.connection is not None:
+            self.connection.close()
+        self.thread.join(TIMEOUT)
+
+    def serve(self):
+        self.connection, address = self.server.accept()
+        self.connection.sendall(b"start\n")
+        self.buffer = b""
+        self.binary_mode = False
+        self.saving = None
+        self.sync = 0
+        while True:
+            try:
+                data = self.connection.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            self.buffer += data
+            while self.buffer:
+                if self.binary_mode:
+                    if not self.read_packet():
+                        break
+                elif not self.read_line():
+                    break
+
+    def write(self, text):
+        if not self.mute:
+            self.connection.sendall(text.encode() + b"\n")
+
+    def read_line(self):
+        line, newline, rest = self.buffer.partition(b"\n")
+        if not newline:
+            return False
+        self.buffer = rest
+        line = line.decode().strip()
+        if line == "M28 B1":
+            self.binary_mode = True
+            self.write("ok")
+        elif self.saving is not None:
+            if line.startswith("M29"):
+                self.saving = None
+                self.write("Done saving file.\nok")
+            else:
+                self.files[self.saving].append(line)
+                self.write("ok")
+        elif line.startswith("M28 "):
+            self.saving = line[4:]
+            self.files[self.saving] = []
+            self.write(f"Writing to file: {self.saving}\nok")
+        elif line == "M115":
+            self.write("FIRMWARE_NAME:Fake\n"
+                       f"Cap:BINARY_FILE_TRANSFER:{int(self.binary)}\nok")
+        elif line == "M105":
+            self.write("ok T:20.0 /0.0")
+        else:
+            self.write("ok")
+        return True
+
+    def read_packet(self):
+        start = self.buffer.find(sdupload.PACKET_TOKEN)
+        if start < 0:
+            self.buffer = self.buffer[-1:]
+            return False
+        header = self.buffer[start + 2:start + 8]
+        if len(header) < 6:
+            return False
+        sync, meta, size, checksum = struct.unpack("<BBHH", header)
+        end = start + 8 + (size + 2 if size else 0)
+        if len(self.buffer) < end:
+            return False
+        payload = self.buffer[start + 8:end - 2]
+        footer = self.buffer[end - 2:end]
+        self.buffer = self.buffer[end:]
+        protocol, packet_type = meta >> 4, meta & 0xF
+        if (protocol, packet_type) == (0, sdupload.CONTROL_SYNC):
+            self.write(f"ss{self.sync},512,0.1.0")
+            return True
+        valid = sdupload.fletcher16(header[:4]) == checksum and (
+            not size or struct.unpack("<H", footer)[0]
+            == sdupload.fletcher16(payload, sdupload.fletcher16(header)))
+        if sync == (self.sync - 1) % 256:
+            self.write(f"ok{sync}")
+            return True
+        if packet_type == sdupload.FILE_WRITE and protocol == 1:
+            self.writes += 1
+            if self.writes in self.corrupt:
+                valid = False
+            if self.writes in self.dropped:
+                return True
+        if sync != self.sync or not valid:
+            self.write(f"rs{self.sync}")
+            return True
+        if packet_type == sdupload.FILE_WRITE:
+            self.gate.wait(TIMEOUT)
+        self.write(f"ok{sync}")
+        self.sync = (self.sync + 1) % 256
+        self.dispatch(protocol, packet_type, payload)
+        return True
+
+    def dispatch(self, protocol, packet_type, payload):
+        if protocol == sdupload.PROTOCOL_CONTROL:
+            if packet_type == sdupload.CONTROL_CLOSE:
+                self.binary_mode = False
+        elif packet_type == sdupload.FILE_QUERY:
+            compression = "heatshrink,8,4" if self.compression else "none"
+            self.write(f"PFT:version:0.1.0:compression:{compression}")
+        elif packet_type == sdupload.FILE_OPEN:
+            self.compressed = payload[1] == 1
+            self.saving = payload[2:-1].decode()
+            self.received = bytearray()
+            self.write("PFT:success")
+        elif packet_type == sdupload.FILE_WRITE:
+            self.received += payload
+        elif packet_type == sdupload.FILE_CLOSE:
+            data = bytes(self.received)
+            if self.compressed:
+                data = sdupload.decompress(data)
+            self.files[self.saving] = data.decode().splitlines()
+            self.saving = None
+            self.write("PFT:success")
+        elif packet_type == sdupload.FILE_ABORT:
+            self.saving = None
+            self.write("PFT:success")
+
+
+class TestCompaction(unittest.TestCase):
+    """Checks of the encoding functions"""
+
+    def test_compact(self):
+        """Test comments and spaces are stripped"""
+        self.assertEqual(list(sdupload.compact(GCODE[:5])),
+                         ["G28", "M117 Hello world", "G1X0Y0.5E0"])
+        self.assertEqual(sdupload.compact_line("  (comment) M104 S200 "),
+                         "M104 S200")
+
+    def test_heatshrink(self):
+        """Test compressed data, written in chunks, decompresses back"""
+        data = "".join(line + "\n" for line in sdupload.compact(GCODE))
+        data = data.encode() + bytes(random.randrange(4)
+                                     for i in range(10000))
+        encoder = sdupload.HeatshrinkEncoder()
+        compressed = b"".join(encoder.compress(data[i:i + 100])
+                              for i in range(0, len(data), 100))
+        compressed += encoder.flush()
+        self.assertLess(len(compressed), len(data) / 2)
+        self.assertEqual(sdupload.decompress(compressed), data)
+        self.assertEqual(sdupload.HeatshrinkEncoder().flush(), b"")
+
+    def test_packet(self):
+        """Test the packet layout and checksums"""
+        self.assertEqual(sdupload.fletcher16(b"abcde"), 0xC8F0)
+        self.assertEqual(sdupload.build_packet(3, 0, 1),
+                         b"\xb5\xad\x03\x01\x00\x00\x04\x0f")
+        packet = sdupload.build_packet(1, 1, 3, b"G28\n")
+        self.assertEqual(packet[8:12], b"G28\n")
+        self.assertEqual(struct.unpack("<H", packet[12:])[0],
+                         sdupload.fletcher16(packet[2:12]))
+
+
+class TestSDUpload(unittest.TestCase):
+    """Functional checks of uploads to a fake firmware"""
+
+    def connect(self, **kwargs):
+        """Connect a printcore to a fake firmware"""
+        self.firmware = FakeFirmware(**kwargs)
+        self.addCleanup(self.firmware.close)
+        self.core = printcore.printcore()
+        # Not the global handlers, other tests leave theirs there
+        self.core.event_handler = []
+        self.core.connect(f"127.0.0.1:{self.firmware.port}", 115200)
+        self.addCleanup(self.core.disconnect)
+        wait_for(lambda: self.core.online)
+
+    def upload(self, **kwargs):
+        """Start uploading GCODE as TEST.GCO"""
+        kwargs.setdefault("timeout", 0.2)
+        upload = sdupload.SDUpload(self.core, GCODE, "TEST.GCO", **kwargs)
+        self.assertTrue(upload.start())
+        return upload
+
+    def check_file(self, upload):
+        """Check the whole file was received"""
+        self.assertTrue(upload.wait(TIMEOUT))
+        self.assertEqual(upload.state, sdupload.DONE)
+        self.assertEqual(upload.progress, 1)
+        lines = [line for line in self.firmware.files["TEST.GCO"]
+                 if not line.startswith("M110")]
+        self.assertEqual(lines, list(sdupload.compact(GCODE)))
+
+    def check_link(self):
+        """Check commands are sent again once the upload ended"""
+        temps = []
+        self.core.callback.temp = temps.append
+        self.core.send_now("M105")
+        wait_for(lambda: temps)
+
+    def test_binary(self):
+        """Test compressed binary uploads"""
+        self.connect()
+        upload = self.upload()
+        self.check_file(upload)
+        self.assertTrue(upload.binary)
+        self.assertEqual(upload.compression, (8, 4))
+        # Blocks of 512 bytes, compressed by about half
+        self.assertLess(self.firmware.writes, upload.size / 800)
+        self.check_link()
+
+    def test_uncompressed(self):
+        """Test binary uploads to firmwares lacking compression"""
+        self.connect(compression=False)
+        upload = self.upload(window=4)
+        self.check_file(upload)
+        self.assertIsNone(upload.compression)
+        self.assertEqual(self.firmware.writes, -(-upload.size // 512))
+
+    def test_text(self):
+        """Test the text fallback of other firmwares"""
+        self.connect(binary=False)
+        upload = self.upload()
+        self.check_file(upload)
+        self.assertFalse(upload.binary)
+        self.check_link()
+
+    def test_errors(self):
+        """Test packets are sent again on resend requests and timeouts"""
+        self.connect()
+        self.firmware.corrupt = {1, 3}
+        self.firmware.dropped = {5, 6}
+        self.check_file(self.upload())
+
+    def test_pause_resume(self):
+        """Test a paused upload keeps the file open until resumed"""
+        self.connect()
+        self.firmware.gate.clear()
+        upload = self.upload()
+        wait_for(lambda: self.firmware.writes)
+        self.assertTrue(upload.pause())
+        self.firmware.gate.set()
+        time.sleep(0.1)
+        self.assertEqual(upload.state, sdupload.PAUSED)
+        self.assertEqual(self.firmware.writes, 1)
+        self.assertGreater(upload.sent, 0)
+        self.assertFalse(upload.wait(0))
+        self.assertTrue(upload.resume())
+        self.check_file(upload)
+
+    def test_interrupted(self):
+        """Test resuming an upload the firmware stopped answering"""
+        self.connect()
+        self.firmware.gate.clear()
+        upload = self.upload(retries=2)
+        wait_for(lambda: self.firmware.writes)
+        self.firmware.mute = True
+        self.firmware.gate.set()
+        with self.assertLogs(level="ERROR"):
+            self.assertTrue(upload.wait(TIMEOUT))
+        self.assertEqual(upload.state, sdupload.INTERRUPTED)
+        self.assertFalse(upload.finished)
+        self.firmware.mute = False
+        self.assertTrue(upload.resume())
+        self.check_file(upload)
+
+    def test_cancel(self):
+        """Test cancelled uploads abort the file"""
+        self.connect()
+        self.firmware.gate.clear()
+        upload = self.upload()
+        wait_for(lambda: self.firmware.writes)
+        self.assertTrue(upload.cancel())
+        self.firmware.gate.set()
+        self.assertTrue(upload.wait(TIMEOUT))
+        self.assertEqual(upload.state, sdupload.CANCELLED)
+        self.assertNotIn("TEST.GCO", self.firmware.files)
+        self.assertLess(upload.progress, 1)
+        self.check_link()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,26 +4,100 @@
 # bash1$ ./testtools/mock-printer.py
 # bash2$ ./pronterface.py
 # Enter localhost:8080 in Port, press Connect, Load file, Print
-import socket
-with socket.socket() as s:
-    s.bind(('127.0.0.1', 8080))
-    s.listen(1)
-    c, addr = s.accept()
-    print(c)
-    temp = 0
+#
+# A pool of printers on consecutive ports tests hosts driving many of them:
+# bash1$ ./testtools/mock-printer.py --count 30 --delay 0.002 --quiet
+# bash2$ ./printfarm.py --printer localhost:8080-8109 --copies 60 file.gcode
+import argparse
+import asyncio
+
+# test multiple extruders, see #1234
+TEMPERATURE_REPORT = b'ok T0:24.06 /34.00 B:23.45 /0.00 T1:44.28 /54 @:0 B@:0 @0:0 @1:0\n'
+
+
+class MockPrinter(asyncio.Protocol):
+    """Printer greeting on connection and acknowledging each line after
+    `delay` seconds of processing"""
+
+    def __init__(self, name, delay=0, verbose=True):
+        self.name = name
+        self.delay = delay
+        self.verbose = verbose
+        # Lines received, over all connections
+        self.received = 0
+        self.transport = None
+        self._buffer = b''
+        self._busy_until = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.verbose:
+            print(self.name, transport.get_extra_info('peername'))
+        transport.write(b'start\n')
+
+    def data_received(self, data):
+        *lines, self._buffer = (self._buffer + data).split(b'\n')
+        for line in lines:
+            self.received += 1
+            if self.verbose:
+                print(self.name, line)
+            self.reply(TEMPERATURE_REPORT if line.endswith(b'M105')
+                       else b'ok\n')
+
+    def reply(self, answer):
+        if not self.delay:
+            self.transport.write(answer)
+            return
+        # Lines are processed one after the other
+        loop = asyncio.get_running_loop()
+        self._busy_until = max(self._busy_until, loop.time()) + self.delay
+        loop.call_at(self._busy_until, self._write, answer)
+
+    def _write(self, answer):
+        if not self.transport.is_closing():
+            self.transport.write(answer)
+
+
+async def serve(count=1, host='127.0.0.1', port=8080, delay=0, verbose=True):
+    """Serve `count` printers on consecutive ports from `port`, 0 to pick
+    free ports. Returns the servers and their printers."""
+    loop = asyncio.get_running_loop()
+    servers = []
+    printers = []
+    for i in range(count):
+        printer = MockPrinter(f'printer{i}', delay, verbose)
+        server = await loop.create_server(lambda p=printer: p, host,
+                                          port + i if port else 0)
+        servers.append(server)
+        printers.append(printer)
+    return servers, printers
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description='Serve mock network printers on consecutive ports')
+    parser.add_argument('--count', type=int, default=1,
+                        help='number of printers (%(default)s)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='port of the first printer (%(default)s)')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='seconds spent processing each line')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not print the received lines')
+    args = parser.parse_args()
+    servers, printers = await serve(args.count, args.host, args.port,
+                                    args.delay, not args.quiet)
+    print(f'{args.count} printer(s) on {args.host}:{args.port}'
+          f'-{args.port + args.count - 1}')
     try:
-        c.sendall(b'start\n')
-        while True:
-            msg = c.recv(1024)
-            if not msg:
-                break
-            print(msg)
-            if msg == b'M105\n':
-                # c.sendall(('ok T:%d\n'%(20 + temp)).encode('ascii'))
-                # test multiple extruders, see #1234
-                c.sendall('ok T0:24.06 /34.00 B:23.45 /0.00 T1:44.28 /54 @:0 B@:0 @0:0 @1:0\n'.encode('ascii'))
-                temp = (temp + 1)%30
-            else:
-                c.sendall(b'ok\n')
+        await asyncio.gather(*(server.serve_forever() for server in servers))
     finally:
-        c.close()
+        print('Lines received:', sum(p.received for p in printers))
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass